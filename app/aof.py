@@ -0,0 +1,170 @@
+"""Append-only file: every write is logged as the RESP command that redoes it.
+
+Commands are buffered in memory as they are propagated and written out in
+one go before the replies of the same read cycle leave, so a pipeline of
+writes costs one write(2). How often the data is forced to disk depends on
+the fsync policy:
+
+    always    fsync before the replies go out, nothing acknowledged is lost
+    everysec  a background thread fsyncs once a second, at most ~1s is lost
+    no        leave it to the kernel (usually ~30s)
+
+rewrite() writes the smallest set of commands that rebuilds a keyspace,
+which is how the log is compacted (BGREWRITEAOF).
+"""
+import os
+import threading
+import time
+
+from app import strings
+from app.quicklist import QuickList
+from app.resp import RespParser
+from app.stream import Stream, format_entry_id
+
+APPENDFSYNC_POLICIES = ('always', 'everysec', 'no')
+READ_CHUNK_SIZE = 256 * 1024
+# Items per RPUSH when rewriting a list, so no command gets too big
+AOF_REWRITE_ITEMS_PER_CMD = 64
+
+
+def encode_command(parts):
+    out = [b'*%d\r\n' % len(parts)]
+    for part in parts:
+        out.append(b'$%d\r\n' % len(part))
+        out.append(part)
+        out.append(b'\r\n')
+    return b''.join(out)
+
+
+class AppendOnlyFile:
+    """The open log: write buffer, fsync policy and background fsync thread"""
+
+    def __init__(self, path, fsync_policy):
+        self.path = path
+        self.fsync_policy = fsync_policy
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self.size = os.fstat(self.fd).st_size
+        self.buf = bytearray()
+        self.last_write_error = None
+        self.fsync_pending = False
+        # Held around fsync and while the file is swapped by a rewrite
+        self.fd_lock = threading.Lock()
+        if fsync_policy == 'everysec':
+            threading.Thread(target=self._fsync_every_second, daemon=True).start()
+
+    def feed(self, data):
+        self.buf += data
+
+    def flush(self):
+        """Write out the buffer, and fsync it if the policy is always"""
+        if not self.buf:
+            return
+        try:
+            view = memoryview(self.buf)
+            written = 0
+            try:
+                while written < len(view):
+                    written += os.write(self.fd, view[written:])
+            finally:
+                view.release()
+                del self.buf[:written]
+                self.size += written
+        except OSError as e:
+            # Keep what wasn't written and try again on the next flush; the
+            # server refuses writes meanwhile (see last_write_error)
+            if self.last_write_error is None:
+                print(f"Error writing to the AOF file: {e}")
+            self.last_write_error = e
+            return
+        self.last_write_error = None
+        if self.fsync_policy == 'always':
+            with self.fd_lock:
+                os.fsync(self.fd)
+        else:
+            self.fsync_pending = True
+
+    def _fsync_every_second(self):
+        # Off the command path: fsync can take a long time on a busy disk
+        while True:
+            time.sleep(1)
+            if not self.fsync_pending:
+                continue
+            self.fsync_pending = False
+            with self.fd_lock:
+                if self.fd is None:
+                    return
+                try:
+                    os.fsync(self.fd)
+                except OSError as e:
+                    print(f"Error fsyncing the AOF file: {e}")
+
+    def replace(self, new_path):
+        """Rename new_path over the log and continue appending to it"""
+        with self.fd_lock:
+            os.replace(new_path, self.path)
+            os.close(self.fd)
+            self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            self.size = os.fstat(self.fd).st_size
+
+    def close(self):
+        self.flush()
+        with self.fd_lock:
+            os.fsync(self.fd)
+            os.close(self.fd)
+            self.fd = None
+
+
+def rewrite(fp, data_store, expiry_store):
+    """Write the commands that rebuild the keyspace to fp.
+
+    Expiry times are absolute (PEXPIREAT), so the log means the same thing
+    whenever it is replayed."""
+    for key, value in data_store.items():
+        if isinstance(value, QuickList):
+            items = list(value)
+            for i in range(0, len(items), AOF_REWRITE_ITEMS_PER_CMD):
+                fp.write(encode_command([b'RPUSH', key] + items[i:i + AOF_REWRITE_ITEMS_PER_CMD]))
+        elif isinstance(value, Stream):
+            last_id = format_entry_id(value.last_id())
+            if not len(value):
+                # An empty stream still has its last ID, which new IDs must exceed
+                fp.write(encode_command([b'XADD', key, b'MAXLEN', b'0', last_id, b'x', b'y']))
+            for node in value.nodes:
+                for i in range(len(node)):
+                    if not node.is_deleted(i):
+                        entry_id = format_entry_id(node.entry_id(i))
+                        fp.write(encode_command([b'XADD', key, entry_id] + node.entry(i)))
+            if len(value) and entry_id != last_id:
+                fp.write(encode_command([b'XSETID', key, last_id]))
+            for name, group in value.groups.items():
+                fp.write(encode_command([b'XGROUP', b'CREATE', key, name, format_entry_id(group.last_id),
+                                         b'MKSTREAM']))
+                for consumer in group.consumers.values():
+                    fp.write(encode_command([b'XGROUP', b'CREATECONSUMER', key, name, consumer.name]))
+                for entry_id in group.pending_ids:
+                    nack = group.pending[entry_id]
+                    fp.write(encode_command([b'XCLAIM', key, name, nack.consumer.name, b'0',
+                                             format_entry_id(entry_id), b'TIME', b'%d' % nack.delivery_time,
+                                             b'RETRYCOUNT', b'%d' % nack.delivery_count, b'FORCE', b'JUSTID']))
+        else:
+            fp.write(encode_command([b'SET', key, strings.to_bytes(value)]))
+        when = expiry_store.get(key)
+        if when is not None:
+            fp.write(encode_command([b'PEXPIREAT', key, b'%d' % when]))
+
+
+def read_commands(fp):
+    """Yield (command parts, offset just past the command) for a log file.
+
+    The file is parsed READ_CHUNK_SIZE bytes at a time, so replaying a big
+    log never holds more than a chunk and the command being read. A log
+    whose last command was cut short (a crash mid-write) stops early: the
+    caller compares the last offset with the file size."""
+    parser = RespParser()
+    while True:
+        chunk = fp.read(READ_CHUNK_SIZE)
+        if not chunk:
+            return
+        parser.feed(chunk)
+        for parts in parser:
+            yield parts, parser.consumed()
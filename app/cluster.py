@@ -0,0 +1,283 @@
+"""Cluster mode: hash slots, the node table and how nodes learn about each other.
+
+Every key maps to one of HASH_SLOTS slots (CRC16 of the key, or of its
+{hash tag}), and every slot is served by one node. A node that gets a
+command for a slot it doesn't serve answers -MOVED with the owner's
+address; while a slot is being migrated, keys already gone from the source
+are answered with -ASK, which is good for that one command.
+
+There is no separate cluster bus: each node asks every node it knows for
+CLUSTER NODES once a second and merges what it hears (ClusterState.merge).
+A node is believed about the slots it claims for itself, and when two nodes
+claim a slot the one with the higher config epoch wins, which is how a
+migrated slot changes hands everywhere. Unknown nodes in a peer's table are
+added, so meeting one node of a cluster is enough to learn all of it.
+
+The node table is saved in the cluster config file (nodes.conf), in the
+CLUSTER NODES format plus a "vars" line, so a node keeps its ID and slots
+across restarts.
+"""
+import binascii
+import os
+import socket
+import time
+
+HASH_SLOTS = 16384
+NODE_ID_SIZE = 40
+CLUSTER_BUS_PORT_OFFSET = 10000  # only shown in CLUSTER NODES, the bus is the client port
+
+
+def key_hash_slot(key):
+    start = key.find(b'{')
+    if start != -1:
+        end = key.find(b'}', start + 1)
+        # An empty tag ("{}") doesn't count, the whole key is hashed
+        if end > start + 1:
+            key = key[start + 1:end]
+    # crc_hqx is CRC16-CCITT (XModem), the checksum Redis Cluster uses
+    return binascii.crc_hqx(key, 0) % HASH_SLOTS
+
+
+def new_node_id():
+    return os.urandom(NODE_ID_SIZE // 2).hex()
+
+
+def format_slot_ranges(slots):
+    """Sorted slot numbers -> [(first, last), ...] of consecutive runs"""
+    ranges = []
+    for slot in slots:
+        if ranges and ranges[-1][1] == slot - 1:
+            ranges[-1][1] = slot
+        else:
+            ranges.append([slot, slot])
+    return [tuple(r) for r in ranges]
+
+
+class ClusterNode:
+    def __init__(self, node_id, host, port, config_epoch=0, handshake=False):
+        self.node_id = node_id
+        self.host = host
+        self.port = port
+        self.config_epoch = config_epoch
+        self.handshake = handshake  # met, but its real ID isn't known yet
+        self.link_connected = False
+        self.pong_received = 0  # unix ms of the last answer to our poll
+
+    @property
+    def address(self):
+        return f"{self.host}:{self.port}"
+
+
+class ClusterState:
+    def __init__(self, host, port):
+        self.myself = ClusterNode(new_node_id(), host, port)
+        self.myself.link_connected = True
+        self.nodes = {self.myself.node_id: self.myself}
+        self.slots = [None] * HASH_SLOTS  # slot -> ClusterNode serving it
+        self.migrating = {}  # slot -> node we're moving it to
+        self.importing = {}  # slot -> node we're taking it from
+        self.current_epoch = 0
+
+    # Slots
+
+    def node_slots(self, node):
+        return [slot for slot, owner in enumerate(self.slots) if owner is node]
+
+    def slots_assigned(self):
+        return sum(1 for owner in self.slots if owner is not None)
+
+    def is_ok(self):
+        # Like cluster-require-full-coverage yes: all slots or nothing
+        return self.slots_assigned() == HASH_SLOTS
+
+    def bump_epoch(self):
+        """Give myself a config epoch greater than any seen, so the slots I
+        claim win over older claims"""
+        self.current_epoch += 1
+        self.myself.config_epoch = self.current_epoch
+
+    # Nodes
+
+    def meet(self, host, port):
+        for node in self.nodes.values():
+            if node.host == host and node.port == port:
+                return
+        node = ClusterNode(new_node_id(), host, port, handshake=True)
+        self.nodes[node.node_id] = node
+
+    def forget(self, node):
+        del self.nodes[node.node_id]
+        for slot, owner in enumerate(self.slots):
+            if owner is node:
+                self.slots[slot] = None
+        for table in (self.migrating, self.importing):
+            for slot in [slot for slot, other in table.items() if other is node]:
+                del table[slot]
+
+    def describe(self):
+        """The CLUSTER NODES text, one line per node"""
+        lines = []
+        now_ms = int(time.time() * 1000)
+        for node in self.nodes.values():
+            flags = "myself,master" if node is self.myself else "handshake" if node.handshake else "master"
+            pong = now_ms if node is self.myself else node.pong_received
+            line = (f"{node.node_id} {node.address}@{node.port + CLUSTER_BUS_PORT_OFFSET} {flags} - 0 {pong} "
+                    f"{node.config_epoch} {'connected' if node.link_connected else 'disconnected'}")
+            for first, last in format_slot_ranges(self.node_slots(node)):
+                line += f" {first}" if first == last else f" {first}-{last}"
+            if node is self.myself:
+                for slot, other in sorted(self.migrating.items()):
+                    line += f" [{slot}->-{other.node_id}]"
+                for slot, other in sorted(self.importing.items()):
+                    line += f" [{slot}-<-{other.node_id}]"
+            lines.append(line)
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def parse(text):
+        """CLUSTER NODES text -> dicts with id, host, port, flags, epoch, slots"""
+        entries = []
+        for line in text.splitlines():
+            fields = line.split()
+            if len(fields) < 8:
+                continue
+            address = fields[1].split('@')[0]
+            host, _, port = address.rpartition(':')
+            slots = []
+            migrations = []
+            for spec in fields[8:]:
+                if spec.startswith('['):
+                    migrations.append(spec)
+                elif '-' in spec:
+                    first, last = spec.split('-')
+                    slots.extend(range(int(first), int(last) + 1))
+                else:
+                    slots.append(int(spec))
+            entries.append({'id': fields[0], 'host': host, 'port': int(port),
+                            'flags': fields[2].split(','), 'epoch': int(fields[6]),
+                            'slots': slots, 'migrations': migrations})
+        return entries
+
+    def merge(self, node, text):
+        """Take in what `node` answered to CLUSTER NODES. Returns True if our
+        table changed (and so should be saved)."""
+        changed = False
+        for entry in self.parse(text):
+            if 'myself' in entry['flags']:
+                changed |= self._merge_self_report(node, entry)
+            elif entry['id'] not in self.nodes and 'handshake' not in entry['flags']:
+                # Someone the peer knows and we don't: meet it through the peer
+                self.nodes[entry['id']] = ClusterNode(entry['id'], entry['host'], entry['port'], entry['epoch'])
+                changed = True
+        return changed
+
+    def _merge_self_report(self, node, entry):
+        changed = False
+        if node.handshake:
+            # Now we know who answers at that address
+            del self.nodes[node.node_id]
+            known = self.nodes.get(entry['id'])
+            if known is not None or entry['id'] == self.myself.node_id:
+                return True
+            node.node_id = entry['id']
+            node.handshake = False
+            self.nodes[node.node_id] = node
+            changed = True
+        elif entry['id'] != node.node_id:
+            return False
+        if entry['epoch'] != node.config_epoch:
+            node.config_epoch = entry['epoch']
+            changed = True
+        if node.config_epoch > self.current_epoch:
+            self.current_epoch = node.config_epoch
+            changed = True
+        if node.config_epoch == self.myself.config_epoch and node.node_id > self.myself.node_id:
+            # Two nodes with the same epoch couldn't settle a conflicting
+            # claim; the one with the smaller ID moves on
+            self.bump_epoch()
+            changed = True
+        for slot in entry['slots']:
+            owner = self.slots[slot]
+            if owner is node or slot in self.importing:
+                continue
+            if owner is None or owner.config_epoch < node.config_epoch:
+                self.slots[slot] = node
+                if owner is self.myself:
+                    self.migrating.pop(slot, None)
+                changed = True
+        return changed
+
+    # The config file
+
+    def save(self, path):
+        temp_path = f"{path}.tmp-{os.getpid()}"
+        with open(temp_path, 'w') as fp:
+            fp.write(self.describe())
+            fp.write(f"vars currentEpoch {self.current_epoch} lastVoteEpoch 0\n")
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(temp_path, path)
+
+    def load(self, path):
+        """Restore the table from a config file; False if there is none"""
+        try:
+            with open(path) as fp:
+                text = fp.read()
+        except FileNotFoundError:
+            return False
+        entries = self.parse(text)
+        nodes = {}
+        myself = None
+        for entry in entries:
+            node = ClusterNode(entry['id'], entry['host'], entry['port'], entry['epoch'],
+                               handshake='handshake' in entry['flags'])
+            nodes[node.node_id] = node
+            if 'myself' in entry['flags']:
+                myself = node
+            for slot in entry['slots']:
+                self.slots[slot] = node
+        if myself is None:
+            raise ValueError(f"no 'myself' node in {path}")
+        myself.host, myself.port = self.myself.host, self.myself.port
+        myself.link_connected = True
+        self.myself, self.nodes = myself, nodes
+        for entry in entries:
+            for spec in entry['migrations']:
+                # [slot->-id] or [slot-<-id]
+                slot, arrow, other = spec[1:-1].partition('->-') if '->-' in spec else spec[1:-1].partition('-<-')
+                if other in nodes:
+                    (self.migrating if arrow == '->-' else self.importing)[int(slot)] = nodes[other]
+        for line in text.splitlines():
+            fields = line.split()
+            if fields[:2] == ['vars', 'currentEpoch']:
+                self.current_epoch = int(fields[2])
+        return True
+
+
+class NodeLink:
+    """Blocking connection to another node, for polling it"""
+
+    def __init__(self, host, port, timeout):
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.reader = self.sock.makefile('rb')
+
+    def call(self, *parts):
+        """Send a command and return its reply (simple or bulk string)"""
+        out = [b'*%d\r\n' % len(parts)]
+        for part in parts:
+            data = str(part).encode()
+            out.append(b'$%d\r\n%s\r\n' % (len(data), data))
+        self.sock.sendall(b''.join(out))
+        line = self.reader.readline()
+        if not line:
+            raise ConnectionError("connection closed")
+        if line.startswith(b'-'):
+            raise ConnectionError(line[1:].strip().decode())
+        if line.startswith(b'$'):
+            length = int(line[1:])
+            return None if length < 0 else self.reader.read(length + 2)[:-2].decode()
+        return line[1:].strip().decode()
+
+    def close(self):
+        self.reader.close()
+        self.sock.close()
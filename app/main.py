@@ -1,843 +1,4058 @@
-from multiprocessing.dummy import connection
+import asyncio
+import fnmatch
+import heapq
+import io
+import math
+import mmap
+import os
+import queue
+import random
 import socket 
 import threading 
 import time
 import sys
-from collections import defaultdict
+from collections import defaultdict, deque
 
+from app.resp import RespParser, ProtocolError, write_array, write_bulk, write_value
+from app.stream import STREAM_NODE_MAX_ENTRIES, Stream, StreamGroup, format_entry_id
+from app.quicklist import QuickList
+from app.replication import BulkReader, ReplicationBacklog
+from app import aof, cluster, rdb, strings, workers
 
-waiting_clients = defaultdict(list)
+
+# key -> waiters parked on it by BLPOP / XREAD BLOCK, as a dict in the order
+# they blocked (the values are unused), so a waiter leaves its keys in O(1)
+key_waiters = defaultdict(dict)
+ready_keys = {}  # keys written to while clients wait on them, in order (values unused)
+# key_waiters entry of clients in WAIT, signalled when a replica acknowledges more
+# of the stream; not a string, so it can't clash with a real key
+REPLICA_ACK = object()
 data_store = {}
 expiry_store = {}
+expiry_heap = []  # (unix ms, key) min-heap over expiry_store, may hold stale pairs
 NULL_BULK_STRING = b'$-1\r\n'
+WRONGTYPE_ERROR = b'-WRONGTYPE Operation against a key holding the wrong kind of value\r\n'
+READ_BUFFER_SIZE = 16 * 1024
+MAX_IOV = 1024  # buffers per sendmsg call (IOV_MAX on Linux)
 # Global server configuration
 server_role = "master"  # default role
 master_host = None
 master_port = None
-master_replid = "8371b4fb1155b71f4a04d3e1bc3e18c4a990aeeb"  # 40 character replication ID
+# 40 character replication ID, new on every start so a replica never resumes
+# a stream from a different run of the master
+master_replid = os.urandom(20).hex()
 master_repl_offset = 0  
 replica_listening_port=None
+repl_backlog_size = 1024 * 1024
+repl_backlog = None  # ReplicationBacklog, created when the first replica connects
+replicas = []  # clients that sent PSYNC, fed every propagated write
+# A replica this far behind is disconnected; it resyncs when it reconnects
+replica_output_buffer_limit = 256 * 1024 * 1024
+REPL_TIMEOUT = 60  # seconds to wait for the master during the handshake
+REPL_ACK_PERIOD = 1  # seconds between a replica's REPLCONF ACKs
+repl_getack_offset = -1  # master_repl_offset right after the last REPLCONF GETACK sent
+# Full syncs stream the snapshot from a forked child straight to the sockets
+repl_diskless_sync = True
+repl_diskless_sync_delay = 5  # seconds to wait for more replicas to share a transfer
+repl_transfer_start_at = None  # time.monotonic() the next transfer is due, None if no replica waits
+repl_transfer_running = False
+RDB_EOF_MARK_SIZE = 40
+REPL_TRANSFER_HIGH_WATER = 4 * 1024 * 1024  # replica backlog that pauses reading the snapshot pipe
+master_link_status = "down"  # replica side
+repl_synced = False  # replica side: holds data from master_replid up to master_repl_offset
+io_mode = "threads"  # "threads" (one thread per connection) or "asyncio"
+# Worker mode (--workers N): this process owns a share of the slots, see app/workers.py
+worker_count = 1
+worker_id = 0
+worker_socket_dir = None
+worker_parent_pid = None
+# Cluster mode (--cluster-enabled yes), see app/cluster.py
+cluster_enabled = False
+cluster_state = None  # ClusterState: the nodes and who serves which slot
+cluster_config_file = "nodes.conf"
+cluster_announce_ip = "127.0.0.1"
+CLUSTER_POLL_INTERVAL = 1  # seconds between polls of each known node
+CLUSTER_NODE_TIMEOUT = 2   # seconds a polled node has to answer
+slot_keys = defaultdict(set)  # cluster mode: slot -> the keys stored in it
+# Output buffer limit per client: hard bytes, soft bytes, seconds over soft (0 disables)
+client_output_buffer_limit = (256 * 1024 * 1024, 64 * 1024 * 1024, 60)
+# Keep stream entries encoded once they have been read, see Stream.encoded_entry
+stream_entry_cache = True
+
+# Serializes command execution across connection threads
+store_lock = threading.RLock()
+
+server_hz = 10  # server_cron runs this many times per second
+# Share of each cron tick the active expire cycle may spend deleting keys
+ACTIVE_EXPIRE_CYCLE_BUDGET = 0.25
+stats = {
+    'total_connections_received': 0,
+    'expired_keys': 0,
+    'expired_time_cap_reached_count': 0,
+    'expire_cycle_cpu_milliseconds': 0,
+    'evicted_keys': 0,
+    'lazyfreed_objects': 0,
+}
+connected_clients = 0
+blocked_clients = 0
+OPS_SAMPLES = 16
+# (time.monotonic(), commands processed) at each cron tick, for instantaneous_ops_per_sec
+ops_samples = deque(maxlen=OPS_SAMPLES)
+
+# Commands at least this slow (microseconds, negative disables) go into the slow log
+slowlog_log_slower_than = 10000
+slowlog_max_len = 128
+slowlog = deque()  # newest last: [id, unix time, microseconds, arguments, client address]
+slowlog_next_id = 0
+SLOWLOG_ENTRY_MAX_ARGC = 32
+SLOWLOG_ENTRY_MAX_STRING = 128
+
+# UNLINK hands values made of more blocks than this (list chunks, stream
+# nodes) to the reclaimer thread, smaller ones are cheaper to free in place
+LAZYFREE_THRESHOLD = 64
+lazyfree_queue = None  # values for the reclaimer thread, created on first use
+lazyfree_pending = 0
+
+# maxmemory: 0 means no limit, and no per-key memory/access tracking at all
+maxmemory = 0
+maxmemory_policy = "noeviction"
+maxmemory_samples = 5
+MAXMEMORY_POLICIES = ('noeviction', 'allkeys-lru', 'allkeys-lfu', 'allkeys-random',
+                      'volatile-lru', 'volatile-lfu', 'volatile-random', 'volatile-ttl')
+used_memory = 0  # sum of the estimated sizes in key_meta
+# Per-key metadata packed in one int, only kept while maxmemory is set:
+#   bits 0-7    LFU counter (logarithmic, decays while the key is idle)
+#   bits 8-31   LRU clock of the last access, seconds, wraps every ~194 days
+#   bits 32-63  estimated size in bytes
+#   bits 64+    position in sample_keys
+key_meta = {}
+sample_keys = []  # keys of key_meta in a list, so sampling is O(1)
+EVICTION_POOL_SIZE = 16
+eviction_pool = []  # best (score, key) candidates seen by recent samplings, best last
+LFU_INIT_VAL = 5
+LFU_LOG_FACTOR = 10
+LFU_DECAY_TIME = 60  # seconds of idle time per LFU counter decrement
+KEY_OVERHEAD = 72  # dict entry and bookkeeping per key, roughly
+
+# RDB persistence
+rdb_dir = "."
+rdb_filename = "dump.rdb"
+save_params = []  # [(seconds, changes)]: BGSAVE once both are reached
+dirty = 0  # changes since the last successful save
+dirty_before_bgsave = 0
+rdb_child_pid = None
+rdb_bgsave_started = 0
+lastsave = int(time.time())
+rdb_last_bgsave_status = "ok"
+
+# Append-only file
+appendonly = False
+appendfilename = "appendonly.aof"
+appendfsync = "everysec"
+aof_file = None  # aof.AppendOnlyFile while appendonly is on
+aof_child_pid = None
+aof_rewrite_buf = None  # what was logged since the rewrite child forked, None if there's no child
+aof_rewrite_started = 0
+aof_rewrite_scheduled = False  # BGREWRITEAOF arrived while a BGSAVE child was running
+aof_last_rewrite_time = -1
+aof_last_bgrewrite_status = "ok"
+aof_base_size = 0  # size after the last rewrite, for auto-aof-rewrite-percentage
+auto_aof_rewrite_percentage = 100
+auto_aof_rewrite_min_size = 64 * 1024 * 1024
+# Commands the running call wants logged, see propagate()
+pending_propagation = []
+
+def encode_resp_array(elements):
+    """Array of bulk strings"""
+    out = bytearray()
+    write_array(out, elements)
+    return out
+
+def encode_resp(value):
+    """RESP for nested lists of strings and integers, None as a null bulk string"""
+    out = bytearray()
+    write_value(out, value)
+    return out
+
+def parse_memory(value):
+    # "100", "64kb", "256mb", "1gb" -> bytes
+    units = {'b': 1, 'k': 1000, 'kb': 1024, 'm': 1000**2, 'mb': 1024**2, 'g': 1000**3, 'gb': 1024**3}
+    value = value.strip().lower()
+    number = value.rstrip('bkmg')
+    unit = value[len(number):] or 'b'
+    if unit not in units:
+        raise ValueError(f"invalid memory unit '{unit}'")
+    return int(number) * units[unit]
+
+def parse_entry_id(entry_id):
+    try:
+        ms_str, seq_str = entry_id.split(b'-')
+        ms = int(ms_str)
+        seq = seq_str
+        if seq != b'*':
+            seq = int(seq_str)
+        return ms, seq
+    except Exception:
+        return None
+
+def parse_entry_id_with_default(entry_id_str, default_seq_for_end=False):
+    MAX_SEQ = 18446744073709551615  # Max 64-bit unsigned int
+    MAX_MS = 9223372036854775807   # Approx max int64 ms timestamp (can use a large number)
+    if entry_id_str == b'+':
+        # Return maximum possible ID
+        return MAX_MS, MAX_SEQ
+    if b'-' in entry_id_str:
+        ms_str, seq_str = entry_id_str.split(b'-')
+        ms = int(ms_str)
+        seq = int(seq_str)
+        return ms, seq
+    else:
+        ms = int(entry_id_str)
+        seq = MAX_SEQ if default_seq_for_end else 0
+        return ms, seq
+
+def encode_stream_entries(entries, out=None):
+    # Array of stream entries, as returned already encoded by Stream.range()
+    # and friends (each one is [id, [field, value, ...]])
+    if out is None:
+        out = bytearray()
+    out += b'*%d\r\n' % len(entries)
+    for entry in entries:
+        out += entry
+    return out
+
+def to_bulk_string(message):
+    return b'$%d\r\n%s\r\n' % (len(message), message)
+
+def is_stream(obj):
+    return isinstance(obj, Stream)
+
+def is_list(obj):
+    return isinstance(obj, QuickList)
+
+def value_memory_usage(value):
+    # Approximate bytes held by a value, for MEMORY USAGE
+    if is_stream(value) or is_list(value):
+        return value.memory_usage()
+    return sys.getsizeof(value)
+
+def delete_key(key):
+    del data_store[key]
+    expiry_store.pop(key, None)
+    if maxmemory:
+        forget_key_meta(key)
+    if cluster_enabled:
+        slot_keys[cluster.key_hash_slot(key)].discard(key)
+
+def free_effort(value):
+    # Blocks to free for a value, each one a single deallocation
+    if is_list(value):
+        return len(value.chunks)
+    if is_stream(value):
+        return len(value.nodes) + sum(len(group.pending) for group in value.groups.values())
+    return 1
+
+def free_value_async(value):
+    global lazyfree_queue, lazyfree_pending
+    if lazyfree_queue is None:
+        lazyfree_queue = queue.SimpleQueue()
+        threading.Thread(target=lazyfree_thread, daemon=True).start()
+    lazyfree_pending += 1
+    lazyfree_queue.put(value)
+
+def lazyfree_thread():
+    """Free the values UNLINK handed over.
+
+    Dropping a big container is one long deallocation that holds the GIL
+    until it's done. Taking it apart a block at a time instead lets the
+    GIL go to the threads serving clients between blocks."""
+    global lazyfree_pending
+    while True:
+        value = lazyfree_queue.get()
+        if is_list(value):
+            chunks = value.chunks
+            while chunks:
+                chunks.pop()
+        elif is_stream(value):
+            nodes = value.nodes
+            while nodes:
+                nodes.pop()
+            for group in value.groups.values():
+                for consumer in group.consumers.values():
+                    consumer.pending.clear()
+                pending = group.pending
+                while pending:
+                    pending.popitem()
+        del value
+        with store_lock:
+            lazyfree_pending -= 1
+            stats['lazyfreed_objects'] += 1
+
+def lru_clock():
+    return int(time.monotonic()) & 0xFFFFFF
+
+def lfu_log_incr(counter):
+    # The busier the key already is, the less likely another hit bumps it
+    if counter == 255:
+        return counter
+    base = max(counter - LFU_INIT_VAL, 0)
+    if random.random() < 1.0 / (base * LFU_LOG_FACTOR + 1):
+        counter += 1
+    return counter
+
+def lfu_decayed(meta, now):
+    idle = (now - ((meta >> 8) & 0xFFFFFF)) & 0xFFFFFF
+    return max((meta & 0xFF) - idle // LFU_DECAY_TIME, 0)
+
+def key_memory_usage(key):
+    return KEY_OVERHEAD + sys.getsizeof(key) + value_memory_usage(data_store[key])
+
+def update_key_meta(key):
+    """Refresh the size estimate of a key that was just written"""
+    global used_memory
+    if key not in data_store:
+        forget_key_meta(key)
+        return
+    size = min(key_memory_usage(key), 0xFFFFFFFF)
+    meta = key_meta.get(key)
+    now = lru_clock()
+    if meta is None:
+        key_meta[key] = (len(sample_keys) << 64) | (size << 32) | (now << 8) | LFU_INIT_VAL
+        sample_keys.append(key)
+        used_memory += size
+    else:
+        used_memory += size - ((meta >> 32) & 0xFFFFFFFF)
+        key_meta[key] = (meta & ~(0xFFFFFFFF << 32)) | (size << 32)
+
+def touch_key(key):
+    meta = key_meta.get(key)
+    if meta is not None:
+        now = lru_clock()
+        counter = lfu_log_incr(lfu_decayed(meta, now))
+        key_meta[key] = (meta & ~0xFFFFFFFF) | (now << 8) | counter
+
+def forget_key_meta(key):
+    global used_memory
+    meta = key_meta.pop(key, None)
+    if meta is None:
+        return
+    used_memory -= (meta >> 32) & 0xFFFFFFFF
+    # Swap the last sampled key into the freed slot
+    pos = meta >> 64
+    last = sample_keys.pop()
+    if last != key:
+        sample_keys[pos] = last
+        key_meta[last] = (key_meta[last] & ((1 << 64) - 1)) | (pos << 64)
+
+def sample_eviction_candidates():
+    """Up to maxmemory_samples (score, key) pairs, higher score evicts first"""
+    now = lru_clock()
+    candidates = []
+    volatile = maxmemory_policy.startswith('volatile')
+    # Volatile policies sample expiry_heap, a list of (deadline, key), which
+    # only holds keys with a TTL (plus stale pairs, skipped here)
+    population = expiry_heap if volatile else sample_keys
+    if not population:
+        return candidates
+    for _ in range(maxmemory_samples):
+        picked = population[random.randrange(len(population))]
+        if volatile:
+            when, key = picked
+            if expiry_store.get(key) != when:
+                continue
+        else:
+            key = picked
+        meta = key_meta.get(key)
+        if meta is None:
+            continue
+        if maxmemory_policy.endswith('lru'):
+            score = (now - ((meta >> 8) & 0xFFFFFF)) & 0xFFFFFF  # idle seconds
+        elif maxmemory_policy.endswith('lfu'):
+            score = 255 - lfu_decayed(meta, now)
+        elif maxmemory_policy == 'volatile-ttl':
+            score = -expiry_store[key]
+        else:
+            score = random.random()
+        candidates.append((score, key))
+    return candidates
+
+def perform_evictions():
+    """Evict keys until used_memory fits in maxmemory; False if it can't"""
+    while used_memory > maxmemory:
+        if maxmemory_policy == 'noeviction':
+            return False
+        # Merge the new samples into the pool of best candidates so far,
+        # which makes a handful of samples approximate a full scan well
+        for candidate in sample_eviction_candidates():
+            if candidate not in eviction_pool:
+                eviction_pool.append(candidate)
+        eviction_pool.sort()
+        del eviction_pool[:-EVICTION_POOL_SIZE]
+        evicted = False
+        while eviction_pool:
+            _, key = eviction_pool.pop()
+            if key in data_store and (not maxmemory_policy.startswith('volatile') or key in expiry_store):
+                delete_key(key)
+                stats['evicted_keys'] += 1
+                propagate([b'DEL', key])
+                evicted = True
+                break
+        if not evicted and not (expiry_store if maxmemory_policy.startswith('volatile') else key_meta):
+            # Nothing left that the policy may evict
+            return False
+    return True
+
+def before_command(command, command_parts):
+    """Lazy expiry, access tracking and the maxmemory check.
+
+    Returns an error reply if the command must be refused, None otherwise."""
+    expire_command_keys(command_parts)
+    if maxmemory:
+        for arg in command_parts[1:]:
+            if arg in key_meta:
+                touch_key(arg)
+        if 'denyoom' in command.flags and not perform_evictions():
+            return "-OOM command not allowed when used memory > 'maxmemory'.\r\n"
+    if aof_file is not None and aof_file.last_write_error is not None and 'write' in command.flags:
+        return f"-MISCONF Errors writing to the AOF file: {aof_file.last_write_error.strerror}\r\n"
+    return None
+
+def after_write(keys):
+    # Refresh size estimates of the keys (or key-like arguments) a write touched,
+    # and in cluster mode index new keys by slot
+    if maxmemory:
+        for key in keys:
+            if key in data_store or key in key_meta:
+                update_key_meta(key)
+    if cluster_enabled:
+        for key in keys:
+            if key in data_store:
+                slot_keys[cluster.key_hash_slot(key)].add(key)
+
+def set_expiry(key, when_ms):
+    expiry_store[key] = when_ms
+    heapq.heappush(expiry_heap, (when_ms, key))
+
+def delete_expired_key(key):
+    delete_key(key)
+    stats['expired_keys'] += 1
+    # The log replays the deletion rather than redoing the expiry check
+    propagate([b'DEL', key])
+
+def expire_if_needed(key):
+    """Lazily delete key if its TTL has passed; True if it was deleted"""
+    when = expiry_store.get(key)
+    if when is None or int(time.time() * 1000) <= when:
+        return False
+    delete_expired_key(key)
+    return True
+
+def expire_command_keys(command_parts):
+    # Any argument naming a key past its TTL is deleted before the command
+    # runs. A value that happens to match such a key costs a harmless early
+    # delete, which is cheaper than knowing every command's key positions.
+    # Replicas leave it to the master, whose DEL arrives with the stream.
+    if expiry_store and server_role == "master":
+        for arg in command_parts[1:]:
+            if arg in expiry_store:
+                expire_if_needed(arg)
+
+def active_expire_cycle():
+    """Delete keys whose TTL has passed, oldest deadline first.
+
+    expiry_heap is ordered by deadline, so this only looks at keys that are
+    actually due. Pairs left behind by keys whose TTL changed or that were
+    deleted are skipped. Stops once the cycle uses its share of the tick."""
+    start = time.monotonic()
+    budget = ACTIVE_EXPIRE_CYCLE_BUDGET / server_hz
+    now_ms = int(time.time() * 1000)
+    checked = 0
+    while expiry_heap and expiry_heap[0][0] < now_ms:
+        when, key = heapq.heappop(expiry_heap)
+        if expiry_store.get(key) == when:
+            delete_expired_key(key)
+        checked += 1
+        if checked % 16 == 0 and time.monotonic() - start > budget:
+            stats['expired_time_cap_reached_count'] += 1
+            break
+    # Rebuild once stale pairs outnumber live deadlines
+    if len(expiry_heap) > 2 * len(expiry_store) + 1024:
+        expiry_heap[:] = [(when, key) for key, when in expiry_store.items()]
+        heapq.heapify(expiry_heap)
+    stats['expire_cycle_cpu_milliseconds'] += int((time.monotonic() - start) * 1000)
+
+def server_cron():
+    """Background housekeeping, run server_hz times per second"""
+    if worker_count > 1 and os.getppid() != worker_parent_pid:
+        # The supervisor is gone (killed outright), and with it the way to stop us
+        print(f"Worker {worker_id}: parent process exited, shutting down")
+        with store_lock:
+            if aof_file is not None:
+                aof_file.close()
+        os._exit(1)
+    with store_lock:
+        ops_samples.append((time.monotonic(), total_commands_processed()))
+        if server_role == "master":
+            active_expire_cycle()
+        propagate_pending()
+        check_rdb_child()
+        check_aof_child()
+        if rdb_child_pid is None and aof_child_pid is None:
+            elapsed = time.time() - lastsave
+            for seconds, changes in save_params:
+                if dirty >= changes and elapsed >= seconds:
+                    print(f"{changes} changes in {seconds} seconds. Saving...")
+                    rdb_bgsave()
+                    break
+        if (repl_transfer_start_at is not None and not repl_transfer_running
+                and time.monotonic() >= repl_transfer_start_at):
+            start_diskless_transfer()
+        if rdb_child_pid is None and aof_child_pid is None:
+            if aof_rewrite_scheduled:
+                aof_bgrewrite()
+            elif (aof_file is not None and auto_aof_rewrite_percentage
+                  and aof_file.size > auto_aof_rewrite_min_size
+                  and (aof_file.size - aof_base_size) * 100 >= auto_aof_rewrite_percentage * max(aof_base_size, 1)):
+                print(f"Starting automatic rewriting of AOF on {aof_file.size * 100 // max(aof_base_size, 1) - 100}% growth")
+                aof_bgrewrite()
+        if aof_file is not None:
+            aof_file.flush()
+
+def propagate(command_parts):
+    """Log the command that redoes a write, in the form that replays exactly.
+
+    Called by commands as they change the dataset. What is logged is what
+    happened, not what was asked for: XADD * gets the ID it picked, relative
+    TTLs become PEXPIREAT, BLPOP becomes LPOP and expirations become DEL."""
+    pending_propagation.append(command_parts)
+
+def propagate_pending():
+    """Hand the commands propagated by the call that just ran to the AOF and
+    the replicas.
+
+    Several at once (an EXEC, or SET with a TTL) are wrapped in MULTI/EXEC,
+    so a replay applies all of them or none. Returns True if there was
+    anything to propagate."""
+    if not pending_propagation:
+        return False
+    if aof_file is not None or aof_rewrite_buf is not None or repl_backlog is not None:
+        commands = pending_propagation
+        if len(commands) > 1:
+            commands = [[b'MULTI']] + commands + [[b'EXEC']]
+        data = b''.join(aof.encode_command(parts) for parts in commands)
+        if aof_file is not None:
+            aof_file.feed(data)
+        if aof_rewrite_buf is not None:
+            aof_rewrite_buf.append(data)
+        if repl_backlog is not None:
+            replication_feed(data)
+    pending_propagation.clear()
+    return True
+
+def flush_append_only_file():
+    # Called before replies are written, so with appendfsync always a client
+    # never sees the reply to a write that isn't on disk yet
+    if aof_file is not None and aof_file.buf:
+        with store_lock:
+            aof_file.flush()
+
+def cron_thread():
+    while True:
+        time.sleep(1 / server_hz)
+        server_cron()
+
+async def cron_task():
+    while True:
+        await asyncio.sleep(1 / server_hz)
+        server_cron()
+
+def total_commands_processed():
+    return sum(command.calls for command in COMMAND_TABLE.values())
+
+def instantaneous_ops_per_sec():
+    # Over the samples server_cron took in the last OPS_SAMPLES ticks
+    if len(ops_samples) < 2:
+        return 0
+    (start, start_calls), (end, end_calls) = ops_samples[0], ops_samples[-1]
+    return int((end_calls - start_calls) / (end - start)) if end > start else 0
+
+def rss_memory():
+    """Resident set size of the process in bytes, 0 where /proc isn't there"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return 0
+
+def info_response(section):
+    """Bulk string reply for INFO [section]. No section, or default, gives
+    every section but commandstats; all and everything add it."""
+    def wanted(name):
+        return section == name or section in (None, 'default', 'all', 'everything')
+
+    sections = []
+    if wanted('clients'):
+        sections.append(f"# Clients\r\nconnected_clients:{connected_clients - len(replicas)}\r\n"
+                        f"blocked_clients:{blocked_clients}")
+    if wanted('replication'):
+        lines = [f"role:{server_role}"]
+        if server_role == "master":
+            lines.append(f"connected_slaves:{len(replicas)}")
+            now = time.monotonic()
+            for i, replica in enumerate(replicas):
+                lines.append(f"slave{i}:ip={replica.address[0]},port={replica.replica_listening_port},"
+                             f"state={replica.repl_state},offset={replica.repl_ack_offset},"
+                             f"lag={int(now - replica.repl_ack_time)}")
+        else:
+            lines += [f"master_host:{master_host}", f"master_port:{master_port}",
+                      f"master_link_status:{master_link_status}", f"slave_repl_offset:{master_repl_offset}"]
+        lines += [f"master_replid:{master_replid}", f"master_repl_offset:{master_repl_offset}",
+                  f"repl_backlog_active:{int(repl_backlog is not None)}", f"repl_backlog_size:{repl_backlog_size}"]
+        if repl_backlog is not None:
+            lines += [f"repl_backlog_first_byte_offset:{repl_backlog.first_offset}",
+                      f"repl_backlog_histlen:{repl_backlog.histlen}"]
+        sections.append("# Replication\r\n" + "\r\n".join(lines))
+    if wanted('cluster'):
+        sections.append(f"# Cluster\r\ncluster_enabled:{int(cluster_enabled)}")
+    if wanted('memory'):
+        # The keys' sizes are only added up while maxmemory is set
+        lines = [f"used_memory:{used_memory}"] if maxmemory else []
+        lines += [f"used_memory_rss:{rss_memory()}", f"maxmemory:{maxmemory}",
+                  f"maxmemory_policy:{maxmemory_policy}", f"lazyfree_pending_objects:{lazyfree_pending}"]
+        sections.append("# Memory\r\n" + "\r\n".join(lines))
+    if wanted('persistence'):
+        sections.append(
+            f"# Persistence\r\nrdb_changes_since_last_save:{dirty}\r\n"
+            f"rdb_bgsave_in_progress:{int(rdb_child_pid is not None)}\r\n"
+            f"rdb_last_save_time:{lastsave}\r\nrdb_last_bgsave_status:{rdb_last_bgsave_status}\r\n"
+            f"aof_enabled:{int(aof_file is not None)}\r\n"
+            f"aof_rewrite_in_progress:{int(aof_child_pid is not None)}\r\n"
+            f"aof_rewrite_scheduled:{int(aof_rewrite_scheduled)}\r\n"
+            f"aof_last_rewrite_time_sec:{aof_last_rewrite_time}\r\n"
+            f"aof_last_bgrewrite_status:{aof_last_bgrewrite_status}\r\n"
+            f"aof_last_write_status:{'ok' if aof_file is None or aof_file.last_write_error is None else 'err'}"
+            + (f"\r\naof_current_size:{aof_file.size}\r\naof_base_size:{aof_base_size}"
+               f"\r\naof_buffer_length:{len(aof_file.buf)}" if aof_file is not None else ""))
+    if wanted('stats'):
+        lines = [f"total_commands_processed:{total_commands_processed()}",
+                 f"instantaneous_ops_per_sec:{instantaneous_ops_per_sec()}"]
+        lines += [f"{name}:{value}" for name, value in stats.items()]
+        sections.append("# Stats\r\n" + "\r\n".join(lines))
+    if wanted('cpu'):
+        cpu = os.times()
+        sections.append(f"# CPU\r\nused_cpu_sys:{cpu.system:.6f}\r\nused_cpu_user:{cpu.user:.6f}")
+    if section in ('commandstats', 'all', 'everything'):
+        lines = [f"cmdstat_{command.name.lower()}:calls={command.calls},usec={command.usec},"
+                 f"usec_per_call={command.usec / command.calls if command.calls else 0:.2f},"
+                 f"rejected_calls={command.rejected_calls},failed_calls={command.failed_calls}"
+                 for command in COMMAND_TABLE.values() if command.calls or command.rejected_calls]
+        sections.append("# Commandstats" + "".join("\r\n" + line for line in lines))
+    return to_bulk_string("\r\n\r\n".join(sections).encode())
+
+def rdb_path():
+    return os.path.join(rdb_dir, rdb_filename)
+
+def rdb_save():
+    """Write the snapshot to a temp file, then rename it over the old one"""
+    global dirty, lastsave
+    tmp = os.path.join(rdb_dir, f"temp-{os.getpid()}.rdb")
+    with open(tmp, 'wb', buffering=1024 * 1024) as fp:
+        rdb.dump(fp, data_store, expiry_store)
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(tmp, rdb_path())
+    dirty = 0
+    lastsave = int(time.time())
+
+def rdb_bgsave():
+    """Fork a child that writes the snapshot; False if one is already running.
+
+    The child gets a copy-on-write view of the keyspace as of the fork, so
+    the parent keeps serving commands while it writes."""
+    global rdb_child_pid, rdb_bgsave_started, dirty_before_bgsave
+    if rdb_child_pid is not None or aof_child_pid is not None:
+        return False
+    if not hasattr(os, 'fork'):
+        rdb_save()
+        return True
+    dirty_before_bgsave = dirty
+    pid = os.fork()
+    if pid == 0:
+        code = 1
+        try:
+            rdb_save()
+            code = 0
+        finally:
+            os._exit(code)
+    rdb_child_pid = pid
+    rdb_bgsave_started = time.time()
+    print(f"Background saving started by pid {pid}")
+    return True
+
+def check_rdb_child():
+    global rdb_child_pid, dirty, lastsave, rdb_last_bgsave_status
+    if rdb_child_pid is None:
+        return
+    pid, status = os.waitpid(rdb_child_pid, os.WNOHANG)
+    if pid == 0:
+        return
+    rdb_child_pid = None
+    if os.waitstatus_to_exitcode(status) == 0:
+        # Writes that arrived while the child was saving are still unsaved
+        dirty -= dirty_before_bgsave
+        lastsave = int(time.time())
+        rdb_last_bgsave_status = "ok"
+        print("Background saving terminated with success")
+    else:
+        rdb_last_bgsave_status = "err"
+        print("Background saving error")
+
+def rdb_load():
+    """Load the snapshot at startup, if there is one"""
+    path = rdb_path()
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return
+    start = time.monotonic()
+    with open(path, 'rb') as fp, mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        loaded = load_snapshot(rdb.RdbLoader(mapped))
+    print(f"DB loaded from disk: {loaded} keys in {time.monotonic() - start:.3f} seconds")
+
+def load_snapshot(loader):
+    """Add the keys an RdbLoader reads to the keyspace, minus expired ones"""
+    now_ms = int(time.time() * 1000)
+    loaded = 0
+    for key, value, expire_ms in loader.entries():
+        if expire_ms is not None and expire_ms < now_ms:
+            continue
+        data_store[key] = value
+        if expire_ms is not None:
+            set_expiry(key, expire_ms)
+        if maxmemory:
+            update_key_meta(key)
+        if cluster_enabled:
+            slot_keys[cluster.key_hash_slot(key)].add(key)
+        loaded += 1
+    return loaded
+
+def empty_keyspace():
+    global used_memory
+    data_store.clear()
+    expiry_store.clear()
+    expiry_heap.clear()
+    key_meta.clear()
+    sample_keys.clear()
+    eviction_pool.clear()
+    slot_keys.clear()
+    used_memory = 0
+
+def aof_path():
+    return os.path.join(rdb_dir, appendfilename)
+
+def aof_temp_path(pid):
+    return os.path.join(rdb_dir, f"temp-rewriteaof-{pid}.aof")
+
+def aof_rewrite(path):
+    with open(path, 'wb', buffering=1024 * 1024) as fp:
+        aof.rewrite(fp, data_store, expiry_store)
+        fp.flush()
+        os.fsync(fp.fileno())
+
+def aof_install_rewrite(path):
+    """Make the rewritten file at path the log"""
+    global aof_base_size
+    if aof_file is not None:
+        aof_file.replace(path)
+        aof_base_size = aof_file.size
+    else:
+        os.replace(path, aof_path())
+        aof_base_size = os.path.getsize(aof_path())
+
+def aof_bgrewrite():
+    """Fork a child that writes a compacted log from its copy of the keyspace.
+
+    Writes logged while it runs are kept in aof_rewrite_buf and appended to
+    its file once it exits, then that file replaces the log."""
+    global aof_child_pid, aof_rewrite_buf, aof_rewrite_started, aof_rewrite_scheduled
+    global aof_last_rewrite_time, aof_last_bgrewrite_status
+    aof_rewrite_scheduled = False
+    aof_rewrite_started = time.time()
+    if not hasattr(os, 'fork'):
+        path = aof_temp_path(os.getpid())
+        aof_rewrite(path)
+        aof_install_rewrite(path)
+        aof_last_rewrite_time = int(time.time() - aof_rewrite_started)
+        aof_last_bgrewrite_status = "ok"
+        return
+    aof_rewrite_buf = []
+    pid = os.fork()
+    if pid == 0:
+        code = 1
+        try:
+            aof_rewrite(aof_temp_path(os.getpid()))
+            code = 0
+        finally:
+            os._exit(code)
+    aof_child_pid = pid
+    print(f"Background append only file rewriting started by pid {pid}")
+
+def check_aof_child():
+    global aof_child_pid, aof_rewrite_buf, aof_last_rewrite_time, aof_last_bgrewrite_status
+    if aof_child_pid is None:
+        return
+    pid, status = os.waitpid(aof_child_pid, os.WNOHANG)
+    if pid == 0:
+        return
+    aof_child_pid = None
+    path = aof_temp_path(pid)
+    try:
+        if os.waitstatus_to_exitcode(status) != 0:
+            raise OSError("rewrite child failed")
+        with open(path, 'ab') as fp:
+            fp.writelines(aof_rewrite_buf)
+            fp.flush()
+            os.fsync(fp.fileno())
+        aof_install_rewrite(path)
+        aof_last_bgrewrite_status = "ok"
+        print("Background AOF rewrite finished successfully")
+    except OSError as e:
+        aof_last_bgrewrite_status = "err"
+        print(f"Background AOF rewrite error: {e}")
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    aof_rewrite_buf = None
+    aof_last_rewrite_time = int(time.time() - aof_rewrite_started)
+
+
+class ReplayClient:
+    """Runs writes that were already executed elsewhere: the AOF at startup,
+    or the master's stream on a replica. Replies are dropped, and commands
+    between MULTI and EXEC are held back and applied together at EXEC."""
+    def __init__(self):
+        self.transaction = None  # commands queued since MULTI
+
+    def send(self, data):
+        pass
+
+    def apply(self, command_parts):
+        """Run (or queue) one command; returns how many commands were run"""
+        cmd = command_parts[0].upper()
+        if cmd == b'MULTI':
+            self.transaction = []
+            return 0
+        if cmd == b'EXEC':
+            commands, self.transaction = self.transaction or [], None
+        elif self.transaction is not None:
+            self.transaction.append(command_parts)
+            return 0
+        else:
+            commands = [command_parts]
+        for parts in commands:
+            command = COMMAND_TABLE.get(parts[0].upper())
+            if command is not None:
+                command.handler(self, parts)
+                after_write(parts[1:])
+        return len(commands)
+
+
+def aof_load():
+    """Replay the append-only file; False if there isn't one.
+
+    MULTI/EXEC blocks are applied whole. A trailing command or transaction
+    that was cut short (the server died mid-write) is dropped and truncated
+    away, so the file is valid to append to again."""
+    path = aof_path()
+    if not os.path.exists(path):
+        return False
+    start = time.monotonic()
+    size = os.path.getsize(path)
+    client = ReplayClient()
+    applied = 0
+    commands_run = 0
+    with open(path, 'rb') as fp:
+        for command_parts, end in aof.read_commands(fp):
+            commands_run += client.apply(command_parts)
+            pending_propagation.clear()
+            if client.transaction is None:
+                applied = end
+    if applied < size:
+        print(f"AOF ends with an incomplete command, truncating {size - applied} bytes")
+        os.truncate(path, applied)
+    print(f"DB loaded from append only file: {commands_run} commands in {time.monotonic() - start:.3f} seconds")
+    return True
+
+def open_append_only_file():
+    global aof_file, aof_base_size
+    path = aof_path()
+    if not os.path.exists(path):
+        # Turning the log on: start it from what the RDB file loaded
+        aof_rewrite(aof_temp_path(os.getpid()))
+        os.replace(aof_temp_path(os.getpid()), path)
+    aof_file = aof.AppendOnlyFile(path, appendfsync)
+    aof_base_size = aof_file.size
+
+def add_replica(client, replid, offset):
+    """Answer PSYNC and start streaming writes to the replica.
+
+    If the replica already has our history up to `offset` - 1 and the
+    backlog still holds everything after it, only that part is sent
+    (+CONTINUE). Otherwise it gets a snapshot (+FULLRESYNC) taken at the
+    current offset, and the stream carries on from there."""
+    global repl_backlog
+    if repl_backlog is None:
+        repl_backlog = ReplicationBacklog(repl_backlog_size, master_repl_offset)
+    try:
+        psync_offset = int(offset)
+    except ValueError:
+        psync_offset = -1
+    missing = repl_backlog.read_from(psync_offset) if replid == master_replid else None
+    global repl_transfer_start_at
+    client.start_replication()
+    client.repl_ack_time = time.monotonic()
+    replicas.append(client)
+    if missing is not None:
+        print(f"Partial resynchronization of {client.address}: {len(missing)} bytes from offset {psync_offset}")
+        client.feed_replica(f"+CONTINUE {master_replid}\r\n".encode() + missing)
+        client.repl_state = "online"
+    elif repl_diskless_sync and client.repl_capa_eof and hasattr(os, 'fork'):
+        # Replicas arriving within the delay share one snapshot transfer
+        client.repl_state = "wait_bgsave"
+        if repl_transfer_start_at is None:
+            repl_transfer_start_at = time.monotonic() + repl_diskless_sync_delay
+        if not repl_diskless_sync_delay and not repl_transfer_running:
+            start_diskless_transfer()
+    else:
+        # Replicas that can't take an EOF-marked transfer get a length-prefixed
+        # snapshot, which means serializing it in memory first
+        snapshot = io.BytesIO()
+        rdb.dump(snapshot, data_store, expiry_store)
+        payload = snapshot.getvalue()
+        print(f"Full resynchronization of {client.address}: {len(payload)} bytes at offset {master_repl_offset}")
+        client.feed_replica(f"+FULLRESYNC {master_replid} {master_repl_offset}\r\n${len(payload)}\r\n".encode() + payload)
+        client.repl_state = "online"
+
+def replication_feed(data):
+    global master_repl_offset
+    repl_backlog.write(data)
+    master_repl_offset += len(data)
+    for replica in replicas:
+        if replica.repl_state == "online":
+            replica.feed_replica(data)
+        elif replica.repl_state != "wait_bgsave":
+            # Its snapshot is on the way; this goes out after it. Writes to
+            # replicas still in wait_bgsave will be part of their snapshot.
+            replica.repl_held.append(data)
+
+def start_diskless_transfer():
+    """Fork a child that serializes the keyspace into a pipe, and stream that
+    to every replica waiting for a full sync. Nothing touches the disk, and
+    the replicas share the one serialization.
+
+    The payload is sent as "$EOF:<mark>\\r\\n<rdb><mark>", since its length
+    isn't known when it starts. Writes propagated from here on are held per
+    replica until it has loaded the snapshot and sent REPLCONF ACK, so they
+    can't be mistaken for part of the snapshot."""
+    global repl_transfer_start_at, repl_transfer_running
+    repl_transfer_start_at = None
+    targets = [replica for replica in replicas if replica.repl_state == "wait_bgsave"]
+    if not targets:
+        return
+    mark = os.urandom(RDB_EOF_MARK_SIZE // 2).hex().encode()
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        code = 1
+        try:
+            os.close(read_fd)
+            with open(write_fd, 'wb', buffering=1024 * 1024) as pipe:
+                rdb.dump(pipe, data_store, expiry_store)
+            code = 0
+        finally:
+            os._exit(code)
+    os.close(write_fd)
+    header = f"+FULLRESYNC {master_replid} {master_repl_offset}\r\n$EOF:".encode() + mark + b"\r\n"
+    for replica in targets:
+        replica.repl_state = "send_bulk"
+        replica.repl_held = []
+        replica.feed_replica(header)
+    repl_transfer_running = True
+    print(f"Starting diskless transfer to {len(targets)} replica(s) at offset {master_repl_offset}, child pid {pid}")
+    threading.Thread(target=diskless_transfer_thread, args=(pid, read_fd, targets, mark), daemon=True).start()
+
+def diskless_transfer_thread(pid, read_fd, targets, mark):
+    global repl_transfer_running
+    sent = 0
+    with open(read_fd, 'rb', buffering=0) as pipe:
+        while True:
+            # Read no further ahead than the slowest replica is taking it
+            while any(not replica.close_asap and replica.pending_replica_bytes() > REPL_TRANSFER_HIGH_WATER
+                      for replica in targets):
+                time.sleep(0.001)
+            chunk = pipe.read(READ_BUFFER_SIZE * 4)
+            if not chunk:
+                break
+            for replica in targets:
+                replica.feed_replica(chunk)
+            sent += len(chunk)
+    _, status = os.waitpid(pid, 0)
+    succeeded = os.waitstatus_to_exitcode(status) == 0
+    with store_lock:
+        for replica in targets:
+            if succeeded:
+                replica.feed_replica(mark)
+                replica.repl_state = "wait_ack"
+            else:
+                replica.disconnect_replica()
+        repl_transfer_running = False
+    if succeeded:
+        print(f"Diskless transfer done: {sent} bytes to {len(targets)} replica(s)")
+    else:
+        print("Diskless transfer failed, disconnecting its replicas")
+
+def request_replica_acks():
+    """Ask every replica for its offset now, rather than at its next periodic ACK.
+
+    GETACK goes down the stream like a write, so the offset a replica answers
+    with covers everything sent before it. Until more is written, that one
+    request serves every WAIT, however many clients are waiting."""
+    global repl_getack_offset
+    if repl_backlog is None or repl_getack_offset == master_repl_offset:
+        return
+    replication_feed(aof.encode_command([b'REPLCONF', b'GETACK', b'*']))
+    repl_getack_offset = master_repl_offset
+
+def replica_ack_thread(sock, send_lock, link_closed):
+    # Replica side: report the offset applied every REPL_ACK_PERIOD, so the
+    # master always knows how far behind we are
+    while not link_closed.wait(REPL_ACK_PERIOD):
+        try:
+            with send_lock:
+                sock.sendall(aof.encode_command([b'REPLCONF', b'ACK', b'%d' % master_repl_offset]))
+        except OSError:
+            return
+
+def put_replica_online(client):
+    # The replica loaded its snapshot, now it gets what happened meanwhile
+    client.repl_state = "online"
+    held, client.repl_held = client.repl_held, []
+    if held:
+        client.feed_replica(b''.join(held))
+
+def sync_with_master():
+    """Replica side: handshake, full or partial sync, then apply the stream"""
+    global master_replid, master_repl_offset, master_link_status, repl_synced
+    with socket.create_connection((master_host, master_port), timeout=REPL_TIMEOUT) as sock:
+        reader = sock.makefile('rb')
+
+        def call(*parts):
+            sock.sendall(aof.encode_command([part.encode() for part in parts]))
+            reply = reader.readline()
+            if not reply:
+                raise ConnectionError("connection closed by master")
+            if reply.startswith(b'-'):
+                raise ConnectionError(f"master replied {reply.strip().decode()}")
+            return reply.decode().strip()
+
+        call('PING')
+        call('REPLCONF', 'listening-port', str(replica_listening_port or 6379))
+        call('REPLCONF', 'capa', 'eof', 'capa', 'psync2')
+        with store_lock:
+            # Ask to resume after the last byte applied, if there is anything to resume
+            psync = ('PSYNC', master_replid, str(master_repl_offset + 1)) if repl_synced else ('PSYNC', '?', '-1')
+        reply = call(*psync)
+        if reply.startswith('+FULLRESYNC'):
+            _, replid, offset = reply.split()
+            header = reader.readline()
+            while header == b'\n':
+                # The master sends newlines as keepalives while it prepares the snapshot
+                header = reader.readline()
+            if header.startswith(b'$EOF:'):
+                # Diskless: no length up front, the mark follows the snapshot
+                mark = header[5:].rstrip(b'\r\n')
+                source = reader
+            elif header.startswith(b'$'):
+                mark = None
+                source = BulkReader(reader, int(header[1:]))
+            else:
+                raise ConnectionError(f"unexpected snapshot header {header!r}")
+            start = time.monotonic()
+            # Parsed as it arrives, so the snapshot is never held in memory whole
+            with store_lock:
+                empty_keyspace()
+                repl_synced = False
+                loader = rdb.RdbLoader(source)
+                loaded = load_snapshot(loader)
+                loader.read(8)  # checksum
+                if mark is not None and bytes(loader.read(len(mark))) != mark:
+                    raise ConnectionError("snapshot doesn't end with the EOF mark")
+                master_replid, master_repl_offset = replid, int(offset)
+                repl_synced = True
+            print(f"MASTER <-> REPLICA sync: loaded {loaded} keys in {time.monotonic() - start:.3f} seconds")
+            # The master holds the stream back until it hears we're done
+            sock.sendall(aof.encode_command([b'REPLCONF', b'ACK', b'%d' % master_repl_offset]))
+        elif reply.startswith('+CONTINUE'):
+            parts = reply.split()
+            with store_lock:
+                if len(parts) > 1:
+                    master_replid = parts[1]
+            print("MASTER <-> REPLICA sync: partial resynchronization accepted")
+        else:
+            raise ConnectionError(f"unexpected PSYNC reply {reply!r}")
+
+        master_link_status = "up"
+        sock.settimeout(None)
+        parser = RespParser()
+        client = ReplayClient()
+        applied = 0
+        send_lock = threading.Lock()  # the ACK thread writes to the socket too
+        link_closed = threading.Event()
+        threading.Thread(target=replica_ack_thread, args=(sock, send_lock, link_closed), daemon=True).start()
+        try:
+            while True:
+                data = reader.read1(READ_BUFFER_SIZE)
+                if not data:
+                    raise ConnectionError("connection closed by master")
+                parser.feed(data)
+                acks = []
+                with store_lock:
+                    for command_parts in parser:
+                        if command_parts[0].upper() == b'REPLCONF':
+                            # GETACK is answered with the offset before it
+                            if len(command_parts) > 1 and command_parts[1].upper() == b'GETACK':
+                                acks.append(master_repl_offset)
+                        else:
+                            client.apply(command_parts)
+                            propagate_pending()
+                            if ready_keys:
+                                # Readers blocked in XREAD on the replica
+                                serve_blocked_clients()
+                        # Offsets count every byte of the stream, MULTI/EXEC included
+                        master_repl_offset += parser.consumed() - applied
+                        applied = parser.consumed()
+                flush_append_only_file()
+                if acks:
+                    with send_lock:
+                        sock.sendall(b''.join(aof.encode_command([b'REPLCONF', b'ACK', b'%d' % offset])
+                                              for offset in acks))
+        finally:
+            link_closed.set()
+
+def cluster_poll_thread():
+    """Cluster mode: ask every known node for CLUSTER NODES once a second and
+    merge the answers, which is how slot changes and new nodes spread.
+
+    A node that doesn't know us yet is sent CLUSTER MEET, so meeting is
+    mutual. Runs the network part without store_lock."""
+    links = {}  # ClusterNode -> NodeLink
+    while True:
+        time.sleep(CLUSTER_POLL_INTERVAL)
+        with store_lock:
+            myself = cluster_state.myself
+            peers = [node for node in cluster_state.nodes.values() if node is not myself]
+        for node in peers:
+            link = links.get(node)
+            try:
+                if link is None:
+                    link = links[node] = cluster.NodeLink(node.host, node.port, CLUSTER_NODE_TIMEOUT)
+                text = link.call('CLUSTER', 'NODES')
+                if myself.node_id not in text:
+                    link.call('CLUSTER', 'MEET', myself.host, myself.port)
+            except (OSError, ValueError) as e:
+                links.pop(node, None)
+                if link is not None:
+                    link.close()
+                if node.link_connected:
+                    print(f"Cluster node {node.address} unreachable: {e}")
+                node.link_connected = False
+                continue
+            with store_lock:
+                if cluster_state.nodes.get(node.node_id) is not node:
+                    continue  # forgotten meanwhile
+                node.link_connected = True
+                node.pong_received = int(time.time() * 1000)
+                if cluster_state.merge(node, text):
+                    cluster_save_config()
+        for node in list(links):
+            if cluster_state.nodes.get(node.node_id) is not node:
+                links.pop(node).close()
+
+def master_link_thread():
+    """Keep a replica in sync with its master for as long as it runs.
+
+    When the link drops, reconnect after a second; PSYNC then asks for the
+    missing part of the stream only."""
+    global master_link_status
+    while True:
+        try:
+            sync_with_master()
+        except (OSError, ValueError, ProtocolError, rdb.RdbError) as e:
+            print(f"Link with master {master_host}:{master_port} lost: {e}")
+        master_link_status = "down"
+        time.sleep(1)
+
+
+class Client:
+    """Per-connection state shared by the threaded and the asyncio server.
+
+    Replies are appended to an output buffer with send() and written out with
+    flush() once per read cycle, so a pipeline of N commands costs one write
+    instead of N."""
+    def __init__(self, address):
+        self.address = address
+        self.in_multi = False
+        self.queued_commands = []
+        self.multi_error = False  # a command was refused while queuing, EXEC will abort
+        self.reply = []
+        self.reply_bytes = 0
+        self.soft_limit_since = None  # when the buffer first went over the soft limit
+        self.close_asap = False
+        # Set once the client sent PSYNC: the connection then carries the
+        # replication stream, see start_replication()
+        self.is_replica = False
+        self.replica_listening_port = None
+        self.repl_capa_eof = False  # can take a diskless (EOF-marked) snapshot
+        self.repl_state = None      # wait_bgsave, send_bulk, wait_ack or online
+        self.repl_held = []         # stream held back while its snapshot is sent
+        self.repl_ack_offset = 0    # last offset the replica reported with REPLCONF ACK
+        self.repl_ack_time = None   # time.monotonic() of that report
+        # master_repl_offset after this client's last write, what WAIT waits for
+        self.woff = 0
+        self.peer_links = {}     # worker id -> PeerLink, in worker mode
+        self.asking = False      # cluster mode: sent ASKING, may use an importing slot
+        self.forwarded = False   # the reply buffer holds ForwardedReply placeholders
+
+    def send(self, data):
+        if self.close_asap:
+            return
+        self.reply.append(data)
+        self.reply_bytes += len(data)
+        self.check_output_buffer_limits()
+
+    def pending_bytes(self):
+        return self.reply_bytes
+
+    def check_output_buffer_limits(self):
+        if self.is_replica:
+            # Replicas have replica_output_buffer_limit instead, see feed_replica
+            return
+        hard, soft, soft_seconds = client_output_buffer_limit
+        pending = self.pending_bytes()
+        if soft and pending > soft:
+            if self.soft_limit_since is None:
+                self.soft_limit_since = time.monotonic()
+                soft_exceeded = False
+            else:
+                soft_exceeded = time.monotonic() - self.soft_limit_since >= soft_seconds
+        else:
+            self.soft_limit_since = None
+            soft_exceeded = False
+        if (hard and pending > hard) or soft_exceeded:
+            print(f"Client {self.address} scheduled to be closed for overcoming of output buffer limits ({pending} bytes)")
+            self.close_asap = True
+            self.reply.clear()
+            self.reply_bytes = 0
+
+    def flush(self):
+        raise NotImplementedError
+
+    def forward(self, shard, commands):
+        """Have worker `shard` run commands (worker mode). The reply to the last
+        one is relayed in this command's place among the client's replies."""
+        link = self.peer_links.get(shard)
+        if link is None:
+            try:
+                link = workers.PeerLink(shard, workers.peer_path(worker_socket_dir, shard),
+                                        blocking=self.BLOCKING_PEER_LINKS)
+            except OSError as e:
+                print(f"Error connecting to worker {shard}: {e}")
+                self.send(f"-ERR worker {shard} is unavailable\r\n".encode())
+                return
+            self.peer_links[shard] = link
+        link.send(b''.join(aof.encode_command(parts) for parts in commands))
+        self.reply.append(workers.ForwardedReply(link, len(commands) - 1))
+        self.forwarded = True
+
+    def _forwarded_reply_failed(self, link, error):
+        if self.peer_links.get(link.worker_id) is link:
+            print(f"Link to worker {link.worker_id} lost: {error}")
+            del self.peer_links[link.worker_id]
+            link.close()
+        return f"-ERR worker {link.worker_id} is unavailable\r\n".encode()
+
+    def _set_forwarded_reply(self, i, data):
+        self.reply[i] = data
+        self.reply_bytes += len(data)
+
+    def close_peer_links(self):
+        for link in self.peer_links.values():
+            link.close()
+        self.peer_links.clear()
+
+    def start_replication(self):
+        """Send everything from now on through feed_replica(), in order"""
+        raise NotImplementedError
+
+    def feed_replica(self, data):
+        raise NotImplementedError
+
+    def pending_replica_bytes(self):
+        raise NotImplementedError
+
+    def disconnect_replica(self):
+        raise NotImplementedError
+
+    def stop_replication(self):
+        pass
+
+
+class ThreadedClient(Client):
+    BLOCKING_PEER_LINKS = True
+
+    def __init__(self, connection, address):
+        super().__init__(address)
+        self.connection = connection
+
+    def resolve_forwarded(self):
+        """Send what was forwarded to other workers and wait for the replies"""
+        self.forwarded = False
+        for link in list(self.peer_links.values()):
+            try:
+                link.flush()
+            except OSError as e:
+                self._forwarded_reply_failed(link, e)
+        for i, item in enumerate(self.reply):
+            if isinstance(item, workers.ForwardedReply):
+                try:
+                    data = item.link.read_reply(item.skip)
+                except OSError as e:
+                    data = self._forwarded_reply_failed(item.link, e)
+                self._set_forwarded_reply(i, data)
+
+    def flush(self):
+        if self.forwarded:
+            self.resolve_forwarded()
+        reply = self.reply
+        if len(reply) == 1:
+            self.connection.sendall(reply[0])
+            reply.clear()
+        # One vectored write per batch of buffers; sendmsg may stop part way
+        # through, in which case the rest goes out on the next round
+        while reply:
+            batch = reply[:MAX_IOV]
+            sent = self.connection.sendmsg(batch)
+            done = 0
+            while done < len(batch) and sent >= len(batch[done]):
+                sent -= len(batch[done])
+                done += 1
+            del reply[:done]
+            if sent:
+                reply[0] = memoryview(reply[0])[sent:]
+        self.reply_bytes = 0
+        self.soft_limit_since = None
+
+    def start_replication(self):
+        # The stream is written by a thread of its own, so a slow replica never
+        # holds up the thread that propagates (with store_lock held)
+        self.is_replica = True
+        self.replica_buffer = bytearray(b''.join(self.reply))
+        self.reply.clear()
+        self.reply_bytes = 0
+        self.replica_cond = threading.Condition()
+        threading.Thread(target=self._write_replication_stream, daemon=True).start()
+
+    def feed_replica(self, data):
+        with self.replica_cond:
+            if self.close_asap:
+                return
+            self.replica_buffer += data
+            if len(self.replica_buffer) > replica_output_buffer_limit:
+                print(f"Replica {self.address} scheduled to be closed for overcoming of output buffer limits")
+                self._close_replica()
+            self.replica_cond.notify()
+
+    def pending_replica_bytes(self):
+        return len(self.replica_buffer)
+
+    def disconnect_replica(self):
+        with self.replica_cond:
+            self._close_replica()
+            self.replica_cond.notify()
+
+    def _close_replica(self):
+        # Called with replica_cond held; shutdown wakes up handle_client's recv
+        self.close_asap = True
+        self.replica_buffer.clear()
+        try:
+            self.connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _write_replication_stream(self):
+        while True:
+            with self.replica_cond:
+                while not self.replica_buffer and not self.close_asap:
+                    self.replica_cond.wait()
+                if self.close_asap:
+                    return
+                data = bytes(self.replica_buffer)
+                self.replica_buffer.clear()
+            try:
+                self.connection.sendall(data)
+            except OSError:
+                with self.replica_cond:
+                    self._close_replica()
+                return
+
+    def stop_replication(self):
+        with self.replica_cond:
+            self.close_asap = True
+            self.replica_cond.notify()
+
+
+class AsyncioClient(Client):
+    BLOCKING_PEER_LINKS = False
+
+    def __init__(self, writer, address):
+        super().__init__(address)
+        self.writer = writer
+        self.loop = asyncio.get_running_loop()
+
+    async def resolve_forwarded(self):
+        """Like ThreadedClient.resolve_forwarded, without blocking the loop:
+        only this client waits for the other workers"""
+        self.forwarded = False
+        for link in list(self.peer_links.values()):
+            try:
+                await link.flush_async(self.loop)
+            except OSError as e:
+                self._forwarded_reply_failed(link, e)
+        for i, item in enumerate(self.reply):
+            if isinstance(item, workers.ForwardedReply):
+                try:
+                    data = await item.link.read_reply_async(self.loop, item.skip)
+                except OSError as e:
+                    data = self._forwarded_reply_failed(item.link, e)
+                self._set_forwarded_reply(i, data)
+
+    def pending_bytes(self):
+        # Whatever the transport hasn't managed to write yet counts too
+        return self.reply_bytes + self.writer.transport.get_write_buffer_size()
+
+    def flush(self):
+        if self.reply:
+            self.writer.writelines(self.reply)
+            self.reply.clear()
+            self.reply_bytes = 0
+        self.check_output_buffer_limits()
+
+    def start_replication(self):
+        self.is_replica = True
+        self.flush()
+
+    def _in_loop(self):
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+    def feed_replica(self, data):
+        # The transport buffers whatever the socket won't take right away.
+        # Diskless transfers feed from their own thread, which has to go
+        # through the loop; call_soon_threadsafe keeps the order.
+        if not self._in_loop():
+            self.loop.call_soon_threadsafe(self.feed_replica, data)
+            return
+        if self.close_asap:
+            return
+        self.writer.write(data)
+        if self.writer.transport.get_write_buffer_size() > replica_output_buffer_limit:
+            print(f"Replica {self.address} scheduled to be closed for overcoming of output buffer limits")
+            self.disconnect_replica()
+
+    def pending_replica_bytes(self):
+        return self.writer.transport.get_write_buffer_size()
+
+    def disconnect_replica(self):
+        if not self._in_loop():
+            self.loop.call_soon_threadsafe(self.disconnect_replica)
+            return
+        self.close_asap = True
+        self.writer.transport.abort()
+
+    def stop_replication(self):
+        self.close_asap = True
+
+
+class BlockedCommand:
+    """Returned by a command that can't be answered yet (BLPOP, XREAD BLOCK, WAIT).
+
+    The server parks the client on all of `keys` at once. After a command
+    writes to one of them, `retry()` is called for the clients parked there,
+    in the order they blocked, and returns the reply or None to keep waiting.
+    `timeout` is in seconds, None means wait forever. `timeout_reply` is the
+    reply sent when it passes, or a function that returns it."""
+    def __init__(self, keys, timeout, retry, timeout_reply):
+        self.keys = keys
+        self.timeout = timeout
+        self.retry = retry
+        self.timeout_reply = timeout_reply
+
+    def timed_out(self):
+        if callable(self.timeout_reply):
+            with store_lock:
+                return self.timeout_reply()
+        return self.timeout_reply
+
+
+class Waiter:
+    """A client parked on the keys of a BlockedCommand. It is answered by
+    serve_blocked_clients, which sets `reply` and then wakes it."""
+    def __init__(self, client, blocked):
+        self.client = client
+        self.blocked = blocked
+        self.reply = None
+
+
+class ThreadWaiter(Waiter):
+    def __init__(self, client, blocked):
+        super().__init__(client, blocked)
+        self.event = threading.Event()
+
+    def wake(self):
+        self.event.set()
+
+
+class AsyncioWaiter(Waiter):
+    def __init__(self, client, blocked, loop):
+        super().__init__(client, blocked)
+        self.loop = loop
+        self.event = asyncio.Event()
+
+    def wake(self):
+        self.loop.call_soon_threadsafe(self.event.set)
+
+
+def register_waiter(waiter):
+    global blocked_clients
+    blocked_clients += 1
+    for key in waiter.blocked.keys:
+        key_waiters[key][waiter] = None
+
+def unregister_waiter(waiter):
+    global blocked_clients
+    blocked_clients -= 1
+    for key in waiter.blocked.keys:
+        waiters = key_waiters.get(key)
+        if waiters is None:
+            continue
+        waiters.pop(waiter, None)
+        if not waiters:
+            del key_waiters[key]
+
+def signal_key_ready(key):
+    # Called (under store_lock) by commands that add data to a key; the
+    # clients waiting on it are served once the command is done
+    if key in key_waiters:
+        ready_keys[key] = None
+
+def serve_blocked_clients():
+    """Answer the clients parked on the keys the last command wrote to.
+
+    Runs under store_lock right after the write, so nothing else gets in
+    between. Each key's clients are tried in the order they blocked, and
+    once a key that held data is gone (its list popped empty) the rest of
+    its queue isn't even looked at. Only the clients answered are woken."""
+    served = []
+    while ready_keys:
+        key = next(iter(ready_keys))
+        del ready_keys[key]
+        waiters = key_waiters.get(key)
+        if not waiters:
+            continue
+        had_data = key in data_store
+        answered = []
+        for waiter in waiters:
+            if had_data and key not in data_store:
+                break
+            reply = waiter.blocked.retry()
+            if reply is not None:
+                waiter.reply = reply
+                answered.append(waiter)
+        for waiter in answered:
+            unregister_waiter(waiter)
+            after_write(waiter.blocked.keys)
+        served += answered
+    if propagate_pending():
+        for waiter in served:
+            waiter.client.woff = master_repl_offset
+    for waiter in served:
+        waiter.wake()
+
+def command_keys(command_parts):
+    command = COMMAND_TABLE.get(command_parts[0].upper())
+    return [] if command is None else command.keys(command_parts)
+
+def cluster_redirect(commands, asking):
+    """Cluster mode: the error reply sending a client elsewhere for the keys
+    of commands, or None if this node serves them.
+
+    -MOVED when another node owns the slot. While the slot migrates away,
+    keys already gone are at the target: -ASK, valid for the next command.
+    The target serves them only to clients that sent ASKING."""
+    slot = None
+    keys = []
+    for parts in commands:
+        for key in command_keys(parts):
+            key_slot = cluster.key_hash_slot(key)
+            if slot is None:
+                slot = key_slot
+            elif key_slot != slot:
+                return b"-CROSSSLOT Keys in request don't hash to the same slot\r\n"
+            keys.append(key)
+    if slot is None:
+        return None
+    if not cluster_state.is_ok():
+        return b"-CLUSTERDOWN The cluster is down\r\n"
+    owner = cluster_state.slots[slot]
+    migrating_to = cluster_state.migrating.get(slot) if owner is cluster_state.myself else None
+    importing = slot in cluster_state.importing
+    cmd = commands[0][0].upper()
+    if (migrating_to is not None or importing) and cmd == b'MIGRATE':
+        return None
+    missing = sum(1 for key in keys if key not in data_store) if migrating_to is not None or importing else 0
+    if migrating_to is not None and missing:
+        if missing < len(keys):
+            return b"-TRYAGAIN Multiple keys request during rehashing of slot\r\n"
+        return f"-ASK {slot} {migrating_to.address}\r\n".encode()
+    if importing and (asking or cmd == b'RESTORE-ASKING'):
+        if len(keys) > 1 and missing:
+            return b"-TRYAGAIN Multiple keys request during rehashing of slot\r\n"
+        return None
+    if owner is None:
+        return b"-CLUSTERDOWN Hash slot not served\r\n"
+    if owner is not cluster_state.myself:
+        return f"-MOVED {slot} {owner.address}\r\n".encode()
+    return None
+
+CROSS_SHARD = -1
+
+def commands_shard(commands):
+    """Worker owning every key of commands: None if they take no keys,
+    CROSS_SHARD if the keys belong to more than one worker"""
+    shard = None
+    for parts in commands:
+        for key in command_keys(parts):
+            owner = workers.key_worker(key, worker_count)
+            if shard is None:
+                shard = owner
+            elif owner != shard:
+                return CROSS_SHARD
+    return shard
+
+
+def process_command(client, command_parts):
+    """Run one parsed command for client, replies go out through client.send.
+
+    Returns a BlockedCommand if the client has to wait for data, None otherwise.
+    Must be called with store_lock held."""
+    command = COMMAND_TABLE.get(command_parts[0].upper())
+    asking = client.asking
+    if not client.in_multi:
+        # ASKING is good for one command, or for a whole transaction
+        client.asking = False
+
+    if command is None:
+        reject_command(client, unknown_command(command_parts))
+        return
+    if not command.check_arity(len(command_parts)):
+        reject_command(client, wrong_number_of_arguments(command_parts), command)
+        return
+    if server_role == "slave" and 'write' in command.flags:
+        # Writes only come from the master's stream, or replicas would diverge
+        reject_command(client, b"-READONLY You can't write against a read only replica.\r\n", command)
+        return
+
+    if client.in_multi and 'no-queue' not in command.flags:
+        if 'no-multi' in command.flags:
+            reject_command(client, b'-ERR Command not allowed inside a transaction\r\n', command)
+            return
+        client.queued_commands.append(command_parts)
+        client.send(b'+QUEUED\r\n')
+        return
+
+    if worker_count > 1:
+        shard = commands_shard([command_parts])
+        if shard is not None and shard != worker_id:
+            if shard == CROSS_SHARD:
+                reject_command(client, b"-CROSSSLOT Keys in request don't hash to the same worker\r\n", command)
+            else:
+                client.forward(shard, [command_parts])
+            return
+    if cluster_enabled:
+        error = cluster_redirect([command_parts], asking)
+        if error is not None:
+            command.rejected_calls += 1
+            client.send(error)
+            return
+
+    error = before_command(command, command_parts)
+    if error is not None:
+        propagate_pending()
+        command.rejected_calls += 1
+        client.send(error.encode())
+        return
+    blocked = call_command(client, command, command_parts)
+    if propagate_pending():
+        client.woff = master_repl_offset
+    if ready_keys:
+        serve_blocked_clients()
+    return blocked
+
+def call_command(client, command, command_parts):
+    """Run a command that passed the checks, then do what its flags call for.
+
+    Its run time, not counting the wait of a blocking command, goes into
+    the command's statistics and maybe into the slow log."""
+    global dirty
+    reply = client.reply
+    replies = len(reply)
+    start = time.perf_counter_ns()
+    blocked = command.handler(client, command_parts)
+    usec = (time.perf_counter_ns() - start) // 1000
+    command.calls += 1
+    command.usec += usec
+    command.latency[usec.bit_length()] += 1
+    # An error is the only reply of a command that fails
+    if len(reply) > replies and type(reply[replies]) is bytes and reply[replies][:1] == b'-':
+        command.failed_calls += 1
+    if 0 <= slowlog_log_slower_than <= usec and 'skip-slowlog' not in command.flags:
+        slowlog_add(client, command_parts, usec)
+    if 'write' in command.flags:
+        after_write(command_parts[1:])
+        dirty += 1
+    return blocked
+
+def slowlog_add(client, command_parts, usec):
+    global slowlog_next_id
+    args = command_parts
+    if len(args) > SLOWLOG_ENTRY_MAX_ARGC:
+        args = args[:SLOWLOG_ENTRY_MAX_ARGC - 1] + [
+            b'... (%d more arguments)' % (len(args) - SLOWLOG_ENTRY_MAX_ARGC + 1)]
+    args = [arg if len(arg) <= SLOWLOG_ENTRY_MAX_STRING else
+            arg[:SLOWLOG_ENTRY_MAX_STRING] + b'... (%d more bytes)' % (len(arg) - SLOWLOG_ENTRY_MAX_STRING)
+            for arg in args]
+    address = client.address
+    if isinstance(address, tuple):
+        address = f"{address[0]}:{address[1]}"
+    slowlog.append([slowlog_next_id, int(time.time()), usec, args, address])
+    slowlog_next_id += 1
+    while len(slowlog) > slowlog_max_len:
+        slowlog.popleft()
+
+def reject_command(client, error, command=None):
+    if command is not None:
+        command.rejected_calls += 1
+    # Inside MULTI a refused command also dooms the transaction
+    if client.in_multi:
+        client.multi_error = True
+    client.send(error)
+
+def multi_command(client, command_parts):
+    if client.in_multi:
+        client.send(b'-ERR MULTI calls can not be nested\r\n')
+        return
+    client.in_multi = True
+    client.send(b'+OK\r\n')
+
+def discard_command(client, command_parts):
+    if not client.in_multi:
+        client.send(b'-ERR DISCARD without MULTI\r\n')
+        return
+    client.in_multi = False
+    client.queued_commands = []
+    client.multi_error = False
+    client.asking = False
+    client.send(b'+OK\r\n')
+
+def exec_command(client, command_parts):
+    """Run the queued commands through the same table as any other command.
+
+    The reply is an array with an element per command, so each command's
+    reply goes out as it runs. Nothing else runs in between (store_lock is
+    held), so a blocking command can't be woken: it times out at once."""
+    if not client.in_multi:
+        client.send(b'-ERR EXEC without MULTI\r\n')
+        return
+    commands, aborted, asking = client.queued_commands, client.multi_error, client.asking
+    client.in_multi = False
+    client.queued_commands = []
+    client.multi_error = False
+    client.asking = False
+    if aborted:
+        client.send(b'-EXECABORT Transaction discarded because of previous errors.\r\n')
+        return
+    if worker_count > 1:
+        # The transaction runs whole on the worker owning its keys
+        shard = commands_shard(commands)
+        if shard is not None and shard != worker_id:
+            if shard == CROSS_SHARD:
+                client.send(b"-CROSSSLOT Keys in request don't hash to the same worker\r\n")
+            else:
+                client.forward(shard, [[b'MULTI']] + commands + [[b'EXEC']])
+            return
+    if cluster_enabled:
+        error = cluster_redirect(commands, asking)
+        if error is not None:
+            client.send(error)
+            return
+
+    client.send(b'*%d\r\n' % len(commands))
+    for parts in commands:
+        command = COMMAND_TABLE[parts[0].upper()]
+        error = before_command(command, parts)
+        if error is not None:
+            command.rejected_calls += 1
+            client.send(error.encode())
+            continue
+        blocked = call_command(client, command, parts)
+        if blocked is not None:
+            client.send(blocked.timed_out())
+
+
+def cluster_config_path():
+    return os.path.join(rdb_dir, cluster_config_file)
+
+def cluster_save_config():
+    try:
+        cluster_state.save(cluster_config_path())
+    except OSError as e:
+        print(f"Error saving the cluster config file: {e}")
+
+def parse_slot(arg):
+    slot = int(arg)
+    if not 0 <= slot < cluster.HASH_SLOTS:
+        raise ValueError
+    return slot
+
+def cluster_command(client, command_parts):
+    """CLUSTER <subcommand> ..."""
+    if not cluster_enabled:
+        client.send(b'-ERR This instance has cluster support disabled\r\n')
+        return
+    # Node IDs, addresses and slot numbers: text, unlike keys
+    sub = command_parts[1].decode(errors='replace').upper()
+    args = [arg.decode(errors='replace') for arg in command_parts[2:]]
+    myself = cluster_state.myself
+
+    if sub == 'MYID' and not args:
+        client.send(encode_resp(myself.node_id))
+
+    elif sub == 'INFO' and not args:
+        assigned = cluster_state.slots_assigned()
+        serving = {node for node in cluster_state.slots if node is not None}
+        info = (f"cluster_state:{'ok' if cluster_state.is_ok() else 'fail'}\r\n"
+                f"cluster_slots_assigned:{assigned}\r\ncluster_slots_ok:{assigned}\r\n"
+                f"cluster_slots_pfail:0\r\ncluster_slots_fail:0\r\n"
+                f"cluster_known_nodes:{len(cluster_state.nodes)}\r\ncluster_size:{len(serving)}\r\n"
+                f"cluster_current_epoch:{cluster_state.current_epoch}\r\n"
+                f"cluster_my_epoch:{myself.config_epoch}\r\n")
+        client.send(encode_resp(info))
+
+    elif sub == 'NODES' and not args:
+        client.send(encode_resp(cluster_state.describe()))
+
+    elif sub in ('SLOTS', 'SHARDS') and not args:
+        owners = {}
+        for node in cluster_state.slots:
+            if node is not None:
+                owners.setdefault(node, None)
+        reply = []
+        for node in owners:
+            ranges = cluster.format_slot_ranges(cluster_state.node_slots(node))
+            if sub == 'SLOTS':
+                reply += [[first, last, [node.host, node.port, node.node_id]] for first, last in ranges]
+            else:
+                reply.append(['slots', [n for r in ranges for n in r],
+                              'nodes', [['id', node.node_id, 'port', node.port, 'ip', node.host,
+                                         'endpoint', node.host, 'role', 'master', 'replication-offset', 0,
+                                         'health', 'online' if node.link_connected else 'fail']]])
+        client.send(encode_resp(reply))
+
+    elif sub == 'KEYSLOT' and len(args) == 1:
+        client.send(b':%d\r\n' % cluster.key_hash_slot(command_parts[2]))
+
+    elif sub in ('COUNTKEYSINSLOT', 'GETKEYSINSLOT') and len(args) == (1 if sub == 'COUNTKEYSINSLOT' else 2):
+        try:
+            slot = parse_slot(args[0])
+            count = int(args[1]) if len(args) > 1 else 0
+            if count < 0:
+                raise ValueError
+        except ValueError:
+            client.send(b'-ERR Invalid slot or number of keys\r\n')
+            return
+        keys = slot_keys.get(slot, ())
+        if sub == 'COUNTKEYSINSLOT':
+            client.send(b':%d\r\n' % len(keys))
+        else:
+            client.send(encode_resp([key for key, _ in zip(keys, range(count))]))
+
+    elif sub == 'MEET' and len(args) >= 2:
+        try:
+            port = int(args[1])
+        except ValueError:
+            client.send(b'-ERR Invalid node address specified\r\n')
+            return
+        # Polled from the cluster thread, which learns its ID then
+        cluster_state.meet(args[0], port)
+        cluster_save_config()
+        client.send(b'+OK\r\n')
+
+    elif sub == 'FORGET' and len(args) == 1:
+        node = cluster_state.nodes.get(args[0])
+        if node is None:
+            client.send(f"-ERR Unknown node {args[0]}\r\n".encode())
+        elif node is myself:
+            client.send(b"-ERR I tried hard but I can't forget myself...\r\n")
+        else:
+            cluster_state.forget(node)
+            cluster_save_config()
+            client.send(b'+OK\r\n')
+
+    elif sub in ('ADDSLOTS', 'DELSLOTS', 'ADDSLOTSRANGE', 'DELSLOTSRANGE') and args:
+        try:
+            if sub.endswith('RANGE'):
+                if len(args) % 2:
+                    raise ValueError
+                slots = []
+                for i in range(0, len(args), 2):
+                    first, last = parse_slot(args[i]), parse_slot(args[i + 1])
+                    slots.extend(range(first, last + 1))
+            else:
+                slots = [parse_slot(arg) for arg in args]
+        except ValueError:
+            client.send(b'-ERR Invalid or out of range slot\r\n')
+            return
+        adding = sub.startswith('ADD')
+        for slot in slots:
+            if adding and cluster_state.slots[slot] is not None:
+                client.send(f"-ERR Slot {slot} is already busy\r\n".encode())
+                return
+            if not adding and cluster_state.slots[slot] is None:
+                client.send(f"-ERR Slot {slot} is already unassigned\r\n".encode())
+                return
+        for slot in slots:
+            cluster_state.slots[slot] = myself if adding else None
+            if not adding:
+                cluster_state.migrating.pop(slot, None)
+                cluster_state.importing.pop(slot, None)
+        cluster_save_config()
+        client.send(b'+OK\r\n')
+
+    elif sub == 'SETSLOT' and len(args) >= 2:
+        try:
+            slot = parse_slot(args[0])
+        except ValueError:
+            client.send(b'-ERR Invalid or out of range slot\r\n')
+            return
+        action = args[1].upper()
+        node = cluster_state.nodes.get(args[2]) if len(args) == 3 else None
+        if action in ('MIGRATING', 'IMPORTING', 'NODE') and node is None:
+            client.send(f"-ERR I don't know about node {args[2] if len(args) > 2 else ''}\r\n".encode())
+            return
+        owner = cluster_state.slots[slot]
+        if action == 'MIGRATING':
+            if owner is not myself:
+                client.send(f"-ERR I'm not the owner of hash slot {slot}\r\n".encode())
+                return
+            if node is myself:
+                client.send(b"-ERR I'm already the owner of this slot\r\n")
+                return
+            cluster_state.migrating[slot] = node
+        elif action == 'IMPORTING':
+            if owner is myself:
+                client.send(f"-ERR I'm already the owner of hash slot {slot}\r\n".encode())
+                return
+            cluster_state.importing[slot] = node
+        elif action == 'STABLE':
+            cluster_state.migrating.pop(slot, None)
+            cluster_state.importing.pop(slot, None)
+        elif action == 'NODE':
+            if owner is myself and node is not myself and slot_keys.get(slot):
+                client.send(f"-ERR Can't assign hashslot {slot} to a different node while I still hold keys for this hash slot.\r\n".encode())
+                return
+            cluster_state.migrating.pop(slot, None)
+            if node is myself and cluster_state.importing.pop(slot, None) is not None:
+                # Claim the slot with a newer epoch, so every node takes our word over the old owner's
+                cluster_state.bump_epoch()
+            cluster_state.slots[slot] = node
+        else:
+            client.send(b'-ERR Invalid CLUSTER SETSLOT action or number of arguments\r\n')
+            return
+        cluster_save_config()
+        client.send(b'+OK\r\n')
+
+    elif sub == 'SAVECONFIG' and not args:
+        cluster_save_config()
+        client.send(b'+OK\r\n')
+
+    else:
+        client.send(unknown_subcommand(command_parts))
+
+def migrate_command(client, command_parts):
+    """MIGRATE host port key|"" destination-db timeout [COPY] [REPLACE] [KEYS key ...]
+
+    Sends the keys to the target as RESTORE commands (RESTORE-ASKING in
+    cluster mode, so a node importing the slot takes them) and deletes them
+    here once the target has them. Blocks the server for the round trip."""
+    host = command_parts[1].decode(errors='replace')
+    try:
+        port = int(command_parts[2])
+        db = int(command_parts[4])
+        timeout = int(command_parts[5])
+    except ValueError:
+        client.send(b'-ERR value is not an integer or out of range\r\n')
+        return
+    copy = replace = False
+    keys = [command_parts[3]] if command_parts[3] else []
+    i = 6
+    while i < len(command_parts):
+        option = command_parts[i].upper()
+        if option == b'COPY':
+            copy = True
+        elif option == b'REPLACE':
+            replace = True
+        elif option == b'KEYS' and not keys:
+            keys = command_parts[i + 1:]
+            break
+        else:
+            client.send(b'-ERR syntax error\r\n')
+            return
+        i += 1
+    if db != 0:
+        client.send(b'-ERR only database 0 is supported\r\n')
+        return
+    keys = [key for key in keys if key in data_store and not expire_if_needed(key)]
+    if not keys:
+        client.send(b'+NOKEY\r\n')
+        return
+    now_ms = int(time.time() * 1000)
+    restore = b'RESTORE-ASKING' if cluster_enabled else b'RESTORE'
+    requests = []
+    for key in keys:
+        ttl = max(expiry_store[key] - now_ms, 1) if key in expiry_store else 0
+        parts = [restore, key, b'%d' % ttl, rdb.dump_value(data_store[key])]
+        if replace:
+            parts.append(b'REPLACE')
+        requests.append(aof.encode_command(parts))
+    try:
+        with socket.create_connection((host, port), timeout=(timeout if timeout > 0 else 1000) / 1000) as sock:
+            sock.sendall(b''.join(requests))
+            reader = sock.makefile('rb')
+            replies = [reader.readline() for _ in keys]
+    except OSError as e:
+        client.send(f"-IOERR error or timeout talking to target instance: {e}\r\n".encode())
+        return
+    error = None
+    for key, reply in zip(keys, replies):
+        if not reply.startswith(b'+'):
+            error = error or reply[1:].strip().decode(errors='replace') or "connection closed"
+        elif not copy:
+            delete_key(key)
+            propagate([b'DEL', key])
+    if error is not None:
+        client.send(f"-ERR Target instance replied with error: {error}\r\n".encode())
+    else:
+        client.send(b'+OK\r\n')
+
+def set_command(client, command_parts):
+    key, value = command_parts[1], command_parts[2]
+    expiry = None
+    if len(command_parts) >= 5 and command_parts[3].upper() == b'PX':
+        try:
+            px = int(command_parts[4])
+            expiry = int(time.time() * 1000) + px
+        except (ValueError, IndexError):
+            client.send(b'-ERR invalid PX value\r\n')
+            return
+
+    data_store[key] = strings.encode(value)
+    propagate([b'SET', key, value])
+    if expiry is not None:
+        set_expiry(key, expiry)
+        propagate([b'PEXPIREAT', key, b'%d' % expiry])
+    elif key in expiry_store:
+        del expiry_store[key]
+    client.send(b'+OK\r\n')
+
+def incr_command(client, command_parts):
+    """INCR key | DECR key | INCRBY key increment | DECRBY key decrement"""
+    cmd = command_parts[0].upper()
+    if len(command_parts) == 3:
+        delta = strings.parse_int(command_parts[2])
+        if delta is None:
+            client.send(b'-ERR value is not an integer or out of range\r\n')
+            return
+        if cmd == b'DECRBY':
+            if delta == strings.LLONG_MIN:
+                client.send(b'-ERR decrement would overflow\r\n')
+                return
+            delta = -delta
+    else:
+        delta = -1 if cmd == b'DECR' else 1
+
+    key = command_parts[1]
+    value = data_store.get(key, 0)
+    # Counters are stored as ints, so this is an int add with no parse or format
+    n = value if type(value) is int else None
+    if n is None:
+        if not strings.is_string(value):
+            client.send(WRONGTYPE_ERROR)
+            return
+        n = strings.parse_int(value)
+        if n is None:
+            client.send(b'-ERR value is not an integer or out of range\r\n')
+            return
+    n += delta
+    if not strings.LLONG_MIN <= n <= strings.LLONG_MAX:
+        client.send(b'-ERR increment or decrement would overflow\r\n')
+        return
+    data_store[key] = strings.shared(n)
+    propagate(command_parts)
+    client.send(b':%d\r\n' % n)
+
+def incrbyfloat_command(client, command_parts):
+    key = command_parts[1]
+    increment = strings.parse_float(command_parts[2])
+    if increment is None:
+        client.send(b'-ERR value is not a valid float\r\n')
+        return
+    value = data_store.get(key, 0)
+    if not strings.is_string(value):
+        client.send(WRONGTYPE_ERROR)
+        return
+    n = value if type(value) is int else strings.parse_float(value)
+    if n is None:
+        client.send(b'-ERR value is not a valid float\r\n')
+        return
+    n += increment
+    if math.isinf(n) or math.isnan(n):
+        client.send(b'-ERR increment would produce NaN or Infinity\r\n')
+        return
+    result = strings.format_float(n)
+    data_store[key] = strings.encode(result)
+    # Replayed as the value it produced, so float rounding can't make copies differ
+    propagate([b'SET', key, result])
+    if key in expiry_store:
+        propagate([b'PEXPIREAT', key, b'%d' % expiry_store[key]])
+    client.send(to_bulk_string(result))
+
+def append_command(client, command_parts):
+    key, data = command_parts[1], command_parts[2]
+    value = data_store.get(key)
+    if value is None:
+        data_store[key] = strings.encode(data)
+        length = len(data)
+    elif not strings.is_string(value):
+        client.send(WRONGTYPE_ERROR)
+        return
+    else:
+        length = strings.length(value) + len(data)
+        if length > strings.MAX_STRING_LENGTH:
+            client.send(b'-ERR string exceeds maximum allowed size (proto-max-bulk-len)\r\n')
+            return
+        if type(value) is not bytearray:
+            value = data_store[key] = bytearray(strings.to_bytes(value))
+        value += data
+    propagate(command_parts)
+    client.send(b':%d\r\n' % length)
+
+def getrange_command(client, command_parts):
+    """GETRANGE key start end, both inclusive and counting back from the end if negative"""
+    key = command_parts[1]
+    start, end = strings.parse_int(command_parts[2]), strings.parse_int(command_parts[3])
+    if start is None or end is None:
+        client.send(b'-ERR value is not an integer or out of range\r\n')
+        return
+    value = data_store.get(key, b'')
+    if not strings.is_string(value):
+        client.send(WRONGTYPE_ERROR)
+        return
+    value = strings.to_bytes(value)
+    size = len(value)
+    if start < 0 and end < 0 and start > end:
+        client.send(b'$0\r\n\r\n')
+        return
+    start = max(start + size if start < 0 else start, 0)
+    end = min(end + size if end < 0 else end, size - 1)
+    client.send(to_bulk_string(value[start:end + 1] if start <= end else b''))
+
+def setrange_command(client, command_parts):
+    key, data = command_parts[1], command_parts[3]
+    offset = strings.parse_int(command_parts[2])
+    if offset is None or offset < 0:
+        client.send(b'-ERR offset is out of range\r\n')
+        return
+    value = data_store.get(key)
+    if value is not None and not strings.is_string(value):
+        client.send(WRONGTYPE_ERROR)
+        return
+    if not data:
+        # Nothing to write: the length as it is, and no key gets created
+        client.send(b':%d\r\n' % (strings.length(value) if value is not None else 0))
+        return
+    if offset + len(data) > strings.MAX_STRING_LENGTH:
+        client.send(b'-ERR string exceeds maximum allowed size (proto-max-bulk-len)\r\n')
+        return
+    if type(value) is not bytearray:
+        value = data_store[key] = bytearray(strings.to_bytes(value) if value is not None else b'')
+    if offset > len(value):
+        value += bytes(offset - len(value))
+    value[offset:offset + len(data)] = data
+    propagate(command_parts)
+    client.send(b':%d\r\n' % len(value))
+
+def strlen_command(client, command_parts):
+    value = data_store.get(command_parts[1], b'')
+    if not strings.is_string(value):
+        client.send(WRONGTYPE_ERROR)
+        return
+    client.send(b':%d\r\n' % strings.length(value))
+
+def info_command(client, command_parts):
+    section = command_parts[1].decode(errors='replace').lower() if len(command_parts) > 1 else None
+    client.send(info_response(section))
+
+def expire_command(client, command_parts):
+    cmd = command_parts[0].upper()
+    key = command_parts[1]
+    try:
+        amount = int(command_parts[2])
+    except ValueError:
+        client.send(b'-ERR value is not an integer or out of range\r\n')
+        return
+    if key not in data_store:
+        client.send(b':0\r\n')
+        return
+    if cmd == b'EXPIRE':
+        when = int(time.time() * 1000) + amount * 1000
+    elif cmd == b'PEXPIRE':
+        when = int(time.time() * 1000) + amount
+    elif cmd == b'EXPIREAT':
+        when = amount * 1000
+    else:
+        when = amount
+    if when <= int(time.time() * 1000):
+        # A deadline in the past deletes the key right away
+        delete_expired_key(key)
+    else:
+        set_expiry(key, when)
+        propagate([b'PEXPIREAT', key, b'%d' % when])
+    client.send(b':1\r\n')
+
+def ttl_command(client, command_parts):
+    cmd = command_parts[0].upper()
+    key = command_parts[1]
+    if key not in data_store:
+        client.send(b':-2\r\n')
+    elif key not in expiry_store:
+        client.send(b':-1\r\n')
+    else:
+        remaining = max(expiry_store[key] - int(time.time() * 1000), 0)
+        if cmd == b'TTL':
+            remaining = (remaining + 500) // 1000
+        client.send(b':%d\r\n' % remaining)
+
+def persist_command(client, command_parts):
+    key = command_parts[1]
+    if key in data_store and expiry_store.pop(key, None) is not None:
+        propagate(command_parts)
+        client.send(b':1\r\n')
+    else:
+        client.send(b':0\r\n')
+
+def del_command(client, command_parts):
+    """DEL key [key ...] | UNLINK key [key ...]: UNLINK leaves freeing big
+    values to the reclaimer thread"""
+    unlink = command_parts[0].upper() == b'UNLINK'
+    deleted = 0
+    for key in command_parts[1:]:
+        value = data_store.get(key)
+        if value is not None:
+            delete_key(key)
+            deleted += 1
+            if unlink and free_effort(value) > LAZYFREE_THRESHOLD:
+                free_value_async(value)
+    if deleted:
+        propagate(command_parts)
+    client.send(b':%d\r\n' % deleted)
+
+def exists_command(client, command_parts):
+    # A key named twice counts twice, like in Redis
+    client.send(b':%d\r\n' % sum(key in data_store for key in command_parts[1:]))
+
+def mget_command(client, command_parts):
+    """MGET key [key ...]: the whole reply is written into one buffer"""
+    out = bytearray(b'*%d\r\n' % (len(command_parts) - 1))
+    get = data_store.get
+    for key in command_parts[1:]:
+        value = get(key)
+        if type(value) is int:
+            out += b'$%d\r\n%d\r\n' % (strings.length(value), value)
+        elif value is None or not strings.is_string(value):
+            # Missing keys and keys of other types are both nil
+            out += NULL_BULK_STRING
+        else:
+            write_bulk(out, value)
+    client.send(out)
+
+def mset_command(client, command_parts):
+    """MSET key value [key value ...] | MSETNX key value [key value ...]
+
+    MSETNX sets nothing (and replies 0) if any of the keys exists."""
+    if len(command_parts) % 2 == 0:
+        client.send(wrong_number_of_arguments(command_parts))
+        return
+    nx = command_parts[0].upper() == b'MSETNX'
+    if nx and any(key in data_store for key in command_parts[1::2]):
+        client.send(b':0\r\n')
+        return
+    for i in range(1, len(command_parts), 2):
+        key = command_parts[i]
+        data_store[key] = strings.encode(command_parts[i + 1])
+        if key in expiry_store:
+            del expiry_store[key]
+    propagate(command_parts)
+    client.send(b':1\r\n' if nx else b'+OK\r\n')
+
+def xrange_command(client, command_parts):
+    cmd = command_parts[0].upper()
+    key = command_parts[1]
+    if cmd == b'XRANGE':
+        start_id_str, end_id_str = command_parts[2], command_parts[3]
+    else:
+        end_id_str, start_id_str = command_parts[2], command_parts[3]
+
+    if start_id_str == b'-':
+        start_id_str = b'0-0'
+
+    count = None
+    if len(command_parts) > 4:
+        if len(command_parts) != 6 or command_parts[4].upper() != b'COUNT':
+            client.send(b'-ERR syntax error\r\n')
+            return
+        try:
+            count = max(int(command_parts[5]), 0)
+        except ValueError:
+            client.send(b'-ERR value is not an integer or out of range\r\n')
+            return
+
+    # Check stream existence
+    if key not in data_store or not is_stream(data_store[key]):
+        # Return empty array if key missing or not a stream
+        client.send(b"*0\r\n")
+        return
+
+    stream = data_store[key]
+
+    # Parse IDs with proper default sequence numbers
+    try:
+        start = parse_entry_id_with_default(start_id_str, default_seq_for_end=False)
+        end = parse_entry_id_with_default(end_id_str, default_seq_for_end=True)
+    except ValueError:
+        client.send(b'-ERR Invalid stream ID specified as stream command argument\r\n')
+        return
+
+    # The stream seeks straight to the start ID, so this costs only the rows returned
+    if cmd == b'XRANGE':
+        result_entries = stream.range(start, end, count, stream_entry_cache)
+    else:
+        result_entries = stream.rev_range(end, start, count, stream_entry_cache)
+    if maxmemory and stream_entry_cache:
+        # Newly cached entries count towards the key's size
+        update_key_meta(key)
+
+    client.send(encode_stream_entries(result_entries))
+
+def rpush_command(client, command_parts):
+    key = command_parts[1]
+    values = command_parts[2:]
+    if key not in data_store:
+        data_store[key] = QuickList(values)
+        length = len(data_store[key])
+    else:
+        if is_list(data_store[key]):
+            for value in values:
+                data_store[key].append(value)
+            length = len(data_store[key])
+        else:
+            client.send(b'-ERR value is not a list\r\n')
+            return
+
+    propagate(command_parts)
+    client.send(b':%d\r\n' % length)
+    signal_key_ready(key)
+
+def type_command(client, command_parts):
+    key = command_parts[1]
+    if key not in data_store:
+        client.send(b'+none\r\n')
+    else:
+        value = data_store[key]
+        if is_stream(value):
+            client.send(b'+stream\r\n')
+        elif is_list(value):
+            client.send(b'+list\r\n')
+        else:
+            client.send(b'+string\r\n')
+
+def memory_command(client, command_parts):
+    if command_parts[1].upper() != b'USAGE' or len(command_parts) != 3:
+        client.send(unknown_subcommand(command_parts))
+        return
+    key = command_parts[2]
+    if key not in data_store:
+        client.send(NULL_BULK_STRING)
+    else:
+        usage = sys.getsizeof(key) + value_memory_usage(data_store[key])
+        client.send(b':%d\r\n' % usage)
+
+def echo_command(client, command_parts):
+    message = command_parts[1]
+    response = to_bulk_string(message)
+    client.send(response)
+
+def ping_command(client, command_parts):
+    client.send(b'+PONG\r\n')
+
+def save_command(client, command_parts):
+    if rdb_child_pid is not None:
+        client.send(b'-ERR Background save already in progress\r\n')
+        return
+    try:
+        rdb_save()
+    except OSError as e:
+        client.send(f'-ERR {e}\r\n'.encode())
+        return
+    client.send(b'+OK\r\n')
+
+def bgsave_command(client, command_parts):
+    if aof_child_pid is not None:
+        client.send(b"-ERR Another child process is active (AOF?): can't BGSAVE right now\r\n")
+    elif rdb_bgsave():
+        client.send(b'+Background saving started\r\n')
+    else:
+        client.send(b'-ERR Background save already in progress\r\n')
+
+def lastsave_command(client, command_parts):
+    client.send(b':%d\r\n' % lastsave)
+
+def bgrewriteaof_command(client, command_parts):
+    global aof_rewrite_scheduled
+    if aof_child_pid is not None:
+        client.send(b'-ERR Background append only file rewriting already in progress\r\n')
+    elif rdb_child_pid is not None:
+        # Started by server_cron once the BGSAVE child is done
+        aof_rewrite_scheduled = True
+        client.send(b'+Background append only file rewriting scheduled\r\n')
+    else:
+        aof_bgrewrite()
+        client.send(b'+Background append only file rewriting started\r\n')
+
+def config_command(client, command_parts):
+    """CONFIG GET pattern | SET parameter value | RESETSTAT"""
+    sub = command_parts[1].upper()
+    if sub == b'SET' and len(command_parts) == 4:
+        config_set(client, command_parts[2].decode(errors='replace').lower(), command_parts[3])
+        return
+    if sub == b'RESETSTAT' and len(command_parts) == 2:
+        reset_stats()
+        client.send(b'+OK\r\n')
+        return
+    if sub != b'GET' or len(command_parts) != 3:
+        client.send(unknown_subcommand(command_parts))
+        return
+    config = {
+        'dir': rdb_dir,
+        'dbfilename': rdb_filename,
+        'save': ' '.join(f"{seconds} {changes}" for seconds, changes in save_params),
+        'maxmemory': str(maxmemory),
+        'maxmemory-policy': maxmemory_policy,
+        'appendonly': 'yes' if appendonly else 'no',
+        'appendfilename': appendfilename,
+        'appendfsync': appendfsync,
+        'auto-aof-rewrite-percentage': str(auto_aof_rewrite_percentage),
+        'auto-aof-rewrite-min-size': str(auto_aof_rewrite_min_size),
+        'repl-backlog-size': str(repl_backlog_size),
+        'repl-diskless-sync': 'yes' if repl_diskless_sync else 'no',
+        'repl-diskless-sync-delay': str(repl_diskless_sync_delay),
+        'cluster-enabled': 'yes' if cluster_enabled else 'no',
+        'cluster-config-file': cluster_config_file,
+        'stream-entry-cache': 'yes' if stream_entry_cache else 'no',
+        'slowlog-log-slower-than': str(slowlog_log_slower_than),
+        'slowlog-max-len': str(slowlog_max_len),
+    }
+    pattern = command_parts[2].decode(errors='replace').lower()
+    matches = []
+    for name, value in config.items():
+        if fnmatch.fnmatchcase(name, pattern):
+            matches += [name, value]
+    client.send(encode_resp(matches))
+
+def config_set(client, name, value):
+    # Only the settings that can change while the server runs
+    global slowlog_log_slower_than, slowlog_max_len
+    if name not in ('slowlog-log-slower-than', 'slowlog-max-len'):
+        client.send(f"-ERR Unknown option or number of arguments for CONFIG SET - '{name}'\r\n".encode())
+        return
+    n = strings.parse_int(value)
+    if n is None or (name == 'slowlog-max-len' and n < 0):
+        client.send(f"-ERR CONFIG SET failed (possibly related to argument '{name}') - "
+                    f"argument {'must be an integer' if n is None else 'can not be negative'}\r\n".encode())
+        return
+    if name == 'slowlog-log-slower-than':
+        slowlog_log_slower_than = n
+    else:
+        slowlog_max_len = n
+        while len(slowlog) > slowlog_max_len:
+            slowlog.popleft()
+    client.send(b'+OK\r\n')
+
+def reset_stats():
+    # CONFIG RESETSTAT: counters and command statistics, not the slow log
+    for name in stats:
+        stats[name] = 0
+    for command in COMMAND_TABLE.values():
+        command.reset_stats()
+    ops_samples.clear()
+
+def slowlog_command(client, command_parts):
+    """SLOWLOG GET [count] | LEN | RESET"""
+    sub = command_parts[1].upper()
+    if sub == b'GET' and len(command_parts) <= 3:
+        count = 10
+        if len(command_parts) == 3:
+            count = strings.parse_int(command_parts[2])
+            if count is None or count < -1:
+                client.send(b'-ERR count should be greater than or equal to -1\r\n')
+                return
+            if count == -1:
+                count = len(slowlog)
+        entries = [slowlog[-i] for i in range(1, min(count, len(slowlog)) + 1)]
+        client.send(encode_resp([[entry_id, when, usec, args, address, b'']
+                                 for entry_id, when, usec, args, address in entries]))
+    elif sub == b'LEN' and len(command_parts) == 2:
+        client.send(b':%d\r\n' % len(slowlog))
+    elif sub == b'RESET' and len(command_parts) == 2:
+        slowlog.clear()
+        client.send(b'+OK\r\n')
+    else:
+        client.send(unknown_subcommand(command_parts))
+
+def latency_command(client, command_parts):
+    """LATENCY HISTOGRAM [command ...]: for each command called, its calls
+    and the number of them that took under each power of two microseconds"""
+    if command_parts[1].upper() != b'HISTOGRAM':
+        client.send(unknown_subcommand(command_parts))
+        return
+    names = {name.upper() for name in command_parts[2:]}
+    out = []
+    for name, command in COMMAND_TABLE.items():
+        if not command.calls or (names and name not in names):
+            continue
+        buckets = []
+        total = 0
+        for n, count in enumerate(command.latency):
+            if count:
+                total += count
+                buckets += [1 << n, total]
+            if total == command.calls:
+                break
+        out += [command.name.lower(), ['calls', command.calls, 'histogram_usec', buckets]]
+    client.send(encode_resp(out))
+
+def replconf_command(client, command_parts):
+    option = command_parts[1].lower() if len(command_parts) > 1 else b''
+    if option == b'ack':
+        # Replicas report their offset; nothing is sent back on the stream
+        if not client.is_replica or len(command_parts) < 3:
+            return
+        try:
+            offset = int(command_parts[2])
+        except ValueError:
+            return
+        client.repl_ack_time = time.monotonic()
+        if client.repl_state == "wait_ack":
+            put_replica_online(client)
+        if offset > client.repl_ack_offset:
+            client.repl_ack_offset = offset
+            signal_key_ready(REPLICA_ACK)
+        return
+    if option == b'capa':
+        client.repl_capa_eof = client.repl_capa_eof or b'eof' in (arg.lower() for arg in command_parts[2::2])
+    elif option == b'listening-port' and len(command_parts) == 3:
+        try:
+            client.replica_listening_port = int(command_parts[2])
+        except ValueError:
+            client.send(b'-ERR value is not an integer or out of range\r\n')
+            return
+    client.send(b'+OK\r\n')
+
+def psync_command(client, command_parts):
+    if server_role != "master":
+        client.send(b'-ERR chained replication is not supported, PSYNC the master instead\r\n')
+        return
+    if worker_count > 1:
+        client.send(b'-ERR replication is not supported with --workers\r\n')
+        return
+    add_replica(client, command_parts[1].decode(errors='replace'), command_parts[2])
+
+def wait_command(client, command_parts):
+    if server_role != "master":
+        client.send(b'-ERR WAIT cannot be used with replica instances\r\n')
+        return
+    try:
+        numreplicas = int(command_parts[1])
+        timeout = int(command_parts[2])
+    except ValueError:
+        client.send(b'-ERR value is not an integer or out of range\r\n')
+        return
+    if timeout < 0:
+        client.send(b'-ERR timeout is negative\r\n')
+        return
+    target = client.woff
+
+    def acked():
+        return sum(1 for replica in replicas
+                   if replica.repl_state == "online" and replica.repl_ack_offset >= target)
+
+    def retry():
+        count = acked()
+        return b':%d\r\n' % count if count >= numreplicas else None
+
+    response = retry()
+    if response is not None:
+        client.send(response)
+    else:
+        # Woken by the ACKs rather than polling; only this client waits
+        request_replica_acks()
+        return BlockedCommand([REPLICA_ACK], timeout / 1000 if timeout else None, retry,
+                              lambda: b':%d\r\n' % acked())
+
+def asking_command(client, command_parts):
+    if not cluster_enabled:
+        client.send(b'-ERR This instance has cluster support disabled\r\n')
+        return
+    client.asking = True
+    client.send(b'+OK\r\n')
+
+def dump_command(client, command_parts):
+    value = data_store.get(command_parts[1])
+    if value is None:
+        client.send(NULL_BULK_STRING)
+        return
+    payload = rdb.dump_value(value)
+    client.send(b'$%d\r\n%s\r\n' % (len(payload), payload))
+
+def restore_command(client, command_parts):
+    key = command_parts[1]
+    options = {option.upper() for option in command_parts[4:]}
+    if not options <= {b'REPLACE', b'ABSTTL'}:
+        client.send(b'-ERR syntax error\r\n')
+        return
+    try:
+        ttl = int(command_parts[2])
+        if ttl < 0:
+            raise ValueError
+    except ValueError:
+        client.send(b'-ERR Invalid TTL value, must be >= 0\r\n')
+        return
+    if key in data_store and b'REPLACE' not in options:
+        client.send(b'-BUSYKEY Target key name already exists.\r\n')
+        return
+    try:
+        value = rdb.load_value(command_parts[3])
+    except rdb.RdbError:
+        client.send(b'-ERR DUMP payload version or checksum are wrong\r\n')
+        return
+    now_ms = int(time.time() * 1000)
+    when = None if not ttl else ttl if b'ABSTTL' in options else now_ms + ttl
+    if key in data_store:
+        delete_key(key)
+        propagate([b'DEL', key])
+    if when is not None and when <= now_ms:
+        # Already expired: there's nothing to restore
+        client.send(b'+OK\r\n')
+        return
+    data_store[key] = value
+    parts = [b'RESTORE', key, b'0', command_parts[3]]
+    if when is not None:
+        set_expiry(key, when)
+        parts = [b'RESTORE', key, b'%d' % when, command_parts[3], b'ABSTTL']
+    propagate(parts)
+    signal_key_ready(key)
+    client.send(b'+OK\r\n')
+
+def lrange_command(client, command_parts):
+    key = command_parts[1]
+    try:
+        start = int(command_parts[2])
+        end = int(command_parts[3])
+    except ValueError:
+        client.send(b'-ERR value is not an integer or out of range\r\n')
+        return
+
+    if key not in data_store or not is_list(data_store[key]):
+        client.send(b"*0\r\n")
+        return
+
+    lst = data_store[key]
+    if start < 0:
+        start = max(len(lst) + start, 0)
+    if end < 0:
+        end = len(lst) + end
+    result = lst.range(start, min(end, len(lst) - 1) + 1)
+
+    client.send(encode_resp_array(result))
+
+def lpush_command(client, command_parts):
+    key = command_parts[1]
+    values = command_parts[2:]
+    if key not in data_store:
+        data_store[key] = QuickList()
+    if not is_list(data_store[key]):
+        client.send(b'-ERR value is not a list\r\n')
+        return
+    for val in values:
+        data_store[key].appendleft(val)
+    propagate(command_parts)
+    client.send(b':%d\r\n' % len(data_store[key]))
+    signal_key_ready(key)
+
+def lindex_command(client, command_parts):
+    key = command_parts[1]
+    try:
+        index = int(command_parts[2])
+    except ValueError:
+        client.send(b'-ERR value is not an integer or out of range\r\n')
+        return
+    if key not in data_store:
+        client.send(NULL_BULK_STRING)
+        return
+    if not is_list(data_store[key]):
+        client.send(b'-WRONGTYPE Operation against a key holding the wrong kind of value\r\n')
+        return
+    try:
+        client.send(to_bulk_string(data_store[key][index]))
+    except IndexError:
+        client.send(NULL_BULK_STRING)
+
+def lset_command(client, command_parts):
+    key = command_parts[1]
+    try:
+        index = int(command_parts[2])
+    except ValueError:
+        client.send(b'-ERR value is not an integer or out of range\r\n')
+        return
+    if key not in data_store:
+        client.send(b'-ERR no such key\r\n')
+        return
+    if not is_list(data_store[key]):
+        client.send(b'-WRONGTYPE Operation against a key holding the wrong kind of value\r\n')
+        return
+    try:
+        data_store[key][index] = command_parts[3]
+    except IndexError:
+        client.send(b'-ERR index out of range\r\n')
+        return
+    propagate(command_parts)
+    client.send(b'+OK\r\n')
+
+def ltrim_command(client, command_parts):
+    key = command_parts[1]
+    try:
+        start = int(command_parts[2])
+        end = int(command_parts[3])
+    except ValueError:
+        client.send(b'-ERR value is not an integer or out of range\r\n')
+        return
+    if key in data_store:
+        lst = data_store[key]
+        if not is_list(lst):
+            client.send(b'-WRONGTYPE Operation against a key holding the wrong kind of value\r\n')
+            return
+        if start < 0:
+            start = max(len(lst) + start, 0)
+        if end < 0:
+            end = len(lst) + end
+        lst.trim(min(start, len(lst)), max(min(end + 1, len(lst)), 0))
+        if not lst:
+            delete_key(key)
+        propagate(command_parts)
+    client.send(b'+OK\r\n')
+
+def lmove_command(client, command_parts):
+    source, destination = command_parts[1], command_parts[2]
+    wherefrom, whereto = command_parts[3].upper(), command_parts[4].upper()
+    if wherefrom not in (b'LEFT', b'RIGHT') or whereto not in (b'LEFT', b'RIGHT'):
+        client.send(b'-ERR syntax error\r\n')
+        return
+    if source not in data_store:
+        client.send(NULL_BULK_STRING)
+        return
+    src = data_store[source]
+    dst = data_store.get(destination)
+    if not is_list(src) or (dst is not None and not is_list(dst)):
+        client.send(b'-WRONGTYPE Operation against a key holding the wrong kind of value\r\n')
+        return
+    value = src.popleft() if wherefrom == b'LEFT' else src.pop()
+    # With source == destination the list is rotated in place: it may be
+    # empty for a moment, but the key stays
+    if not src and source != destination:
+        delete_key(source)
+    if dst is None:
+        dst = data_store[destination] = QuickList()
+    if whereto == b'LEFT':
+        dst.appendleft(value)
+    else:
+        dst.append(value)
+    propagate(command_parts)
+    client.send(to_bulk_string(value))
+    signal_key_ready(destination)
+
+def xread_command(client, command_parts):
+    block = None # None means no blocking, 0 means block forever
+    count = None
+    idx = 1
+
+    # Detect BLOCK / COUNT options if present
+    while idx + 1 < len(command_parts) and command_parts[idx].upper() in (b'BLOCK', b'COUNT'):
+        option = command_parts[idx].upper()
+        try:
+            if option == b'BLOCK':
+                block = int(command_parts[idx + 1])
+            else:
+                count = max(int(command_parts[idx + 1]), 1)
+        except ValueError:
+            client.send(b'-ERR invalid %s value\r\n' % option)
+            return
+        idx += 2
+
+    # Next token must be 'STREAMS'
+    if len(command_parts) <= idx or command_parts[idx].upper() != b'STREAMS':
+        client.send(b'-ERR syntax error\r\n')
+        return
+
+    idx += 1
+    num_streams = (len(command_parts) - idx) // 2
+    keys = command_parts[idx:idx + num_streams]
+    last_ids = command_parts[idx + num_streams: idx + num_streams * 2]
+
+    if len(keys) != len(last_ids):
+        client.send(b'-ERR number of streams and IDs do not match\r\n')
+        return
+
+    # Resolve '$' IDs at the start of XREAD
+    resolved_last_ids = []
+    for stream_key, last_id_str in zip(keys, last_ids):
+        if last_id_str == b'$':
+            if stream_key in data_store and is_stream(data_store[stream_key]):
+                # Use the last entry ID in the stream at this moment (0-0 if empty)
+                resolved_last_ids.append(format_entry_id(data_store[stream_key].last_id()))
+            else:
+                # Stream doesn't exist
+                resolved_last_ids.append(b'0-0')
+        else:
+            resolved_last_ids.append(last_id_str)
+
+    parsed_last_ids = []
+    for last_id_str in resolved_last_ids:
+        parsed = parse_entry_id(last_id_str)
+        if parsed is None:
+            client.send(b'-ERR invalid ID format\r\n')
+            return
+        parsed_last_ids.append(parsed)
+
+    def check_new_entries():
+        # Only the streams that have new entries are in the reply. Their top
+        # entries may be deleted, so last_id() can be past what is left
+        results = []
+        for stream_key, last_id in zip(keys, parsed_last_ids):
+            stream = data_store.get(stream_key)
+            if stream is None or not is_stream(stream):
+                continue
+            top_id = stream.top_id()
+            if top_id is None or top_id <= last_id:
+                continue
+            results.append((stream_key, stream.after(last_id, count, stream_entry_cache)))
+            if maxmemory and stream_entry_cache:
+                update_key_meta(stream_key)
+        return results
+
+    def encode_xread_response(resp_data):
+        resp = bytearray(b'*%d\r\n' % len(resp_data))
+        for stream_key, entries in resp_data:
+            resp += b'*2\r\n$%d\r\n%s\r\n' % (len(stream_key), stream_key)
+            encode_stream_entries(entries, resp)
+        return resp
+
+    # Check for new entries immediately
+    resp_data = check_new_entries()
+
+    # If any entries found or no blocking requested, send response immediately
+    if resp_data or block is None:
+        # No entries found and no blocking: an empty array
+        client.send(encode_xread_response(resp_data))
+    else:
+        # Blocking requested: park the client until one of the streams gets an entry
+        def retry():
+            resp_data = check_new_entries()
+            return encode_xread_response(resp_data) if resp_data else None
+
+        timeout_sec = block / 1000.0 if block > 0 else None
+        return BlockedCommand(keys, timeout_sec, retry, b"$-1\r\n")
+
+STREAM_ID_ERROR = b'-ERR Invalid stream ID specified as stream command argument\r\n'
+MAX_ENTRY_ID = (18446744073709551615, 18446744073709551615)
+
+def parse_stream_id(entry_id):
+    # An exact ID, "ms-seq" or "ms" (seq 0); None if it isn't one
+    ms, _, seq = entry_id.partition(b'-')
+    try:
+        return int(ms), int(seq) if seq else 0
+    except ValueError:
+        return None
+
+def now_ms():
+    return int(time.time() * 1000)
+
+def lookup_stream_group(client, key, group_name):
+    """The stream at key and its consumer group; (None, None) once the
+    error is sent if either is missing"""
+    stream = data_store.get(key)
+    if stream is not None and not is_stream(stream):
+        client.send(WRONGTYPE_ERROR)
+        return None, None
+    group = stream.groups.get(group_name) if stream is not None else None
+    if group is None:
+        client.send(b"-NOGROUP No such key '%s' or consumer group '%s'\r\n" % (key, group_name))
+        return None, None
+    return stream, group
+
+def lookup_consumer(key, group_name, group, name, now):
+    # Consumers come into being when first named; replicas and the log are told
+    consumer = group.consumer(name, now, create=False)
+    if consumer is None:
+        consumer = group.consumer(name, now)
+        propagate([b'XGROUP', b'CREATECONSUMER', key, group_name, name])
+    consumer.seen_time = now
+    return consumer
+
+def propagate_claim(key, group_name, entry_id, nack, last_id):
+    # How a delivery or a claim is replayed: the same owner, time and count
+    propagate([b'XCLAIM', key, group_name, nack.consumer.name, b'0', format_entry_id(entry_id),
+               b'TIME', b'%d' % nack.delivery_time, b'RETRYCOUNT', b'%d' % nack.delivery_count,
+               b'FORCE', b'JUSTID', b'LASTID', format_entry_id(last_id)])
+
+def encode_entry_or_nil(stream, entry_id):
+    # A pending entry that was deleted from the stream is [id, nil]
+    encoded = stream.get(entry_id, stream_entry_cache)
+    if encoded is not None:
+        return encoded
+    entry_id = format_entry_id(entry_id)
+    return b'*2\r\n$%d\r\n%s\r\n*-1\r\n' % (len(entry_id), entry_id)
+
+def xgroup_command(client, command_parts):
+    """XGROUP CREATE key group id|$ [MKSTREAM] | SETID key group id|$ | DESTROY key group
+    | CREATECONSUMER key group consumer | DELCONSUMER key group consumer"""
+    sub = command_parts[1].upper()
+    arity = {b'CREATE': -5, b'SETID': 5, b'DESTROY': 4, b'CREATECONSUMER': 5, b'DELCONSUMER': 5}.get(sub)
+    if arity is None or not (len(command_parts) == arity or (arity < 0 and len(command_parts) >= -arity)):
+        client.send(unknown_subcommand(command_parts))
+        return
+    key, group_name = command_parts[2], command_parts[3]
+    stream = data_store.get(key)
+    if stream is not None and not is_stream(stream):
+        client.send(WRONGTYPE_ERROR)
+        return
+
+    if sub == b'CREATE':
+        options = [part.upper() for part in command_parts[5:]]
+        if any(option != b'MKSTREAM' for option in options):
+            client.send(b'-ERR syntax error\r\n')
+            return
+        if stream is None and not options:
+            client.send(b'-ERR The XGROUP subcommand requires the key to exist. Note that for CREATE '
+                        b'you may want to use the MKSTREAM option to create an empty stream automatically.\r\n')
+            return
+        if stream is not None and group_name in stream.groups:
+            client.send(b'-BUSYGROUP Consumer Group name already exists\r\n')
+            return
+        last_id = stream.last_id() if stream is not None else (0, 0)
+        if command_parts[4] != b'$':
+            last_id = parse_stream_id(command_parts[4])
+            if last_id is None:
+                client.send(STREAM_ID_ERROR)
+                return
+        if stream is None:
+            stream = data_store[key] = Stream()
+        stream.groups[group_name] = StreamGroup(last_id)
+        propagate([b'XGROUP', b'CREATE', key, group_name, format_entry_id(last_id), b'MKSTREAM'])
+        client.send(b'+OK\r\n')
+        return
+
+    group = stream.groups.get(group_name) if stream is not None else None
+    if sub == b'DESTROY':
+        if group is None:
+            client.send(b':0\r\n')
+            return
+        del stream.groups[group_name]
+        # Clients blocked reading through the group get -NOGROUP
+        signal_key_ready(key)
+        propagate(command_parts)
+        client.send(b':1\r\n')
+        return
+    if group is None:
+        client.send(b"-NOGROUP No such key '%s' or consumer group '%s'\r\n" % (key, group_name))
+        return
+
+    if sub == b'SETID':
+        last_id = stream.last_id()
+        if command_parts[4] != b'$':
+            last_id = parse_stream_id(command_parts[4])
+            if last_id is None:
+                client.send(STREAM_ID_ERROR)
+                return
+        group.last_id = last_id
+        propagate([b'XGROUP', b'SETID', key, group_name, format_entry_id(last_id)])
+        client.send(b'+OK\r\n')
+    elif sub == b'CREATECONSUMER':
+        name = command_parts[4]
+        if group.consumer(name, now_ms(), create=False) is not None:
+            client.send(b':0\r\n')
+            return
+        group.consumer(name, now_ms())
+        propagate(command_parts)
+        client.send(b':1\r\n')
+    else:
+        pending = group.delete_consumer(command_parts[4])
+        propagate(command_parts)
+        client.send(b':%d\r\n' % pending)
+
+def xreadgroup_command(client, command_parts):
+    """XREADGROUP GROUP group consumer [COUNT n] [BLOCK ms] [NOACK] STREAMS key [key ...] id [id ...]
+
+    With the ID > the consumer gets entries not delivered to the group yet,
+    which go to its pending entries (unless NOACK). Any other ID rereads
+    the consumer's own pending entries after it, and never blocks."""
+    if command_parts[1].upper() != b'GROUP':
+        client.send(b'-ERR syntax error\r\n')
+        return
+    group_name, consumer_name = command_parts[2], command_parts[3]
+    block = None  # None means no blocking, 0 means block forever
+    count = None
+    noack = False
+    idx = 4
+    while idx < len(command_parts) and command_parts[idx].upper() != b'STREAMS':
+        option = command_parts[idx].upper()
+        if option == b'NOACK':
+            noack = True
+            idx += 1
+            continue
+        if option not in (b'BLOCK', b'COUNT') or idx + 1 >= len(command_parts):
+            client.send(b'-ERR syntax error\r\n')
+            return
+        try:
+            if option == b'BLOCK':
+                block = int(command_parts[idx + 1])
+            else:
+                count = max(int(command_parts[idx + 1]), 1)
+        except ValueError:
+            client.send(b'-ERR invalid %s value\r\n' % option)
+            return
+        idx += 2
+    idx += 1
+    rest = command_parts[idx:]
+    if not rest or len(rest) % 2:
+        client.send(b"-ERR Unbalanced 'xreadgroup' list of streams: for each stream key an ID "
+                    b"or '>' must be specified.\r\n")
+        return
+    keys = rest[:len(rest) // 2]
+    start_ids = []  # None for >
+    for arg in rest[len(rest) // 2:]:
+        start_id = None if arg == b'>' else parse_stream_id(arg)
+        if start_id is None and arg != b'>':
+            client.send(STREAM_ID_ERROR)
+            return
+        start_ids.append(start_id)
+    for key in keys:
+        stream, group = lookup_stream_group(client, key, group_name)
+        if group is None:
+            return
+
+    def read_group():
+        # The streams with something to return, or an error if a group went away
+        results = []
+        now = now_ms()
+        for key, start_id in zip(keys, start_ids):
+            stream = data_store.get(key)
+            group = stream.groups.get(group_name) if stream is not None and is_stream(stream) else None
+            if group is None:
+                return b"-NOGROUP No such key '%s' or consumer group '%s'\r\n" % (key, group_name)
+            consumer = lookup_consumer(key, group_name, group, consumer_name, now)
+            if start_id is not None:
+                entries = []
+                after = (start_id[0], start_id[1] + 1)
+                for entry_id in group.pending_range(after, MAX_ENTRY_ID, count, consumer):
+                    nack = group.pending[entry_id]
+                    nack.delivery_time = now
+                    nack.delivery_count += 1
+                    propagate_claim(key, group_name, entry_id, nack, group.last_id)
+                    entries.append(encode_entry_or_nil(stream, entry_id))
+                results.append((key, entries))
+                continue
+            if stream.last_id() <= group.last_id:
+                continue
+            delivered = stream.after(group.last_id, count, stream_entry_cache, with_ids=True)
+            if not delivered:
+                continue
+            group.last_id = delivered[-1][0]
+            consumer.active_time = now
+            if noack:
+                propagate([b'XGROUP', b'SETID', key, group_name, format_entry_id(group.last_id)])
+            else:
+                for entry_id, _ in delivered:
+                    nack = group.add_pending(entry_id, consumer, now)
+                    propagate_claim(key, group_name, entry_id, nack, group.last_id)
+            results.append((key, [entry for _, entry in delivered]))
+        return results
+
+    def encode_reply(results):
+        resp = bytearray(b'*%d\r\n' % len(results))
+        for key, entries in results:
+            resp += b'*2\r\n$%d\r\n%s\r\n' % (len(key), key)
+            encode_stream_entries(entries, resp)
+        return resp
+
+    results = read_group()
+    if isinstance(results, bytes):
+        client.send(results)
+    elif results:
+        client.send(encode_reply(results))
+    elif block is None or any(start_id is not None for start_id in start_ids):
+        client.send(b'*-1\r\n')
+    else:
+        def retry():
+            results = read_group()
+            if isinstance(results, bytes):
+                return results
+            return encode_reply(results) if results else None
+
+        return BlockedCommand(keys, block / 1000.0 if block > 0 else None, retry, b'*-1\r\n')
+
+def xack_command(client, command_parts):
+    """XACK key group id [id ...]"""
+    key, group_name = command_parts[1], command_parts[2]
+    entry_ids = [parse_stream_id(arg) for arg in command_parts[3:]]
+    if None in entry_ids:
+        client.send(STREAM_ID_ERROR)
+        return
+    stream = data_store.get(key)
+    if stream is not None and not is_stream(stream):
+        client.send(WRONGTYPE_ERROR)
+        return
+    group = stream.groups.get(group_name) if stream is not None else None
+    if group is None:
+        client.send(b':0\r\n')
+        return
+    acked = sum(group.ack(entry_id) for entry_id in entry_ids)
+    if acked:
+        propagate(command_parts)
+    client.send(b':%d\r\n' % acked)
+
+def xpending_command(client, command_parts):
+    """XPENDING key group [[IDLE min-idle-ms] start end count [consumer]]"""
+    key, group_name = command_parts[1], command_parts[2]
+    args = command_parts[3:]
+    min_idle = None
+    if len(args) >= 2 and args[0].upper() == b'IDLE':
+        try:
+            min_idle = int(args[1])
+        except ValueError:
+            client.send(b'-ERR value is not an integer or out of range\r\n')
+            return
+        args = args[2:]
+        if not args:
+            client.send(b'-ERR syntax error\r\n')
+            return
+    if args and len(args) not in (3, 4):
+        client.send(b'-ERR syntax error\r\n')
+        return
+    stream, group = lookup_stream_group(client, key, group_name)
+    if group is None:
+        return
+
+    if not args:
+        # Summary: how many, the smallest and greatest ID, and how many per consumer
+        if not group.pending_ids:
+            client.send(b'*4\r\n:0\r\n$-1\r\n$-1\r\n*-1\r\n')
+            return
+        per_consumer = [[consumer.name, b'%d' % len(consumer.pending)]
+                        for consumer in group.consumers.values() if consumer.pending]
+        client.send(encode_resp([len(group.pending_ids), format_entry_id(group.pending_ids.first()),
+                                 format_entry_id(group.pending_ids.last()), per_consumer]))
+        return
+
+    try:
+        start = parse_entry_id_with_default(b'0-0' if args[0] == b'-' else args[0])
+        end = parse_entry_id_with_default(args[1], default_seq_for_end=True)
+        count = max(int(args[2]), 0)
+    except ValueError:
+        client.send(STREAM_ID_ERROR)
+        return
+    consumer = None
+    if len(args) == 4:
+        consumer = group.consumer(args[3], 0, create=False)
+        if consumer is None:
+            client.send(b'*0\r\n')
+            return
+    now = now_ms()
+    rows = []
+    # With IDLE, entries delivered too recently are skipped and don't count
+    for entry_id in group.pending_range(start, end, None if min_idle else count, consumer):
+        if len(rows) >= count:
+            break
+        nack = group.pending[entry_id]
+        idle = now - nack.delivery_time
+        if min_idle is not None and idle < min_idle:
+            continue
+        rows.append([format_entry_id(entry_id), nack.consumer.name, max(idle, 0), nack.delivery_count])
+    client.send(encode_resp(rows))
+
+def claim_pending(stream, group, key, group_name, entry_id, consumer, delivery_time, delivery_count, last_id,
+                  force=False):
+    """Give entry_id to consumer and propagate it; False (and the entry is
+    acknowledged) if it was deleted from the stream meanwhile, unless force
+    keeps it pending all the same"""
+    if not force and stream.get(entry_id, cache=False) is None:
+        if group.ack(entry_id):
+            propagate([b'XACK', key, group_name, format_entry_id(entry_id)])
+        return False
+    nack = group.add_pending(entry_id, consumer, delivery_time, delivery_count)
+    propagate_claim(key, group_name, entry_id, nack, last_id)
+    return True
+
+def xclaim_command(client, command_parts):
+    """XCLAIM key group consumer min-idle-time id [id ...] [IDLE ms] [TIME unix-ms]
+    [RETRYCOUNT count] [FORCE] [JUSTID] [LASTID id]"""
+    key, group_name, consumer_name = command_parts[1], command_parts[2], command_parts[3]
+    try:
+        min_idle = int(command_parts[4])
+    except ValueError:
+        client.send(b'-ERR Invalid min-idle-time argument for XCLAIM\r\n')
+        return
+    entry_ids = []
+    idx = 5
+    while idx < len(command_parts):
+        entry_id = parse_stream_id(command_parts[idx])
+        if entry_id is None:
+            break
+        entry_ids.append(entry_id)
+        idx += 1
+    now = now_ms()
+    delivery_time = None
+    retry_count = None
+    force = justid = False
+    last_id = None
+    while idx < len(command_parts):
+        option = command_parts[idx].upper()
+        if option in (b'FORCE', b'JUSTID'):
+            force = force or option == b'FORCE'
+            justid = justid or option == b'JUSTID'
+            idx += 1
+            continue
+        if option not in (b'IDLE', b'TIME', b'RETRYCOUNT', b'LASTID') or idx + 1 >= len(command_parts):
+            client.send(b'-ERR Unrecognized XCLAIM option \'%s\'\r\n' % command_parts[idx])
+            return
+        value = command_parts[idx + 1]
+        if option == b'LASTID':
+            last_id = parse_stream_id(value)
+            if last_id is None:
+                client.send(STREAM_ID_ERROR)
+                return
+        else:
+            try:
+                number = int(value)
+            except ValueError:
+                client.send(b'-ERR Invalid %s option argument for XCLAIM\r\n' % option)
+                return
+            if option == b'IDLE':
+                delivery_time = now - number
+            elif option == b'TIME':
+                delivery_time = number
+            else:
+                retry_count = number
+        idx += 2
+    stream, group = lookup_stream_group(client, key, group_name)
+    if group is None:
+        return
+
+    if last_id is not None and last_id > group.last_id:
+        group.last_id = last_id
+    consumer = lookup_consumer(key, group_name, group, consumer_name, now)
+    claimed = []
+    for entry_id in entry_ids:
+        nack = group.pending.get(entry_id)
+        if nack is None:
+            # FORCE puts entries that aren't pending yet in the PEL. It does
+            # so even for an entry deleted from the stream: that is how the
+            # AOF and replicas get back a pending entry that can't be read
+            # any more but still waits for its XACK
+            if not force:
+                continue
+            delivery_count = 0
+        elif now - nack.delivery_time < min_idle:
+            continue
+        else:
+            delivery_count = nack.delivery_count
+        if retry_count is not None:
+            delivery_count = retry_count
+        elif not justid:
+            delivery_count += 1
+        if claim_pending(stream, group, key, group_name, entry_id, consumer,
+                         now if delivery_time is None else delivery_time, delivery_count, group.last_id, force):
+            claimed.append(entry_id)
+    if claimed:
+        consumer.active_time = now
+    if justid:
+        client.send(encode_resp_array([format_entry_id(entry_id) for entry_id in claimed]))
+    else:
+        client.send(encode_stream_entries([encode_entry_or_nil(stream, entry_id) for entry_id in claimed]))
+
+def xautoclaim_command(client, command_parts):
+    """XAUTOCLAIM key group consumer min-idle-time start [COUNT count] [JUSTID]
+
+    Walks the PEL from start and claims up to count entries idle long
+    enough, looking at no more than ten times count. The reply is the ID to
+    continue from (0-0 at the end), the claimed entries and the IDs that
+    were pending but no longer exist in the stream."""
+    key, group_name, consumer_name = command_parts[1], command_parts[2], command_parts[3]
+    try:
+        min_idle = int(command_parts[4])
+    except ValueError:
+        client.send(b'-ERR Invalid min-idle-time argument for XAUTOCLAIM\r\n')
+        return
+    start = (0, 0) if command_parts[5] == b'-' else parse_stream_id(command_parts[5])
+    if start is None:
+        client.send(STREAM_ID_ERROR)
+        return
+    count = 100
+    justid = False
+    idx = 6
+    while idx < len(command_parts):
+        option = command_parts[idx].upper()
+        if option == b'JUSTID':
+            justid = True
+            idx += 1
+        elif option == b'COUNT' and idx + 1 < len(command_parts):
+            try:
+                count = int(command_parts[idx + 1])
+            except ValueError:
+                count = 0
+            if count < 1:
+                client.send(b'-ERR COUNT must be > 0\r\n')
+                return
+            idx += 2
+        else:
+            client.send(b'-ERR syntax error\r\n')
+            return
+    stream, group = lookup_stream_group(client, key, group_name)
+    if group is None:
+        return
 
-stream_conditions = defaultdict(threading.Condition)
-
-def parse_resp(data):
-    lines=data.split(b'\r\n')
-    if not lines or lines[0][0] != ord('*'):
-        return []
-    num_items = int(lines[0][1:])
-    parts = []
-    i=1
-    while len(parts) < num_items and i < len(lines):
-        if lines[i].startswith(b'$'):
-            length = int(lines[i][1:])
-            parts.append(lines[i+1].decode())
-            i+=2
+    now = now_ms()
+    consumer = lookup_consumer(key, group_name, group, consumer_name, now)
+    claimed = []
+    deleted = []
+    examined = group.pending_range(start, MAX_ENTRY_ID, count * 10)
+    last_examined = None
+    for entry_id in examined:
+        if len(claimed) >= count:
+            break
+        last_examined = entry_id
+        nack = group.pending[entry_id]
+        if now - nack.delivery_time < min_idle:
+            continue
+        delivery_count = nack.delivery_count if justid else nack.delivery_count + 1
+        if claim_pending(stream, group, key, group_name, entry_id, consumer, now, delivery_count, group.last_id):
+            claimed.append(entry_id)
         else:
-            i+=1
-    return parts
+            deleted.append(entry_id)
+    if claimed:
+        consumer.active_time = now
+    cursor = group.next_pending(last_examined) if last_examined is not None else None
 
-def encode_resp_array(elements):
-    resp = f"*{len(elements)}\r\n"
-    for elem in elements:
-        resp += f"${len(elem)}\r\n{elem}\r\n"
-    return resp.encode()
+    reply = bytearray(b'*3\r\n')
+    write_bulk(reply, format_entry_id(cursor or (0, 0)))
+    if justid:
+        write_array(reply, [format_entry_id(entry_id) for entry_id in claimed])
+    else:
+        encode_stream_entries([stream.get(entry_id, stream_entry_cache) for entry_id in claimed], reply)
+    write_array(reply, [format_entry_id(entry_id) for entry_id in deleted])
+    client.send(reply)
 
-def parse_entry_id(entry_id):
-    try:
-        ms_str, seq_str = entry_id.split('-')
-        ms = int(ms_str)
-        seq = seq_str
-        if seq!='*':
-            seq = int(seq_str)
-        return ms, seq
-    except Exception:
-        return None
+def llen_command(client, command_parts):
+    key = command_parts[1]
+    if key not in data_store:
+        client.send(b':0\r\n')
+        return
+    elif not is_list(data_store[key]):
+        client.send(b'-ERR value is not a list\r\n')
+    else:
+        client.send(b':%d\r\n' % len(data_store[key]))
 
-def parse_entry_id_with_default(entry_id_str, default_seq_for_end=False):
-    MAX_SEQ = 18446744073709551615  # Max 64-bit unsigned int
-    MAX_MS = 9223372036854775807   # Approx max int64 ms timestamp (can use a large number)
-    if entry_id_str == '+':
-        # Return maximum possible ID
-        return MAX_MS, MAX_SEQ
-    if '-' in entry_id_str:
-        ms_str, seq_str = entry_id_str.split('-')
-        ms = int(ms_str)
-        seq = int(seq_str)
-        return ms, seq
+def pop_command(client, command_parts):
+    cmd = command_parts[0].upper()
+    if len(command_parts) > 3:
+        client.send(wrong_number_of_arguments(command_parts))
+        return
+
+    key = command_parts[1]
+    count = 1
+    if len(command_parts) == 3:
+        try:
+            count = int(command_parts[2])
+            if count < 0:
+                raise ValueError
+        except ValueError:
+            client.send(b'-ERR value is not an integer or out of range\r\n')
+            return
+
+    if key not in data_store:
+        client.send(NULL_BULK_STRING if len(command_parts) == 2 else b'*-1\r\n')
+        return
+
+    values = data_store[key]
+    if not is_list(values):
+        client.send(b'-ERR value is not a list\r\n')
+        return
+
+    pop = values.popleft if cmd == b'LPOP' else values.pop
+    popped = []
+    while len(popped) < count and values:
+        popped.append(pop())
+    if not values:
+        delete_key(key)
+    if popped:
+        propagate(command_parts)
+
+    if len(command_parts) == 2:
+        if popped:
+            client.send(to_bulk_string(popped[0]))
+        else:
+            client.send(NULL_BULK_STRING)
     else:
-        ms = int(entry_id_str)
-        seq = MAX_SEQ if default_seq_for_end else 0
-        return ms, seq
+        client.send(encode_resp_array(popped))
 
-def encode_resp_nested_array(entries):
-    # Helper to encode the list of stream entries for XRANGE
-    # entries is a list of tuples: (id_str, {field: value, ...})
-    resp = f"*{len(entries)}\r\n"
-    for entry_id, fields_dict in entries:
-        # Each entry is an array of 2 elements
-        resp += "*2\r\n"
-        # First element: entry ID as bulk string
-        resp += f"${len(entry_id)}\r\n{entry_id}\r\n"
-
-        # Second element: array of field-value strings
-        # Must preserve insertion order, so we use iteration order of dict
-        n_fields = len(fields_dict) * 2
-        resp += f"*{n_fields}\r\n"
-        for field, value in fields_dict.items():
-            resp += f"${len(field)}\r\n{field}\r\n"
-            resp += f"${len(value)}\r\n{value}\r\n"
-
-    return resp.encode()
-    
-def to_bulk_string(message):
-    return f"${len(message)}\r\n{message}\r\n".encode()
+def parse_trim_options(command_parts, idx):
+    """MAXLEN|MINID [=|~] threshold [LIMIT count] at command_parts[idx].
 
-def is_stream(obj):
-    # Helper: True if obj is a stream (list of (id, dict) tuples); False otherwise
-    # Rudimentary check only for this challenge!
-    if not isinstance(obj, list):
-        return False
-    # Empty stream is still a stream
-    if len(obj) == 0:
-        return True
-    first = obj[0]
-    return (isinstance(first, tuple) and len(first) == 2 and isinstance(first[1], dict))
+    Returns the keyword arguments of Stream.trim and the index past the
+    options, or an error reply. LIMIT caps what ~ removes at once, and
+    defaults to a hundred nodes' worth of entries like in Redis."""
+    strategy = command_parts[idx].upper()
+    idx += 1
+    approx = False
+    if idx < len(command_parts) and command_parts[idx] in (b'=', b'~'):
+        approx = command_parts[idx] == b'~'
+        idx += 1
+    if idx >= len(command_parts):
+        return b'-ERR syntax error\r\n'
+    if strategy == b'MAXLEN':
+        try:
+            threshold = int(command_parts[idx])
+        except ValueError:
+            threshold = -1
+        if threshold < 0:
+            return b'-ERR The MAXLEN argument must be >= 0.\r\n'
+    else:
+        threshold = parse_stream_id(command_parts[idx])
+        if threshold is None:
+            return STREAM_ID_ERROR
+    idx += 1
+    limit = 100 * STREAM_NODE_MAX_ENTRIES if approx else None
+    if idx + 1 < len(command_parts) and command_parts[idx].upper() == b'LIMIT':
+        if not approx:
+            return b'-ERR syntax error, LIMIT cannot be used without the special ~ option\r\n'
+        try:
+            limit = int(command_parts[idx + 1])
+        except ValueError:
+            limit = -1
+        if limit < 0:
+            return b'-ERR The LIMIT argument must be >= 0.\r\n'
+        limit = limit or None
+        idx += 2
+    options = {'maxlen' if strategy == b'MAXLEN' else 'minid': threshold, 'approx': approx, 'limit': limit}
+    return options, idx
 
-def connect_to_master():
-    """Connect to master server and perform initial handshake"""
-    global master_host, master_port
-    
-    if master_host is None or master_port is None:
+def xadd_command(client, command_parts):
+    """XADD key [MAXLEN|MINID [=|~] threshold [LIMIT count]] id|* field value [field value ...]"""
+    key = command_parts[1]
+    idx = 2
+    trim = None
+    if command_parts[idx].upper() in (b'MAXLEN', b'MINID'):
+        parsed = parse_trim_options(command_parts, idx)
+        if isinstance(parsed, bytes):
+            client.send(parsed)
+            return
+        trim, idx = parsed
+    if len(command_parts) - idx < 3 or (len(command_parts) - idx) % 2 != 1:
+        client.send(wrong_number_of_arguments(command_parts))
         return
-    
+    entry_id_raw = command_parts[idx]
+    field_values = command_parts[idx + 1:]
+
+    stream = data_store.get(key)
+    if stream is not None and not is_stream(stream):
+        client.send(b'-ERR key exists and is not a stream\r\n')
+        return
+    last_ms, last_seq = stream.last_id() if stream is not None else (0, 0)
+
+    # Auto-generate full ID if entry_id_raw == "*"
+    if entry_id_raw == b'*':
+        # Get current time in milliseconds
+        ms = int(time.time() * 1000)
+        seq = 0
+        if ms <= last_ms:
+            # Same millisecond as the top item (or the clock went back)
+            ms, seq = last_ms, last_seq + 1
+    else:
+        # Handle previous cases: explicit ID or ms-*
+        parsed = parse_entry_id(entry_id_raw)
+        if parsed is None:
+            client.send(b'-ERR invalid ID format\r\n')
+            return
+        ms, seq = parsed
+
+        # Auto-generate sequence number if seq == '*'
+        if seq == b'*':
+            if stream is not None and last_ms == ms:
+                seq = last_seq + 1
+            else:
+                seq = 1 if ms == 0 else 0
+
+    # Check minimal allowed ID
+    if ms == 0 and seq == 0:
+        client.send(b'-ERR The ID specified in XADD must be greater than 0-0\r\n')
+        return
+
+    # Validate ID ordering if stream has entries
+    if stream is not None and (ms, seq) <= (last_ms, last_seq):
+        client.send(b'-ERR The ID specified in XADD is equal or smaller than the target stream top item\r\n')
+        return
+
+    # Create stream if missing
+    if stream is None:
+        stream = data_store[key] = Stream()
+
+    # Append new entry
+    stream.append((ms, seq), field_values)
+    entry_id = format_entry_id((ms, seq))
+    if trim is None:
+        propagate([b'XADD', key, entry_id] + field_values)
+    else:
+        # What ~ trims depends on the node layout, so replay the outcome exactly
+        stream.trim(**trim)
+        propagate([b'XADD', key, b'MAXLEN', b'=', b'%d' % len(stream), entry_id] + field_values)
+    signal_key_ready(key)
+    # Reply with ID as RESP bulk string
+    client.send(to_bulk_string(entry_id))
+
+def xtrim_command(client, command_parts):
+    """XTRIM key MAXLEN|MINID [=|~] threshold [LIMIT count]"""
+    key = command_parts[1]
+    if command_parts[2].upper() not in (b'MAXLEN', b'MINID'):
+        client.send(b'-ERR syntax error\r\n')
+        return
+    parsed = parse_trim_options(command_parts, 2)
+    if isinstance(parsed, bytes):
+        client.send(parsed)
+        return
+    trim, idx = parsed
+    if idx != len(command_parts):
+        client.send(b'-ERR syntax error\r\n')
+        return
+    stream = data_store.get(key)
+    if stream is not None and not is_stream(stream):
+        client.send(WRONGTYPE_ERROR)
+        return
+    removed = stream.trim(**trim) if stream is not None else 0
+    if removed:
+        propagate([b'XTRIM', key, b'MAXLEN', b'=', b'%d' % len(stream)])
+    client.send(b':%d\r\n' % removed)
+
+def xdel_command(client, command_parts):
+    """XDEL key id [id ...]"""
+    key = command_parts[1]
+    entry_ids = [parse_stream_id(arg) for arg in command_parts[2:]]
+    if None in entry_ids:
+        client.send(STREAM_ID_ERROR)
+        return
+    stream = data_store.get(key)
+    if stream is not None and not is_stream(stream):
+        client.send(WRONGTYPE_ERROR)
+        return
+    deleted = sum(stream.delete(entry_id) for entry_id in entry_ids) if stream is not None else 0
+    if deleted:
+        propagate(command_parts)
+    client.send(b':%d\r\n' % deleted)
+
+def xsetid_command(client, command_parts):
+    """XSETID key last-id: what the next XADD * must exceed (the AOF rewrite
+    uses it when the newest entries were deleted)"""
+    key = command_parts[1]
+    last_id = parse_stream_id(command_parts[2])
+    if last_id is None:
+        client.send(STREAM_ID_ERROR)
+        return
+    stream = data_store.get(key)
+    if stream is None:
+        client.send(b'-ERR no such key\r\n')
+        return
+    if not is_stream(stream):
+        client.send(WRONGTYPE_ERROR)
+        return
+    if len(stream) and last_id < stream.top_id():
+        client.send(b'-ERR The ID specified in XSETID is smaller than the target stream top item\r\n')
+        return
+    stream.last_entry_id = last_id
+    propagate(command_parts)
+    client.send(b'+OK\r\n')
+
+def blpop_command(client, command_parts):
+    keys = command_parts[1:-1]
     try:
-        # Connect to master
-        master_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        master_socket.connect((master_host, master_port))
-        
-        # Send PING command as RESP array
-        ping_command = b'*1\r\n$4\r\nPING\r\n'
-        master_socket.send(ping_command)
-        
-        # Read response (should be +PONG\r\n)
-        response = master_socket.recv(1024)
-        print(f"Master responded to PING: {response}")
-        
-        # Send REPLCONF listening-port <PORT>
-        port_str = str(replica_listening_port if replica_listening_port else 6379)  # Use the port we're listening on
-        replconf_port_command = f'*3\r\n$8\r\nREPLCONF\r\n$14\r\nlistening-port\r\n${len(port_str)}\r\n{port_str}\r\n'.encode()
-        master_socket.send(replconf_port_command)
-        
-        # Read response (should be +OK\r\n)
-        response = master_socket.recv(1024)
-        print(f"Master responded to REPLCONF listening-port: {response}")
-        
-        # Send REPLCONF capa psync2
-        replconf_capa_command = b'*3\r\n$8\r\nREPLCONF\r\n$4\r\ncapa\r\n$6\r\npsync2\r\n'
-        master_socket.send(replconf_capa_command)
-
-        psync_command = b'*3\r\n$5\r\nPSYNC\r\n$1\r\n?\r\n$2\r\n-1\r\n'
-        master_socket.send(psync_command)
-        
-        # Read response (should be +OK\r\n)
-        response = master_socket.recv(1024)
-        print(f"Master responded to REPLCONF capa: {response}")
-        
-        # Keep connection open for future stages
-        # For now, we'll close it, but in later stages we'll keep it
-        master_socket.close()
-        
-    except Exception as e:
-        print(f"Error connecting to master: {e}")
+        timeout = float(command_parts[-1])
+    except ValueError:
+        client.send(b'-ERR value is not a float\r\n')
+        return
+    if timeout < 0:
+        client.send(b'-ERR timeout is negative\r\n')
+        return
 
+    def retry():
+        # Pops from the first of the keys that holds a list. A key of another
+        # type before it is an error, like in Redis, rather than a key to skip
+        for key in keys:
+            values = data_store.get(key)
+            if values is None:
+                continue
+            if not is_list(values):
+                return WRONGTYPE_ERROR
+            value = values.popleft()
+            if not values:
+                delete_key(key)
+            propagate([b'LPOP', key])
+            return encode_resp_array([key, value])
+        return None
 
-def execute_command(command_parts):
-    """Execute a single command and return its response as a string"""
-    global server_role, master_replid, master_repl_offset
-    cmd = command_parts[0].upper()
-    
-    if cmd == 'SET' and len(command_parts) >= 3:
-        key, value = command_parts[1], command_parts[2]
-        expiry = None
-        if len(command_parts) >= 5 and command_parts[3].upper() == 'PX':
-            try:
-                px = int(command_parts[4])
-                expiry = int(time.time() * 1000) + px
-            except (ValueError, IndexError):
-                return '-ERR invalid PX value\r\n'
+    response = retry()
+    if response is not None:
+        client.send(response)
+    else:
+        return BlockedCommand(keys, timeout if timeout > 0 else None, retry, NULL_BULK_STRING)
 
-        data_store[key] = value
-        if expiry is not None:
-            expiry_store[key] = expiry
-        elif key in expiry_store:
-            del expiry_store[key]
-        return '+OK\r\n'
-    
-    elif cmd == 'INFO':
-        # Handle INFO command, specifically for replication section
-        if len(command_parts) == 1 or (len(command_parts) == 2 and command_parts[1].lower() == 'replication'):
-            # Return replication info with role and replication details
-            info_response = f"role:{server_role}\r\nmaster_replid:{master_replid}\r\nmaster_repl_offset:{master_repl_offset}"
-            return f"${len(info_response)}\r\n{info_response}\r\n"
-        else:
-            # For other sections, return empty for now
-            return f"$0\r\n\r\n"
-        
-    elif cmd == "INCR" and len(command_parts) == 2:
-        key = command_parts[1]
-        current_time = int(time.time() * 1000)
-        if key in expiry_store and current_time > expiry_store[key]:
-            del data_store[key]
-            del expiry_store[key]
-        
-        if key in data_store:
-            value = data_store[key]
-            try:
-                new_value = int(value) + 1
-                data_store[key] = str(new_value)
-                return f":{new_value}\r\n"
-            except (ValueError, TypeError):
-                return '-ERR value is not an integer or out of range\r\n'
-        else:   
-            data_store[key] = '1'
-            return ":1\r\n"
-    
-    elif cmd == 'GET' and len(command_parts) == 2:
-        key = command_parts[1]
-        current_time = int(time.time() * 1000)
-        if key in expiry_store and current_time > expiry_store[key]:
-            del data_store[key]
-            del expiry_store[key]
-            return '$-1\r\n'
-        elif key in data_store:
-            value = data_store[key]
-            return f"${len(value)}\r\n{value}\r\n"
+def get_command(client, command_parts):
+    value = data_store.get(command_parts[1])
+    if value is None:
+        response = b'$-1\r\n'
+    elif type(value) is int:
+        response = b'$%d\r\n%d\r\n' % (strings.length(value), value)
+    elif strings.is_string(value):
+        response = to_bulk_string(value)
+    else:
+        response = WRONGTYPE_ERROR
+    client.send(response)
+
+def command_command(client, command_parts):
+    """COMMAND [COUNT | LIST | INFO name ... | GETKEYS command arg ... | DOCS]"""
+    sub = command_parts[1].upper() if len(command_parts) > 1 else None
+    if sub is None:
+        client.send(encode_resp([command.info() for command in COMMAND_TABLE.values()]))
+    elif sub == b'COUNT' and len(command_parts) == 2:
+        client.send(b':%d\r\n' % len(COMMAND_TABLE))
+    elif sub == b'LIST' and len(command_parts) == 2:
+        client.send(encode_resp([name.lower() for name in COMMAND_TABLE]))
+    elif sub == b'INFO':
+        names = command_parts[2:] or list(COMMAND_TABLE)
+        client.send(encode_resp([COMMAND_TABLE[name.upper()].info() if name.upper() in COMMAND_TABLE else None
+                                 for name in names]))
+    elif sub == b'GETKEYS' and len(command_parts) > 2:
+        command = COMMAND_TABLE.get(command_parts[2].upper())
+        args = command_parts[2:]
+        if command is None:
+            client.send(b'-ERR Invalid command specified\r\n')
+        elif not command.check_arity(len(args)):
+            client.send(b'-ERR Invalid number of arguments specified for command\r\n')
+        elif not (keys := command.keys(args)):
+            client.send(b'-ERR The command has no key arguments\r\n')
         else:
-            return '$-1\r\n'
-    
-    # Add more commands as needed
-    elif cmd == 'RPUSH' and len(command_parts) >= 3:
-        key = command_parts[1]
-        values = command_parts[2:]
-        if key not in data_store:
-            data_store[key] = values[:]
-            length = len(data_store[key]) 
+            client.send(encode_resp(keys))
+    elif sub == b'DOCS':
+        # No docs are kept; redis-cli asks at startup and does without
+        client.send(b'*0\r\n')
+    else:
+        client.send(unknown_subcommand(command_parts))
+
+def unknown_command(command_parts):
+    args = b' '.join(b"'%s'" % arg for arg in command_parts[1:])
+    return b"-ERR unknown command '%s', with args beginning with: %s\r\n" % (command_parts[0], args)
+
+def wrong_number_of_arguments(command_parts):
+    return b"-ERR wrong number of arguments for '%s' command\r\n" % command_parts[0].lower()
+
+def unknown_subcommand(command_parts):
+    return b"-ERR unknown subcommand or wrong number of arguments for '%s'\r\n" % command_parts[1]
+
+def migrate_command_keys(command_parts):
+    # MIGRATE host port key|"" db timeout [COPY] [REPLACE] [KEYS key ...]
+    if len(command_parts) > 3 and command_parts[3]:
+        return [command_parts[3]]
+    for i, part in enumerate(command_parts[6:], 6):
+        if part.upper() == b'KEYS':
+            return command_parts[i + 1:]
+    return []
+
+def xread_command_keys(command_parts):
+    # XREAD [COUNT n] [BLOCK ms] STREAMS key [key ...] id [id ...]
+    for i, part in enumerate(command_parts):
+        if part.upper() == b'STREAMS':
+            rest = command_parts[i + 1:]
+            return rest[:len(rest) // 2]
+    return []
+
+class Command:
+    """An entry of COMMAND_TABLE.
+
+    arity counts the command name: N means exactly N arguments, -N at least
+    N. flags decide how the command is run:
+      write     changes the dataset: refused on replicas and when the AOF
+                can't be written, counts as a change for SAVE, sizes refreshed
+      readonly  only reads the dataset
+      denyoom   may grow memory: refused with -OOM over maxmemory
+      blocking  may wait for data, but times out at once inside a transaction
+      no-multi  refused inside MULTI
+      no-queue  runs at once inside MULTI instead of being queued
+      skip-slowlog  never logged in the slow log (EXEC: its commands are)
+    key_spec is (first, last, step), last counting back from the end when
+    negative, or a function of the arguments returning the keys.
+
+    The statistics are counted by call_command and process_command.
+    latency[n] counts the calls that took n bits' worth of microseconds,
+    under 2**n."""
+    __slots__ = ('name', 'handler', 'arity', 'flags', 'key_spec',
+                 'calls', 'usec', 'rejected_calls', 'failed_calls', 'latency')
+
+    def __init__(self, name, handler, arity, flags='', key_spec=None):
+        self.name = name
+        self.handler = handler
+        self.arity = arity
+        self.flags = frozenset(flags.split())
+        self.key_spec = key_spec
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.calls = 0
+        self.usec = 0
+        self.rejected_calls = 0
+        self.failed_calls = 0
+        self.latency = [0] * 64
+
+    def check_arity(self, argc):
+        return argc == self.arity if self.arity >= 0 else argc >= -self.arity
+
+    def keys(self, command_parts):
+        if self.key_spec is None:
+            return []
+        if callable(self.key_spec):
+            return self.key_spec(command_parts)
+        first, last, step = self.key_spec
+        if last < 0:
+            last += len(command_parts)
+        return command_parts[first:last + 1:step]
+
+    def info(self):
+        """The COMMAND INFO entry"""
+        flags = sorted(self.flags)
+        if callable(self.key_spec):
+            first, last, step = 0, 0, 0
+            flags.append('movablekeys')
         else:
-            if isinstance(data_store[key], list):
-                data_store[key].extend(values)
-                length = len(data_store[key])
-            else:
-                return '-ERR value is not a list\r\n'
-        return f':{length}\r\n'
-    
-    elif cmd == 'REPLCONF':
-        # Handle REPLCONF command from replica during handshake
-        # For this stage, we can ignore the arguments and just respond with OK
-        return '+OK\r\n'
-
-    elif cmd == 'PSYNC':
-        # Handle PSYNC command from replica during handshake
-        # Respond with FULLRESYNC and our replication ID and offset
-        return f'+FULLRESYNC {master_replid} {master_repl_offset}\r\n'
-    
-    # Default case - return error for unimplemented commands
-    return '-ERR unknown command\r\n'
+            first, last, step = self.key_spec or (0, 0, 0)
+        return [self.name.lower(), self.arity, flags, first, last, step, [], [], [], []]
+
+KEY = (1, 1, 1)
+
+# Every command the server knows, looked up by name once per command
+COMMAND_TABLE = {command.name.encode(): command for command in [
+    # Strings and keys
+    Command('GET', get_command, 2, 'readonly', KEY),
+    Command('SET', set_command, -3, 'write denyoom', KEY),
+    Command('INCR', incr_command, 2, 'write denyoom', KEY),
+    Command('DECR', incr_command, 2, 'write denyoom', KEY),
+    Command('INCRBY', incr_command, 3, 'write denyoom', KEY),
+    Command('DECRBY', incr_command, 3, 'write denyoom', KEY),
+    Command('INCRBYFLOAT', incrbyfloat_command, 3, 'write denyoom', KEY),
+    Command('APPEND', append_command, 3, 'write denyoom', KEY),
+    Command('GETRANGE', getrange_command, 4, 'readonly', KEY),
+    Command('SETRANGE', setrange_command, 4, 'write denyoom', KEY),
+    Command('STRLEN', strlen_command, 2, 'readonly', KEY),
+    Command('DEL', del_command, -2, 'write', (1, -1, 1)),
+    Command('UNLINK', del_command, -2, 'write', (1, -1, 1)),
+    Command('EXISTS', exists_command, -2, 'readonly', (1, -1, 1)),
+    Command('MGET', mget_command, -2, 'readonly', (1, -1, 1)),
+    Command('MSET', mset_command, -3, 'write denyoom', (1, -1, 2)),
+    Command('MSETNX', mset_command, -3, 'write denyoom', (1, -1, 2)),
+    Command('TYPE', type_command, 2, 'readonly', KEY),
+    Command('EXPIRE', expire_command, 3, 'write', KEY),
+    Command('PEXPIRE', expire_command, 3, 'write', KEY),
+    Command('EXPIREAT', expire_command, 3, 'write', KEY),
+    Command('PEXPIREAT', expire_command, 3, 'write', KEY),
+    Command('TTL', ttl_command, 2, 'readonly', KEY),
+    Command('PTTL', ttl_command, 2, 'readonly', KEY),
+    Command('PERSIST', persist_command, 2, 'write', KEY),
+    Command('MEMORY', memory_command, -2, 'readonly', (2, 2, 1)),
+    # Lists
+    Command('RPUSH', rpush_command, -3, 'write denyoom', KEY),
+    Command('LPUSH', lpush_command, -3, 'write denyoom', KEY),
+    Command('LPOP', pop_command, -2, 'write', KEY),
+    Command('RPOP', pop_command, -2, 'write', KEY),
+    Command('LLEN', llen_command, 2, 'readonly', KEY),
+    Command('LRANGE', lrange_command, 4, 'readonly', KEY),
+    Command('LINDEX', lindex_command, 3, 'readonly', KEY),
+    Command('LSET', lset_command, 4, 'write denyoom', KEY),
+    Command('LTRIM', ltrim_command, 4, 'write', KEY),
+    Command('LMOVE', lmove_command, 5, 'write denyoom', (1, 2, 1)),
+    Command('BLPOP', blpop_command, -3, 'write blocking', (1, -2, 1)),
+    # Streams
+    Command('XADD', xadd_command, -5, 'write denyoom', KEY),
+    Command('XTRIM', xtrim_command, -4, 'write', KEY),
+    Command('XDEL', xdel_command, -3, 'write', KEY),
+    Command('XSETID', xsetid_command, 3, 'write', KEY),
+    Command('XRANGE', xrange_command, -4, 'readonly', KEY),
+    Command('XREVRANGE', xrange_command, -4, 'readonly', KEY),
+    Command('XREAD', xread_command, -4, 'readonly blocking', xread_command_keys),
+    Command('XGROUP', xgroup_command, -4, 'write denyoom', (2, 2, 1)),
+    Command('XREADGROUP', xreadgroup_command, -7, 'write blocking', xread_command_keys),
+    Command('XACK', xack_command, -4, 'write', KEY),
+    Command('XPENDING', xpending_command, -3, 'readonly', KEY),
+    Command('XCLAIM', xclaim_command, -6, 'write', KEY),
+    Command('XAUTOCLAIM', xautoclaim_command, -6, 'write', KEY),
+    # Transactions
+    Command('MULTI', multi_command, 1, 'no-queue'),
+    Command('EXEC', exec_command, 1, 'no-queue skip-slowlog'),
+    Command('DISCARD', discard_command, 1, 'no-queue'),
+    # Connection and server
+    Command('PING', ping_command, -1),
+    Command('ECHO', echo_command, 2),
+    Command('INFO', info_command, -1),
+    Command('CONFIG', config_command, -2),
+    Command('SLOWLOG', slowlog_command, -2),
+    Command('LATENCY', latency_command, -2),
+    Command('COMMAND', command_command, -1),
+    Command('SAVE', save_command, 1, 'no-multi'),
+    Command('BGSAVE', bgsave_command, 1),
+    Command('LASTSAVE', lastsave_command, 1),
+    Command('BGREWRITEAOF', bgrewriteaof_command, 1),
+    # Replication
+    Command('REPLCONF', replconf_command, -1, 'no-multi'),
+    Command('PSYNC', psync_command, 3, 'no-multi'),
+    Command('WAIT', wait_command, 3, 'blocking'),
+    # Cluster
+    Command('CLUSTER', cluster_command, -2),
+    Command('ASKING', asking_command, 1),
+    Command('DUMP', dump_command, 2, 'readonly', KEY),
+    Command('RESTORE', restore_command, -4, 'write denyoom', KEY),
+    Command('RESTORE-ASKING', restore_command, -4, 'write denyoom', KEY),
+    Command('MIGRATE', migrate_command, -6, 'write', migrate_command_keys),
+]}
+
+
+def park_client(waiter):
+    """Queue a blocked client on its keys, unless what it waits for came in
+    while store_lock was released (then the reply is returned)"""
+    blocked = waiter.blocked
+    with store_lock:
+        reply = blocked.retry()
+        if reply is None:
+            register_waiter(waiter)
+            return None
+        after_write(blocked.keys)
+        if propagate_pending():
+            waiter.client.woff = master_repl_offset
+        return reply
+
+def unpark_client(waiter):
+    """The reply for a client that stops waiting: the one it was served if
+    that happened first, None if it timed out"""
+    with store_lock:
+        if waiter.reply is None:
+            unregister_waiter(waiter)
+        return waiter.reply
+
+def block_client_thread(client, blocked):
+    waiter = ThreadWaiter(client, blocked)
+    reply = park_client(waiter)
+    if reply is None:
+        waiter.event.wait(blocked.timeout)
+        reply = unpark_client(waiter)
+    client.send(reply if reply is not None else blocked.timed_out())
+
+def client_connected():
+    global connected_clients
+    with store_lock:
+        connected_clients += 1
+        stats['total_connections_received'] += 1
+
+def client_disconnected():
+    global connected_clients
+    with store_lock:
+        connected_clients -= 1
 
 def handle_client(connection, address):
-    global server_role, master_replid, master_repl_offset
-    in_multi = False
-    queued_commands = []
+    client = ThreadedClient(connection, address)
+    parser = RespParser()
+    client_connected()
     try:
         while True:
-            data = connection.recv(1024)
+            data = connection.recv(READ_BUFFER_SIZE)
             if not data:
                 break
-            command_parts = parse_resp(data)
-            if not command_parts:
-                continue
-            
-            cmd = command_parts[0].upper()
-            
-            # Handle MULTI command
-            if cmd == "MULTI" and len(command_parts) == 1:
-                in_multi = True
-                queued_commands.clear()  # Clear any previous queued commands
-                connection.sendall(b'+OK\r\n')
-                continue
-            
-            # Handle EXEC command
-            elif cmd == "EXEC" and len(command_parts) == 1:
-                if not in_multi:
-                    connection.sendall(b'-ERR EXEC without MULTI\r\n')
-                    continue
-                
-                # Execute all queued commands and collect their responses
-                responses = []
-                for queued_cmd_parts in queued_commands:
-                    response = execute_command(queued_cmd_parts)
-                    responses.append(response)
-                
-                # Send array of responses
-                if len(responses) == 0:
-                    connection.sendall(b'*0\r\n')
-                else:
-                    # Build RESP array response
-                    resp = f"*{len(responses)}\r\n"
-                    for response in responses:
-                        resp += response.decode() if isinstance(response, bytes) else response
-                    connection.sendall(resp.encode())
-                
-                in_multi = False
-                queued_commands.clear()
-                continue
-            elif cmd == "DISCARD" and len(command_parts) == 1:
-                if not in_multi:
-                    connection.sendall(b'-ERR DISCARD without MULTI\r\n')
-                    continue
-
-                    # Discard the transaction - clear queued commands and exit multi mode
-                in_multi = False
-                queued_commands.clear()
-                connection.sendall(b'+OK\r\n')
-                continue 
-            # If we're in a transaction, queue most commands instead of executing them
-            if in_multi:
-                # Commands that should be queued (not MULTI/EXEC which are handled above)
-                if cmd in ['SET', 'GET', 'INCR', 'RPUSH', 'LPUSH', 'LPOP', 'LLEN', 'LRANGE', 'XADD', 'XRANGE', 'XREAD', 'TYPE', 'BLPOP','INFO']:
-                    queued_commands.append(command_parts)
-                    connection.sendall(b'+QUEUED\r\n')
-                    continue
-                # Commands like PING, ECHO might still execute immediately, but for this task let's queue them too
-                else:
-                    queued_commands.append(command_parts)
-                    connection.sendall(b'+QUEUED\r\n')
-                    continue
-            # Handle DISCARD command
-         
-
-            # All other commands follow...
-            if cmd == 'SET' and len(command_parts) >= 3:
-                key, value = command_parts[1], command_parts[2]
-                expiry = None
-                if len(command_parts) >= 5 and command_parts[3].upper() == 'PX':
-                    try:
-                        px = int(command_parts[4])
-                        expiry = int(time.time() * 1000) + px
-                    except (ValueError, IndexError):
-                        connection.sendall(b'-ERR invalid PX value\r\n')
-                        continue
-
-                data_store[key] = value
-                if expiry is not None:
-                    expiry_store[key] = expiry
-                elif key in expiry_store:
-                    del expiry_store[key]
-                connection.sendall(b'+OK\r\n')   
-
-            
-            elif cmd == "INCR" and len(command_parts) == 2:
-                key = command_parts[1]
-                # Check if key exists and get current time for expiry check
-                current_time = int(time.time() * 1000)
-                if key in expiry_store and current_time > expiry_store[key]:
-                    del data_store[key]
-                    del expiry_store[key]
-                
-                if key in data_store:
-                    value = data_store[key]
-                    try:
-                        new_value = int(value) + 1
-                        data_store[key] = str(new_value)
-                        connection.sendall(f":{new_value}\r\n".encode())
-                    except (ValueError, TypeError):
-                        connection.sendall(b'-ERR value is not an integer or out of range\r\n')
-                else:   
-                    data_store[key] = '1'
-                    connection.sendall(b":1\r\n")
-
-            elif cmd == 'INFO':
-            # Handle INFO command, specifically for replication section
-                if len(command_parts) == 1 or (len(command_parts) == 2 and command_parts[1].lower() == 'replication'):
-            # Return replication info with role and replication details
-                    info_response = f"role:{server_role}\r\nmaster_replid:{master_replid}\r\nmaster_repl_offset:{master_repl_offset}"
-                    response = to_bulk_string(info_response)
-                    connection.sendall(response)
-                else:
-            # For other sections, return empty for now
-                    response = to_bulk_string("")
-                    connection.sendall(response)
-
-            elif cmd == "XRANGE" and len(command_parts) >= 4:
-                key = command_parts[1]
-                start_id_str = command_parts[2]
-                end_id_str = command_parts[3]
-
-                if start_id_str == '-':
-                    start_id_str = '0-0'
-
-                # Check stream existence
-                if key not in data_store or not is_stream(data_store[key]):
-                    # Return empty array if key missing or not a stream
-                    connection.sendall(b"*0\r\n")
-                    continue
-
-                stream = data_store[key]
-
-                # Parse IDs with proper default sequence numbers
-                start_ms, start_seq = parse_entry_id_with_default(start_id_str, default_seq_for_end=False)
-                end_ms, end_seq = parse_entry_id_with_default(end_id_str, default_seq_for_end=True)
-
-                # Build the result entries list
-                result_entries = []
-
-                # Iterate over stream entries (assumed sorted by insertion)
-                for entry_id, fields in stream:
-                    # Parse current entry id
-                    entry_ms, entry_seq = parse_entry_id(entry_id)
-                    # Compare with start and end (inclusive)
-                    # Check: start_id <= entry_id <= end_id
-                    # Use (ms, seq) tuple comparisons
-                    if (entry_ms > end_ms) or (entry_ms == end_ms and entry_seq > end_seq):
-                        # Passed end of range, stop early (assuming sorted stream)
-                        break
-                    if (entry_ms > start_ms) or (entry_ms == start_ms and entry_seq >= start_seq):
-                        # Within range, add
-                        result_entries.append((entry_id, fields))
-
-                # Encode and send response
-                response = encode_resp_nested_array(result_entries)
-                connection.sendall(response)
-
-            elif cmd == 'RPUSH' and len(command_parts) >= 3:
-                key = command_parts[1]
-                values = command_parts[2:]
-                if key not in data_store:
-                    data_store[key] = values[:]
-                    length = len(data_store[key]) 
-                else:
-                    if isinstance(data_store[key], list):
-                        data_store[key].extend(values)
-                        length = len(data_store[key])
-                    else:
-                        connection.sendall(b'-ERR value is not a list\r\n')
-                        continue
-                    
-                connection.sendall(f':{length}\r\n'.encode())
-                while waiting_clients[key] and isinstance(data_store.get(key), list) and data_store[key]:
-                    blocked_connection, blocked_key, event = waiting_clients[key].pop(0)
-                    value = data_store[key].pop(0)
-                    response = encode_resp_array([key, value])
-                    try:
-                        blocked_connection.sendall(response)
-                    except:
-                        pass
-                    event.set()  # Notify the waiting client that data is available
-
-            elif cmd == "TYPE" and len(command_parts) == 2:
-                key = command_parts[1]
-                if key not in data_store:
-                    connection.sendall(b'+none\r\n')
-                else:
-                    value = data_store[key]
-                    if is_stream(value):
-                        connection.sendall(b'+stream\r\n')
-                    elif isinstance(value, list):
-                        connection.sendall(b'+list\r\n')
-                    else:
-                        connection.sendall(b'+string\r\n')
-
-            elif cmd == 'ECHO' and len(command_parts) == 2:
-                message = command_parts[1]
-                response = to_bulk_string(message)
-                connection.sendall(response)
-                
-            elif cmd == 'PING':
-                connection.sendall(b'+PONG\r\n')
-
-            elif cmd=='REPLCONF':
-                connection.sendall(b'+OK\r\n')
-
-            elif cmd == 'PSYNC':
-                # Handle PSYNC command from replica during handshake
-                # Respond with FULLRESYNC and our replication ID and offset
-                response= f'+FULLRESYNC {master_replid} {master_repl_offset}\r\n'
-                connection.sendall(response.encode())
-
-            elif cmd == 'LRANGE' and len(command_parts) == 4:
-                key = command_parts[1]
-                start = int(command_parts[2])
-                end = int(command_parts[3])
-
-                if key not in data_store or not isinstance(data_store[key], list):
-                    connection.sendall(b"*0\r\n")
-                    continue
-
-                lst = data_store[key]
-                if end < 0:
-                    end = len(lst) + end
-                result = lst[start:end + 1] if end >= start else []
-
-                response = f"*{len(result)}\r\n"
-                for item in result:
-                    response += f"${len(item)}\r\n{item}\r\n"
-                connection.sendall(response.encode())
-                
-            elif cmd == "LPUSH":
-                key = command_parts[1]
-                values = command_parts[2:]
-                if key not in data_store:
-                    data_store[key] = []
-                if not isinstance(data_store[key], list):
-                    connection.sendall(b'-ERR value is not a list\r\n')
-                    continue
-                for val in values:
-                    data_store[key].insert(0, val)
-                connection.sendall(f':{len(data_store[key])}\r\n'.encode())
-
-            elif cmd == 'XREAD':
-                block = None # None means no blocking, 0 means block forever
-                idx = 1
-
-                # Detect BLOCK option if present
-                if len(command_parts) > 2 and command_parts[1].upper() == 'BLOCK':
-                    try:
-                        block = int(command_parts[2])
-                        idx = 3
-                    except ValueError:
-                        connection.sendall(b'-ERR invalid BLOCK timeout\r\n')
-                        continue
-
-                # Next token must be 'STREAMS'
-                if len(command_parts) <= idx or command_parts[idx].upper() != 'STREAMS':
-                    connection.sendall(b'-ERR syntax error\r\n')
-                    continue
-
-                idx += 1
-                num_streams = (len(command_parts) - idx) // 2
-                keys = command_parts[idx:idx + num_streams]
-                last_ids = command_parts[idx + num_streams: idx + num_streams * 2]
-
-                if len(keys) != len(last_ids):
-                    connection.sendall(b'-ERR number of streams and IDs do not match\r\n')
-                    continue
-
-                # Resolve '$' IDs at the start of XREAD
-                resolved_last_ids = []
-                for stream_key, last_id_str in zip(keys, last_ids):
-                    if last_id_str == '$':
-                        if stream_key in data_store and is_stream(data_store[stream_key]):
-                            stream = data_store[stream_key]
-                            if stream:
-                                # Use the last entry ID in the stream at this moment
-                                resolved_last_ids.append(stream[-1][0])
-                            else:
-                                # Empty stream
-                                resolved_last_ids.append('0-0')
-                        else:
-                            # Stream doesn't exist
-                            resolved_last_ids.append('0-0')
-                    else:
-                        resolved_last_ids.append(last_id_str)
-
-                def check_new_entries():
-                    results = []
-                    for stream_key, last_id_str in zip(keys, resolved_last_ids):
-                        if stream_key not in data_store or not is_stream(data_store[stream_key]):
-                            results.append((stream_key, []))
-                            continue
-                        stream = data_store[stream_key]
-
-                        parsed = parse_entry_id(last_id_str)
-                        if parsed is None:
-                            connection.sendall(b'-ERR invalid ID format\r\n')
-                            return None
-                        last_ms, last_seq = parsed
-                        entries = []
-                        for entry_id, fields in stream:
-                            ms, seq = parse_entry_id(entry_id)
-                            if (ms > last_ms) or (ms == last_ms and seq > last_seq):
-                                entries.append((entry_id, fields))
-                        results.append((stream_key, entries))
-                    return results
-
-                # Check for new entries immediately
-                resp_data = check_new_entries()
-                if resp_data is None:
-                    continue  # error already sent
-
-                # If any entries found or no blocking requested, send response immediately
-                if any(len(entries) > 0 for _, entries in resp_data) or block is None:
-                    if all(len(entries) == 0 for _, entries in resp_data):
-                        # No entries found and no blocking: respond with empty array
-                        connection.sendall(b'*0\r\n')
-                    else:
-                        resp = f"*{len(resp_data)}\r\n"
-                        for stream_key, entries in resp_data:
-                            resp += f"*2\r\n"
-                            resp += f"${len(stream_key)}\r\n{stream_key}\r\n"
-                            resp += f"*{len(entries)}\r\n"
-                            for entry_id, fields in entries:
-                                resp += "*2\r\n"
-                                resp += f"${len(entry_id)}\r\n{entry_id}\r\n"
-                                resp += f"*{len(fields)*2}\r\n"
-                                for field, value in fields.items():
-                                    resp += f"${len(field)}\r\n{field}\r\n"
-                                    resp += f"${len(value)}\r\n{value}\r\n"
-                        connection.sendall(resp.encode())
-                else:
-                    # Blocking requested
-                    start_time = time.time()
-                    timeout_sec = block / 1000.0 if block > 0 else None
-
-                    while True:
-                        # Wait for notifications on any of the monitored streams
-                        notified = False
-                        for key in keys:
-                            cond = stream_conditions[key]
-                            with cond:
-                                if block == 0:
-                                    # Wait infinitely
-                                    cond.wait()
-                                    notified = True
-                                    break
-                                else:
-                                    # Wait with timeout
-                                    remaining = timeout_sec - (time.time() - start_time) if timeout_sec else 0
-                                    if remaining <= 0:
-                                        break
-                                    if cond.wait(remaining):
-                                        notified = True
-                                        break
-
-                        # Check timeout
-                        if block > 0:
-                            elapsed = time.time() - start_time
-                            if elapsed >= timeout_sec:
-                                # Timeout expired, no new entries
-                                connection.sendall(b"$-1\r\n")
-                                break
-
-                        # After waking (or timeout check), check if new entries arrived
-                        resp_data = check_new_entries()
-                        if resp_data is None:
-                            break  # error was sent
-
-                        if any(len(entries) > 0 for _, entries in resp_data):
-                            # Send new entries response
-                            resp = f"*{len(resp_data)}\r\n"
-                            for stream_key, entries in resp_data:
-                                resp += f"*2\r\n"
-                                resp += f"${len(stream_key)}\r\n{stream_key}\r\n"
-                                resp += f"*{len(entries)}\r\n"
-                                for entry_id, fields in entries:
-                                    resp += "*2\r\n"
-                                    resp += f"${len(entry_id)}\r\n{entry_id}\r\n"
-                                    resp += f"*{len(fields)*2}\r\n"
-                                    for field, value in fields.items():
-                                        resp += f"${len(field)}\r\n{field}\r\n"
-                                        resp += f"${len(value)}\r\n{value}\r\n"
-                            connection.sendall(resp.encode())
-                            break
-
-                        # If not notified and no timeout, something went wrong
-                        if not notified and block == 0:
-                            continue  # Keep waiting for infinite block
-
-            elif cmd == 'LLEN' and len(command_parts) == 2:
-                key = command_parts[1]
-                if key not in data_store:
-                    connection.sendall(b':0\r\n')
-                    continue
-                elif not isinstance(data_store[key], list):
-                    connection.sendall(b'-ERR value is not a list\r\n')
-                else:
-                    connection.sendall(f':{len(data_store[key])}\r\n'.encode())
-            
-            elif cmd == 'LPOP':
-                if len(command_parts) not in (2, 3):
-                    connection.sendall(b'-ERR wrong number of arguments for \'lpop\' command\r\n')
-                    continue
-
-                key = command_parts[1]
-                count = 1
-                if len(command_parts) == 3:
-                    try:
-                        count = int(command_parts[2])
-                        if count < 0:
-                            raise ValueError
-                    except ValueError:
-                        connection.sendall(b'-ERR value is not an integer or out of range\r\n')
-                        continue
-                        
-                if key not in data_store:
-                    connection.sendall(b'*0\r\n')
-                    continue
-                    
-                values = data_store[key]
-                if not isinstance(values, list):
-                    connection.sendall(b'-ERR value is not a list\r\n')
-                    continue
-                    
-                popped = []
-                while len(popped) < count and values:
-                    popped.append(values.pop(0))
-                    
-                if len(command_parts) == 2:
-                    if popped:
-                        connection.sendall(to_bulk_string(popped[0]))
-                    else:
-                        connection.sendall(NULL_BULK_STRING)
-                else:
-                    connection.sendall(encode_resp_array(popped))
-
-            elif cmd == "XADD":
-                if len(command_parts) < 5 or (len(command_parts)-3) % 2 != 0:
-                    connection.sendall(b'-ERR wrong number of arguments for XADD\r\n')
-                    continue
-                
-                key = command_parts[1]
-                entry_id_raw = command_parts[2]
-                field_values = command_parts[3:]
-
-                # Auto-generate full ID if entry_id_raw == "*"
-                if entry_id_raw == '*':
-                    # Get current time in milliseconds
-                    ms = int(time.time() * 1000)
-                    seq = 0
-
-                    if key in data_store and is_stream(data_store[key]):
-                        stream = data_store[key]
-                        # Find max sequence number for entries with current millisecond time
-                        last_seq = -1
-                        for last_entry_id, _ in reversed(stream):
-                            last_ms, last_seq_candidate = parse_entry_id(last_entry_id)
-                            if last_ms == ms:
-                                if last_seq_candidate > last_seq:
-                                    last_seq = last_seq_candidate
-                            elif last_ms < ms:
-                                break
-                        if last_seq >= 0:
-                            seq = last_seq + 1
-
-                    entry_id = f"{ms}-{seq}"
-                else:
-                    # Handle previous cases: explicit ID or ms-*
-                    parsed = parse_entry_id(entry_id_raw)
-                    if parsed is None:
-                        connection.sendall(b'-ERR invalid ID format\r\n')
-                        continue
-                    ms, seq = parsed
-
-                    # Auto-generate sequence number if seq == '*'
-                    if seq == '*':
-                        last_seq = -1
-                        if key in data_store and is_stream(data_store[key]):
-                            stream = data_store[key]
-                            for last_entry_id, _ in reversed(stream):
-                                last_ms, last_seq_candidate = parse_entry_id(last_entry_id)
-                                if last_ms == ms:
-                                    if last_seq_candidate > last_seq:
-                                        last_seq = last_seq_candidate
-                                elif last_ms < ms:
-                                    break
-                        if ms == 0:
-                            new_seq = 1
-                        else:
-                            new_seq = last_seq + 1 if last_seq >= 0 else 0
-
-                        entry_id = f"{ms}-{new_seq}"
-                        ms = int(ms)
-                        seq = new_seq
-                    else:
-                        entry_id = entry_id_raw
-                        if not (isinstance(seq, int)):
-                            connection.sendall(b'-ERR invalid ID format\r\n')
-                            continue
-
-                # Check minimal allowed ID
-                if ms == 0 and seq == 0:
-                    connection.sendall(b'-ERR The ID specified in XADD must be greater than 0-0\r\n')
-                    continue
-
-                # Parse fields into dict
-                fields = {}
-                for i in range(0, len(field_values), 2):
-                    fields[field_values[i]] = field_values[i+1]
-
-                # Create stream if missing
-                if key not in data_store:
-                    data_store[key] = []
-
-                value = data_store[key]
-                if not is_stream(value):
-                    connection.sendall(b'-ERR key exists and is not a stream\r\n')
-                    continue
-
-                # Validate ID ordering if stream has entries
-                if value:
-                    last_id, _ = value[-1]
-                    last_ms, last_seq = parse_entry_id(last_id)
-                    if not ((ms > last_ms) or (ms == last_ms and seq > last_seq)):
-                        connection.sendall(b'-ERR The ID specified in XADD is equal or smaller than the target stream top item\r\n')
-                        continue
-
-                # Append new entry
-                data_store[key].append((entry_id, fields))
-                if key in stream_conditions:
-                    with stream_conditions[key]:
-                        stream_conditions[key].notify_all()
-                # Reply with ID as RESP bulk string
-                resp = f"${len(entry_id)}\r\n{entry_id}\r\n".encode()
-                connection.sendall(resp)
-
-            elif cmd == 'BLPOP' and len(command_parts) == 3:
-                key = command_parts[1]
-                try:
-                    timeout = float(command_parts[2])
-                except ValueError:
-                    connection.sendall(b'-ERR value is not a float\r\n')
-                    continue
-                        
-                if key in data_store and isinstance(data_store[key], list) and data_store[key]:
-                    value = data_store[key].pop(0)
-                    response = encode_resp_array([key, value])
-                    connection.sendall(response)
-                else:
-                    event = threading.Event()
-                    waiting_clients[key].append((connection, key, event))
-                    if timeout == 0:
-                        event.wait() 
-                    else: 
-                        if not event.wait(timeout):
-                            try:
-                                waiting_clients[key].remove((connection, key, event))
-                            except ValueError:
-                                pass
-                            try:
-                                connection.sendall(NULL_BULK_STRING)
-                            except:
-                                pass
-
-            elif cmd == 'GET' and len(command_parts) == 2:
-                key = command_parts[1]
-                current_time = int(time.time() * 1000)
-                if key in expiry_store and current_time > expiry_store[key]:
-                    del data_store[key]
-                    del expiry_store[key]
-                    response = NULL_BULK_STRING
-                elif key in data_store:
-                    response = to_bulk_string(data_store[key])
-                else:
-                    response = b'$-1\r\n'
-                connection.sendall(response)
-                
+            parser.feed(data)
+            # Run every complete command of the read, a pipelined batch included
+            for command_parts in parser:
+                with store_lock:
+                    blocked = process_command(client, command_parts)
+                if blocked is not None:
+                    # Replies to the commands before this one go out first
+                    flush_append_only_file()
+                    client.flush()
+                    block_client_thread(client, blocked)
+                if client.close_asap:
+                    break
+            if client.close_asap:
+                break
+            flush_append_only_file()
+            client.flush()
+
+    except ProtocolError as e:
+        client.send(f"-ERR Protocol error: {e}\r\n".encode())
+        client.flush()
     except Exception as e:
         print(f"Error handling client {address}: {e}")
     finally:
+        client_disconnected()
+        client.close_peer_links()
+        if client.is_replica:
+            with store_lock:
+                replicas.remove(client)
+            client.stop_replication()
+            print(f"Connection with replica {address} lost")
         connection.close()
 
+async def block_client_async(client, blocked):
+    # store_lock (in park_client) because a replica's link thread applies writes concurrently
+    waiter = AsyncioWaiter(client, blocked, asyncio.get_running_loop())
+    reply = park_client(waiter)
+    if reply is None:
+        try:
+            await asyncio.wait_for(waiter.event.wait(), blocked.timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            reply = unpark_client(waiter)
+    client.send(reply if reply is not None else blocked.timed_out())
+
+async def handle_client_async(reader, writer):
+    address = writer.get_extra_info('peername')
+    print(f"Accepted connection from {address}")
+    client = AsyncioClient(writer, address)
+    parser = RespParser()
+    client_connected()
+    try:
+        while True:
+            data = await reader.read(READ_BUFFER_SIZE)
+            if not data:
+                break
+            parser.feed(data)
+            for command_parts in parser:
+                # One thread runs all clients, so store_lock is only ever contended
+                # by a replica's link thread (and keeps process_command's contract)
+                with store_lock:
+                    blocked = process_command(client, command_parts)
+                if blocked is not None:
+                    if client.forwarded:
+                        await client.resolve_forwarded()
+                    flush_append_only_file()
+                    client.flush()
+                    await block_client_async(client, blocked)
+                if client.close_asap:
+                    break
+            if client.close_asap:
+                break
+            if client.forwarded:
+                await client.resolve_forwarded()
+            flush_append_only_file()
+            client.flush()
+            if client.close_asap:
+                break
+            await writer.drain()
+    except ProtocolError as e:
+        if client.forwarded:
+            await client.resolve_forwarded()
+        client.send(f"-ERR Protocol error: {e}\r\n".encode())
+        client.flush()
+    except Exception as e:
+        print(f"Error handling client {address}: {e}")
+    finally:
+        client_disconnected()
+        client.close_peer_links()
+        if client.is_replica:
+            with store_lock:
+                replicas.remove(client)
+            client.stop_replication()
+            print(f"Connection with replica {address} lost")
+        if client.close_asap:
+            # Don't bother writing out what the client failed to keep up with
+            writer.transport.abort()
+        else:
+            writer.close()
+
+async def serve_asyncio(port, peer_listener=None):
+    server = await asyncio.start_server(handle_client_async, "localhost", port, reuse_port=True)
+    cron = asyncio.create_task(cron_task())
+    if peer_listener is not None:
+        # Commands forwarded by the other workers
+        await asyncio.start_unix_server(handle_client_async, sock=peer_listener)
+    print(f"Server is listening on port {port} (asyncio)")
+    async with server:
+        await server.serve_forever()
+
+def accept_peer_connections(listener):
+    # Worker mode, threads: a thread per worker connection, like any client
+    while True:
+        connection, _ = listener.accept()
+        threading.Thread(target=handle_client, args=(connection, f"worker link {worker_id}"), daemon=True).start()
+
 def main():
-    global server_role, master_host, master_port
+    global server_role, master_host, master_port, io_mode, client_output_buffer_limit
+    global maxmemory, maxmemory_policy, maxmemory_samples
+    global rdb_dir, rdb_filename, save_params, repl_backlog_size
+    global repl_diskless_sync, repl_diskless_sync_delay
+    global appendonly, appendfilename, appendfsync, auto_aof_rewrite_percentage, auto_aof_rewrite_min_size
+    global worker_count, worker_id, worker_socket_dir, worker_parent_pid
+    global cluster_enabled, cluster_state, cluster_config_file, cluster_announce_ip
+    global stream_entry_cache, slowlog_log_slower_than, slowlog_max_len
     
     port = 6379  # Default port
 
@@ -895,18 +4110,238 @@ def main():
             server_role = "slave"
             i += 2
 
+        elif arg == '--io-mode':
+            if i + 1 >= len(args) or args[i + 1] not in ('threads', 'asyncio'):
+                print("Error: --io-mode must be 'threads' or 'asyncio'")
+                sys.exit(1)
+            io_mode = args[i + 1]
+            i += 2
+
+        elif arg == '--maxmemory':
+            try:
+                maxmemory = parse_memory(args[i + 1])
+            except (IndexError, ValueError):
+                print("Error: --maxmemory requires a size, e.g. 100mb")
+                sys.exit(1)
+            i += 2
+
+        elif arg == '--maxmemory-policy':
+            if i + 1 >= len(args) or args[i + 1] not in MAXMEMORY_POLICIES:
+                print(f"Error: --maxmemory-policy must be one of {', '.join(MAXMEMORY_POLICIES)}")
+                sys.exit(1)
+            maxmemory_policy = args[i + 1]
+            i += 2
+
+        elif arg == '--maxmemory-samples':
+            try:
+                maxmemory_samples = max(int(args[i + 1]), 1)
+            except (IndexError, ValueError):
+                print("Error: --maxmemory-samples requires a number")
+                sys.exit(1)
+            i += 2
+
+        elif arg in ('--dir', '--dbfilename'):
+            if i + 1 >= len(args):
+                print(f"Error: {arg} requires an argument")
+                sys.exit(1)
+            if arg == '--dir':
+                rdb_dir = args[i + 1]
+            else:
+                rdb_filename = args[i + 1]
+            i += 2
+
+        elif arg == '--save':
+            # "<seconds> <changes> [<seconds> <changes> ...]", "" disables
+            numbers = args[i + 1].split() if i + 1 < len(args) else None
+            try:
+                if numbers is None or len(numbers) % 2:
+                    raise ValueError
+                save_params = [(int(numbers[j]), int(numbers[j + 1])) for j in range(0, len(numbers), 2)]
+            except ValueError:
+                print("Error: --save requires '<seconds> <changes> ...'")
+                sys.exit(1)
+            i += 2
+
+        elif arg == '--appendonly':
+            if i + 1 >= len(args) or args[i + 1] not in ('yes', 'no'):
+                print("Error: --appendonly must be 'yes' or 'no'")
+                sys.exit(1)
+            appendonly = args[i + 1] == 'yes'
+            i += 2
+
+        elif arg == '--appendfsync':
+            if i + 1 >= len(args) or args[i + 1] not in aof.APPENDFSYNC_POLICIES:
+                print(f"Error: --appendfsync must be one of {', '.join(aof.APPENDFSYNC_POLICIES)}")
+                sys.exit(1)
+            appendfsync = args[i + 1]
+            i += 2
+
+        elif arg == '--appendfilename':
+            if i + 1 >= len(args):
+                print("Error: --appendfilename requires an argument")
+                sys.exit(1)
+            appendfilename = args[i + 1]
+            i += 2
+
+        elif arg == '--auto-aof-rewrite-percentage':
+            try:
+                auto_aof_rewrite_percentage = max(int(args[i + 1]), 0)
+            except (IndexError, ValueError):
+                print("Error: --auto-aof-rewrite-percentage requires a number (0 disables)")
+                sys.exit(1)
+            i += 2
+
+        elif arg == '--auto-aof-rewrite-min-size':
+            try:
+                auto_aof_rewrite_min_size = parse_memory(args[i + 1])
+            except (IndexError, ValueError):
+                print("Error: --auto-aof-rewrite-min-size requires a size, e.g. 64mb")
+                sys.exit(1)
+            i += 2
+
+        elif arg == '--repl-backlog-size':
+            try:
+                repl_backlog_size = max(parse_memory(args[i + 1]), 1)
+            except (IndexError, ValueError):
+                print("Error: --repl-backlog-size requires a size, e.g. 1mb")
+                sys.exit(1)
+            i += 2
+
+        elif arg == '--repl-diskless-sync':
+            if i + 1 >= len(args) or args[i + 1] not in ('yes', 'no'):
+                print("Error: --repl-diskless-sync must be 'yes' or 'no'")
+                sys.exit(1)
+            repl_diskless_sync = args[i + 1] == 'yes'
+            i += 2
+
+        elif arg == '--repl-diskless-sync-delay':
+            try:
+                repl_diskless_sync_delay = max(int(args[i + 1]), 0)
+            except (IndexError, ValueError):
+                print("Error: --repl-diskless-sync-delay requires a number of seconds")
+                sys.exit(1)
+            i += 2
+
+        elif arg == '--stream-entry-cache':
+            if i + 1 >= len(args) or args[i + 1] not in ('yes', 'no'):
+                print("Error: --stream-entry-cache must be 'yes' or 'no'")
+                sys.exit(1)
+            stream_entry_cache = args[i + 1] == 'yes'
+            i += 2
+
+        elif arg in ('--slowlog-log-slower-than', '--slowlog-max-len'):
+            try:
+                value = int(args[i + 1])
+            except (IndexError, ValueError):
+                print(f"Error: {arg} requires a number")
+                sys.exit(1)
+            if arg == '--slowlog-log-slower-than':
+                slowlog_log_slower_than = value
+            else:
+                slowlog_max_len = max(value, 0)
+            i += 2
+
+        elif arg == '--workers':
+            try:
+                worker_count = int(args[i + 1])
+                if worker_count < 1:
+                    raise ValueError
+            except (IndexError, ValueError):
+                print("Error: --workers requires a number of processes")
+                sys.exit(1)
+            i += 2
+
+        elif arg == '--cluster-enabled':
+            if i + 1 >= len(args) or args[i + 1] not in ('yes', 'no'):
+                print("Error: --cluster-enabled must be 'yes' or 'no'")
+                sys.exit(1)
+            cluster_enabled = args[i + 1] == 'yes'
+            i += 2
+
+        elif arg in ('--cluster-config-file', '--cluster-announce-ip'):
+            if i + 1 >= len(args):
+                print(f"Error: {arg} requires an argument")
+                sys.exit(1)
+            if arg == '--cluster-config-file':
+                cluster_config_file = args[i + 1]
+            else:
+                cluster_announce_ip = args[i + 1]
+            i += 2
+
+        elif arg == '--client-output-buffer-limit':
+            # "<hard> <soft> <soft seconds>", e.g. "256mb 64mb 60"
+            limit_parts = args[i + 1].split() if i + 1 < len(args) else []
+            try:
+                hard, soft, seconds = limit_parts
+                client_output_buffer_limit = (parse_memory(hard), parse_memory(soft), int(seconds))
+            except ValueError:
+                print("Error: --client-output-buffer-limit requires '<hard> <soft> <seconds>'")
+                sys.exit(1)
+            i += 2
+
         else:
             print(f"Error: unknown argument '{arg}'")
             sys.exit(1)
 
-    server_socket = socket.create_server(("localhost", port), reuse_port=True)
-    server_socket.listen()
-    print(f"Server is listening on port {port}")
-
     if server_role=="slave":
         global replica_listening_port
         replica_listening_port=port
-        connect_to_master()
+
+    if cluster_enabled:
+        if server_role == "slave" or worker_count > 1:
+            print("Error: --cluster-enabled can't be used with --replicaof or --workers")
+            sys.exit(1)
+        cluster_state = cluster.ClusterState(cluster_announce_ip, port)
+        try:
+            if cluster_state.load(cluster_config_path()):
+                print(f"Cluster config loaded, node ID {cluster_state.myself.node_id}")
+            else:
+                print(f"No cluster config found, new node ID {cluster_state.myself.node_id}")
+            cluster_state.save(cluster_config_path())
+        except (OSError, ValueError) as e:
+            print(f"Error with the cluster config file {cluster_config_path()}: {e}")
+            sys.exit(1)
+
+    peer_listener = None
+    if worker_count > 1:
+        if server_role == "slave":
+            print("Error: --workers can't be used with --replicaof")
+            sys.exit(1)
+        # Only the workers return from here
+        worker_parent_pid = os.getpid()
+        worker_id, worker_socket_dir, peer_listener = workers.start_workers(worker_count)
+        rdb_filename = workers.worker_filename(rdb_filename, worker_id)
+        appendfilename = workers.worker_filename(appendfilename, worker_id)
+
+    try:
+        # The log is at least as recent as the snapshot, so it wins when it's on
+        if not (appendonly and aof_load()):
+            rdb_load()
+        if appendonly:
+            open_append_only_file()
+    except (OSError, rdb.RdbError) as e:
+        print(f"Error loading the data set: {e}")
+        sys.exit(1)
+    except ProtocolError as e:
+        print(f"Bad file format reading the append only file: {e}")
+        sys.exit(1)
+
+    if server_role == "slave":
+        threading.Thread(target=master_link_thread, daemon=True).start()
+    if cluster_enabled:
+        threading.Thread(target=cluster_poll_thread, daemon=True).start()
+
+    if io_mode == 'asyncio':
+        asyncio.run(serve_asyncio(port, peer_listener))
+        return
+
+    threading.Thread(target=cron_thread, daemon=True).start()
+    if peer_listener is not None:
+        threading.Thread(target=accept_peer_connections, args=(peer_listener,), daemon=True).start()
+
+    server_socket = socket.create_server(("localhost", port), reuse_port=True)
+    server_socket.listen()
+    print(f"Server is listening on port {port}")
 
     while True:
         connection, address = server_socket.accept()
@@ -0,0 +1,147 @@
+import sys
+from collections import deque
+
+# Items per chunk, big enough that per-chunk overhead stays small and small
+# enough that inserting at the ends never shifts much
+QUICKLIST_CHUNK_SIZE = 128
+
+
+class QuickList:
+    """List value with O(1) push/pop at both ends.
+
+    Items are kept in a deque of small Python lists (chunks). Both ends only
+    ever touch the first or last chunk, and positional access (LINDEX, LSET,
+    LRANGE, LTRIM) skips whole chunks from the closer end, so it costs
+    O(n / QUICKLIST_CHUNK_SIZE) to find the start and then the items returned.
+    """
+
+    def __init__(self, items=()):
+        self.chunks = deque()
+        self.length = 0
+        self.item_bytes = 0  # sys.getsizeof of the items, kept up to date for memory_usage
+        for item in items:
+            self.append(item)
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            yield from chunk
+
+    def append(self, item):
+        chunks = self.chunks
+        if not chunks or len(chunks[-1]) >= QUICKLIST_CHUNK_SIZE:
+            chunks.append([])
+        chunks[-1].append(item)
+        self.length += 1
+        self.item_bytes += sys.getsizeof(item)
+
+    def appendleft(self, item):
+        # insert(0) shifts at most QUICKLIST_CHUNK_SIZE items
+        chunks = self.chunks
+        if not chunks or len(chunks[0]) >= QUICKLIST_CHUNK_SIZE:
+            chunks.appendleft([])
+        chunks[0].insert(0, item)
+        self.length += 1
+        self.item_bytes += sys.getsizeof(item)
+
+    def pop(self):
+        chunk = self.chunks[-1]
+        item = chunk.pop()
+        if not chunk:
+            self.chunks.pop()
+        self.length -= 1
+        self.item_bytes -= sys.getsizeof(item)
+        return item
+
+    def popleft(self):
+        chunk = self.chunks[0]
+        item = chunk.pop(0)
+        if not chunk:
+            self.chunks.popleft()
+        self.length -= 1
+        self.item_bytes -= sys.getsizeof(item)
+        return item
+
+    def _locate(self, index):
+        """(chunk, offset) of a non-negative index, walking from the closer end"""
+        if index < self.length // 2:
+            for chunk in self.chunks:
+                if index < len(chunk):
+                    return chunk, index
+                index -= len(chunk)
+        else:
+            index = self.length - 1 - index
+            for chunk in reversed(self.chunks):
+                if index < len(chunk):
+                    return chunk, len(chunk) - 1 - index
+                index -= len(chunk)
+        raise IndexError(index)
+
+    def _normalize(self, index):
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError(index)
+        return index
+
+    def __getitem__(self, index):
+        chunk, offset = self._locate(self._normalize(index))
+        return chunk[offset]
+
+    def __setitem__(self, index, item):
+        chunk, offset = self._locate(self._normalize(index))
+        self.item_bytes += sys.getsizeof(item) - sys.getsizeof(chunk[offset])
+        chunk[offset] = item
+
+    def range(self, start, stop):
+        """Items start..stop-1 (non-negative, already clamped by the caller)"""
+        result = []
+        if start >= stop:
+            return result
+        skipped = 0
+        for chunk in self.chunks:
+            if skipped + len(chunk) <= start:
+                skipped += len(chunk)
+                continue
+            result.extend(chunk[max(start - skipped, 0):stop - skipped])
+            skipped += len(chunk)
+            if skipped >= stop:
+                break
+        return result
+
+    def trim(self, start, stop):
+        """Keep only items start..stop-1, dropping whole chunks where possible"""
+        chunks = self.chunks
+        if start >= stop:
+            chunks.clear()
+            self.length = 0
+            self.item_bytes = 0
+            return
+        # Drop from the tail first so start stays a valid offset from the head
+        drop = self.length - stop
+        while drop and chunks:
+            if len(chunks[-1]) <= drop:
+                dropped = chunks.pop()
+            else:
+                dropped = chunks[-1][len(chunks[-1]) - drop:]
+                del chunks[-1][len(chunks[-1]) - drop:]
+            drop -= len(dropped)
+            self.item_bytes -= sum(sys.getsizeof(item) for item in dropped)
+        drop = start
+        while drop and chunks:
+            if len(chunks[0]) <= drop:
+                dropped = chunks.popleft()
+            else:
+                dropped = chunks[0][:drop]
+                del chunks[0][:drop]
+            drop -= len(dropped)
+            self.item_bytes -= sum(sys.getsizeof(item) for item in dropped)
+        self.length = stop - start
+
+    def memory_usage(self):
+        """Approximate bytes used by the list, in O(1)"""
+        chunk_overhead = sys.getsizeof([]) + 8 * QUICKLIST_CHUNK_SIZE
+        return (sys.getsizeof(self) + sys.getsizeof(self.chunks)
+                + len(self.chunks) * chunk_overhead + self.item_bytes)
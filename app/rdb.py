@@ -0,0 +1,438 @@
+"""RDB snapshot encoding and decoding.
+
+Follows the Redis RDB layout (version 11): header, aux fields, SELECTDB,
+RESIZEDB, then one record per key with an optional millisecond expiry and an
+EOF opcode plus checksum. Strings and lists use the standard encodings, so
+Redis can read those back. Streams are written in their packed node form
+under a type code of our own (RDB_TYPE_STREAM_NODES) since that is a memory
+copy per node instead of a re-encode per entry. RDB_TYPE_STREAM_NODES_2 adds
+the consumer groups after the nodes: each group's last delivered ID, its
+pending entries and its consumers.
+"""
+import io
+import mmap
+import struct
+import sys
+import time
+from array import array
+
+from app import strings
+from app.quicklist import QuickList
+from app.stream import Stream, StreamGroup, StreamNode
+
+RDB_VERSION = 11
+
+RDB_TYPE_STRING = 0
+RDB_TYPE_LIST = 1
+RDB_TYPE_STREAM_NODES = 64  # not a Redis type, see the module docstring
+RDB_TYPE_STREAM_NODES_2 = 65  # the same plus consumer groups
+
+RDB_OPCODE_AUX = 0xFA
+RDB_OPCODE_RESIZEDB = 0xFB
+RDB_OPCODE_EXPIRETIME_MS = 0xFC
+RDB_OPCODE_EXPIRETIME = 0xFD
+RDB_OPCODE_SELECTDB = 0xFE
+RDB_OPCODE_EOF = 0xFF
+
+RDB_ENC_INT8 = 0
+RDB_ENC_INT16 = 1
+RDB_ENC_INT32 = 2
+RDB_ENC_LZF = 3
+
+READ_CHUNK_SIZE = 256 * 1024
+
+
+class RdbError(Exception):
+    pass
+
+
+class RdbWriter:
+    """Writes an RDB file to a binary file-like object, key by key"""
+
+    def __init__(self, fp):
+        self.fp = fp
+
+    def write_length(self, n):
+        if n < 1 << 6:
+            self.fp.write(bytes((n,)))
+        elif n < 1 << 14:
+            self.fp.write(bytes((0x40 | (n >> 8), n & 0xFF)))
+        elif n < 1 << 32:
+            self.fp.write(b'\x80' + struct.pack('>I', n))
+        else:
+            self.fp.write(b'\x81' + struct.pack('>Q', n))
+
+    def write_bytes(self, data):
+        self.write_length(len(data))
+        self.fp.write(data)
+
+    def write_string(self, data):
+        # Small integers get the compact integer encoding, like Redis does
+        if 0 < len(data) <= 11 and data.lstrip(b'-').isdigit() and str(int(data)).encode() == data:
+            n = int(data)
+            if -(1 << 7) <= n < 1 << 7:
+                self.fp.write(bytes((0xC0 | RDB_ENC_INT8,)) + struct.pack('<b', n))
+                return
+            if -(1 << 15) <= n < 1 << 15:
+                self.fp.write(bytes((0xC0 | RDB_ENC_INT16,)) + struct.pack('<h', n))
+                return
+            if -(1 << 31) <= n < 1 << 31:
+                self.fp.write(bytes((0xC0 | RDB_ENC_INT32,)) + struct.pack('<i', n))
+                return
+        self.write_bytes(data)
+
+    def write_header(self, aux=None):
+        self.fp.write(b'REDIS%04d' % RDB_VERSION)
+        fields = {'redis-ver': '7.2.0', 'redis-bits': str(8 * struct.calcsize('P')), 'ctime': str(int(time.time()))}
+        fields.update(aux or {})
+        for name, value in fields.items():
+            self.fp.write(bytes((RDB_OPCODE_AUX,)))
+            self.write_string(name.encode())
+            self.write_string(value.encode())
+
+    def write_db_header(self, db, size, expires_size):
+        self.fp.write(bytes((RDB_OPCODE_SELECTDB,)))
+        self.write_length(db)
+        self.fp.write(bytes((RDB_OPCODE_RESIZEDB,)))
+        self.write_length(size)
+        self.write_length(expires_size)
+
+    def value_type(self, value):
+        if isinstance(value, Stream):
+            return RDB_TYPE_STREAM_NODES_2
+        if isinstance(value, QuickList):
+            return RDB_TYPE_LIST
+        return RDB_TYPE_STRING
+
+    def write_value(self, value):
+        """Payload of a value, without its type byte"""
+        if isinstance(value, Stream):
+            self.write_stream(value)
+        elif isinstance(value, QuickList):
+            self.write_length(len(value))
+            for item in value:
+                self.write_string(item)
+        else:
+            self.write_string(strings.to_bytes(value))
+
+    def write_stream(self, stream):
+        last_ms, last_seq = stream.last_id()
+        self.write_length(len(stream))
+        self.write_length(last_ms)
+        self.write_length(last_seq)
+        self.write_length(len(stream.nodes))
+        for node in stream.nodes:
+            node = node.compacted()
+            self.write_length(node.master_id[0])
+            self.write_length(node.master_id[1])
+            self.write_length(len(node.master_fields))
+            for field in node.master_fields:
+                self.write_string(field)
+            deltas, offsets = node.id_deltas, node.offsets
+            if sys.byteorder != 'little':
+                deltas, offsets = array('q', deltas), array('I', offsets)
+                deltas.byteswap()
+                offsets.byteswap()
+            self.write_bytes(deltas.tobytes())
+            self.write_bytes(offsets.tobytes())
+            self.write_bytes(node.data)
+        self.write_stream_groups(stream)
+
+    def write_stream_groups(self, stream):
+        self.write_length(len(stream.groups))
+        for name, group in stream.groups.items():
+            self.write_string(name)
+            self.write_length(group.last_id[0])
+            self.write_length(group.last_id[1])
+            self.write_length(len(group.pending_ids))
+            for entry_id in group.pending_ids:
+                nack = group.pending[entry_id]
+                self.write_length(entry_id[0])
+                self.write_length(entry_id[1])
+                self.fp.write(struct.pack('<Q', nack.delivery_time))
+                self.write_length(nack.delivery_count)
+            self.write_length(len(group.consumers))
+            for consumer in group.consumers.values():
+                self.write_string(consumer.name)
+                self.fp.write(struct.pack('<Qq', consumer.seen_time, consumer.active_time))
+                self.write_length(len(consumer.pending))
+                for entry_id in consumer.pending:
+                    self.write_length(entry_id[0])
+                    self.write_length(entry_id[1])
+
+    def write_key(self, key, value, expire_ms=None):
+        if expire_ms is not None:
+            self.fp.write(bytes((RDB_OPCODE_EXPIRETIME_MS,)) + struct.pack('<Q', expire_ms))
+        self.fp.write(bytes((self.value_type(value),)))
+        self.write_string(key)
+        self.write_value(value)
+
+    def write_footer(self):
+        # A zero checksum tells loaders (Redis included) not to verify it
+        self.fp.write(bytes((RDB_OPCODE_EOF,)) + b'\x00' * 8)
+
+
+def dump(fp, data_store, expiry_store, aux=None):
+    """Write a full snapshot of the keyspace to fp"""
+    writer = RdbWriter(fp)
+    writer.write_header(aux)
+    writer.write_db_header(0, len(data_store), len(expiry_store))
+    for key, value in data_store.items():
+        writer.write_key(key, value, expiry_store.get(key))
+    writer.write_footer()
+
+
+def _crc64_table():
+    # CRC-64/Jones, reflected, the checksum of DUMP payloads
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0x95AC9329AC4BC9B5 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+CRC64_TABLE = _crc64_table()
+
+
+def crc64(data, crc=0):
+    table = CRC64_TABLE
+    for byte in data:
+        crc = table[(crc ^ byte) & 0xFF] ^ (crc >> 8)
+    return crc
+
+
+def dump_value(value):
+    """DUMP payload: the value as in an RDB file, then the RDB version and a CRC64"""
+    fp = io.BytesIO()
+    writer = RdbWriter(fp)
+    fp.write(bytes((writer.value_type(value),)))
+    writer.write_value(value)
+    fp.write(struct.pack('<H', RDB_VERSION))
+    fp.write(struct.pack('<Q', crc64(fp.getbuffer())))
+    return fp.getvalue()
+
+
+def load_value(payload):
+    """The value of a DUMP payload; RdbError if it is damaged or too new"""
+    if len(payload) < 10:
+        raise RdbError("DUMP payload version or checksum are wrong")
+    version, = struct.unpack('<H', payload[-10:-8])
+    checksum, = struct.unpack('<Q', payload[-8:])
+    if version > RDB_VERSION or crc64(payload[:-8]) != checksum:
+        raise RdbError("DUMP payload version or checksum are wrong")
+    loader = RdbLoader(payload[:-10])
+    value = loader.read_value(loader.read_byte())
+    if loader.pos != len(payload) - 10:
+        raise RdbError("DUMP payload has trailing data")
+    return value
+
+
+def lzf_decompress(data, expected_length):
+    out = bytearray()
+    i = 0
+    while i < len(data):
+        ctrl = data[i]
+        i += 1
+        if ctrl < 32:
+            # Literal run of ctrl + 1 bytes
+            out += data[i:i + ctrl + 1]
+            i += ctrl + 1
+        else:
+            length = ctrl >> 5
+            if length == 7:
+                length += data[i]
+                i += 1
+            ref = len(out) - ((ctrl & 0x1F) << 8) - data[i] - 1
+            i += 1
+            # Back references may overlap what they produce, copy bytewise then
+            for j in range(length + 2):
+                out.append(out[ref + j])
+    if len(out) != expected_length:
+        raise RdbError("LZF decompression length mismatch")
+    return bytes(out)
+
+
+class RdbLoader:
+    """Reads an RDB snapshot.
+
+    `source` is either a bytes-like object holding the whole file (an mmap,
+    so reads are slices of the mapping) or a stream, which is pulled in
+    READ_CHUNK_SIZE pieces as parsing needs more bytes. Streams are read
+    with read1(n) when they have it, which returns what has arrived so far
+    instead of waiting for all n bytes, so a socket can be parsed as the
+    snapshot comes in and nothing past it is consumed early.
+    """
+
+    def __init__(self, source):
+        if isinstance(source, (bytes, bytearray, memoryview, mmap.mmap)):
+            self.stream = None
+            self.buf = memoryview(source)
+        else:
+            self.stream = source.read1 if hasattr(source, 'read1') else source.read
+            self.buf = b''
+        self.pos = 0
+        self.aux = {}
+
+    def _need(self, n):
+        if self.pos + n <= len(self.buf):
+            return
+        if self.stream is None:
+            raise RdbError("unexpected end of RDB data")
+        parts = [bytes(self.buf[self.pos:])]
+        have = len(parts[0])
+        while have < n:
+            chunk = self.stream(max(READ_CHUNK_SIZE, n - have))
+            if not chunk:
+                raise RdbError("unexpected end of RDB data")
+            parts.append(chunk)
+            have += len(chunk)
+        self.buf = b''.join(parts)
+        self.pos = 0
+
+    def read(self, n):
+        self._need(n)
+        data = self.buf[self.pos:self.pos + n]
+        self.pos += n
+        return data
+
+    def read_byte(self):
+        self._need(1)
+        byte = self.buf[self.pos]
+        self.pos += 1
+        return byte
+
+    def read_length_with_encoding(self):
+        first = self.read_byte()
+        kind = first >> 6
+        if kind == 0:
+            return first & 0x3F, False
+        if kind == 1:
+            return ((first & 0x3F) << 8) | self.read_byte(), False
+        if kind == 2:
+            if first == 0x80:
+                return struct.unpack('>I', self.read(4))[0], False
+            if first == 0x81:
+                return struct.unpack('>Q', self.read(8))[0], False
+            raise RdbError(f"unknown length encoding {first:#x}")
+        return first & 0x3F, True
+
+    def read_length(self):
+        length, encoded = self.read_length_with_encoding()
+        if encoded:
+            raise RdbError("unexpected encoded length")
+        return length
+
+    def read_string(self):
+        # Fast path: 6 bit length and the bytes already in the buffer
+        buf, pos = self.buf, self.pos
+        if pos < len(buf) and buf[pos] < 0x40:
+            end = pos + 1 + buf[pos]
+            if end <= len(buf):
+                self.pos = end
+                return bytes(buf[pos + 1:end])
+        length, encoded = self.read_length_with_encoding()
+        if not encoded:
+            return bytes(self.read(length))
+        if length == RDB_ENC_INT8:
+            return b'%d' % struct.unpack('<b', self.read(1))[0]
+        if length == RDB_ENC_INT16:
+            return b'%d' % struct.unpack('<h', self.read(2))[0]
+        if length == RDB_ENC_INT32:
+            return b'%d' % struct.unpack('<i', self.read(4))[0]
+        if length == RDB_ENC_LZF:
+            compressed_length = self.read_length()
+            length = self.read_length()
+            return lzf_decompress(bytes(self.read(compressed_length)), length)
+        raise RdbError(f"unknown string encoding {length}")
+
+    def read_header(self):
+        magic = bytes(self.read(9))
+        if magic[:5] != b'REDIS' or not magic[5:].isdigit():
+            raise RdbError("not an RDB file")
+        if int(magic[5:]) > RDB_VERSION:
+            raise RdbError(f"can't handle RDB format version {int(magic[5:])}")
+
+    def read_value(self, value_type):
+        if value_type == RDB_TYPE_STRING:
+            return strings.encode(self.read_string())
+        if value_type == RDB_TYPE_LIST:
+            return QuickList(self.read_string() for _ in range(self.read_length()))
+        if value_type == RDB_TYPE_STREAM_NODES:
+            return self.read_stream()
+        if value_type == RDB_TYPE_STREAM_NODES_2:
+            stream = self.read_stream()
+            self.read_stream_groups(stream)
+            return stream
+        raise RdbError(f"unsupported value type {value_type}")
+
+    def read_stream(self):
+        length = self.read_length()
+        last_id = (self.read_length(), self.read_length())
+        stream = Stream()
+        for _ in range(self.read_length()):
+            master_id = (self.read_length(), self.read_length())
+            master_fields = tuple(self.read_string() for _ in range(self.read_length()))
+            node = StreamNode(master_id, master_fields)
+            node.id_deltas.frombytes(self.read_string())
+            node.offsets.frombytes(self.read_string())
+            node.data += self.read_string()
+            if sys.byteorder != 'little':
+                node.id_deltas.byteswap()
+                node.offsets.byteswap()
+            stream.append_node(node)
+        if len(stream) != length:
+            raise RdbError("stream length mismatch")
+        stream.last_entry_id = last_id
+        return stream
+
+    def read_stream_groups(self, stream):
+        for _ in range(self.read_length()):
+            name = self.read_string()
+            group = stream.groups[name] = StreamGroup((self.read_length(), self.read_length()))
+            # Delivery time and count of each pending entry, until a consumer claims it
+            delivered = {}
+            for _ in range(self.read_length()):
+                entry_id = (self.read_length(), self.read_length())
+                delivery_time, = struct.unpack('<Q', self.read(8))
+                delivered[entry_id] = (delivery_time, self.read_length())
+            for _ in range(self.read_length()):
+                consumer_name = self.read_string()
+                seen_time, active_time = struct.unpack('<Qq', self.read(16))
+                consumer = group.consumer(consumer_name, seen_time)
+                consumer.active_time = active_time
+                for _ in range(self.read_length()):
+                    entry_id = (self.read_length(), self.read_length())
+                    if entry_id not in delivered:
+                        raise RdbError("consumer holds an entry its group doesn't have pending")
+                    delivery_time, delivery_count = delivered.pop(entry_id)
+                    group.add_pending(entry_id, consumer, delivery_time, delivery_count)
+            if delivered:
+                raise RdbError("pending stream entry without a consumer")
+
+    def entries(self):
+        """Yield (key, value, expire_ms or None) for every key in the file"""
+        self.read_header()
+        expire_ms = None
+        while True:
+            opcode = self.read_byte()
+            if opcode == RDB_OPCODE_EOF:
+                # 8 byte checksum follows (older versions have none)
+                return
+            if opcode == RDB_OPCODE_AUX:
+                name = self.read_string().decode(errors='replace')
+                self.aux[name] = self.read_string().decode(errors='replace')
+            elif opcode == RDB_OPCODE_SELECTDB:
+                self.read_length()
+            elif opcode == RDB_OPCODE_RESIZEDB:
+                self.read_length()
+                self.read_length()
+            elif opcode == RDB_OPCODE_EXPIRETIME_MS:
+                expire_ms = struct.unpack('<Q', self.read(8))[0]
+            elif opcode == RDB_OPCODE_EXPIRETIME:
+                expire_ms = struct.unpack('<I', self.read(4))[0] * 1000
+            else:
+                key = self.read_string()
+                value = self.read_value(opcode)
+                yield key, value, expire_ms
+                expire_ms = None
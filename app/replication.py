@@ -0,0 +1,64 @@
+class ReplicationBacklog:
+    """Ring buffer holding the tail of the replication stream.
+
+    Offsets count bytes of the stream since it started, the first byte being
+    offset 1, so `end_offset` is the master's master_repl_offset. A replica
+    that lost its link asks to resume at the offset after the last byte it
+    processed; as long as that byte is still here it gets the missing part
+    instead of a whole new snapshot.
+    """
+
+    def __init__(self, size, end_offset):
+        self.buf = bytearray(size)
+        self.size = size
+        self.histlen = 0  # bytes of history held, at most size
+        self.idx = 0      # where the next byte goes
+        self.end_offset = end_offset
+
+    @property
+    def first_offset(self):
+        return self.end_offset - self.histlen + 1
+
+    def write(self, data):
+        n = len(data)
+        self.end_offset += n
+        if n >= self.size:
+            self.buf[:] = data[n - self.size:]
+            self.idx = 0
+            self.histlen = self.size
+            return
+        # Slice assignments of equal length, so the buffer is never reallocated
+        first = min(n, self.size - self.idx)
+        self.buf[self.idx:self.idx + first] = data[:first]
+        if first < n:
+            self.buf[:n - first] = data[first:]
+        self.idx = (self.idx + n) % self.size
+        self.histlen = min(self.histlen + n, self.size)
+
+    def read_from(self, offset):
+        """The stream from offset to the end, None if part of it is gone"""
+        if not self.first_offset <= offset <= self.end_offset + 1:
+            return None
+        n = self.end_offset + 1 - offset
+        start = (self.idx - n) % self.size
+        if start + n <= self.size:
+            return bytes(self.buf[start:start + n])
+        return bytes(self.buf[start:]) + bytes(self.buf[:n - (self.size - start)])
+
+
+class BulkReader:
+    """The next `length` bytes of a buffered stream, nothing past them.
+
+    read1() returns what has already arrived (up to n bytes), like recv, so
+    a snapshot can be parsed while it is still being received."""
+
+    def __init__(self, raw, length):
+        self.raw = raw
+        self.remaining = length
+
+    def read1(self, n):
+        if not self.remaining:
+            return b''
+        data = self.raw.read1(min(n, self.remaining))
+        self.remaining -= len(data)
+        return data
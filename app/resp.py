@@ -0,0 +1,171 @@
+MAX_MULTIBULK_LENGTH = 1024 * 1024
+MAX_BULK_LENGTH = 512 * 1024 * 1024
+MAX_INLINE_LENGTH = 64 * 1024
+BIG_ARG = 32 * 1024
+
+
+class ProtocolError(Exception):
+    pass
+
+
+class RespParser:
+    """Incremental parser for client requests.
+
+    Bytes are fed in as they arrive from the socket and every complete command
+    is handed back as a list of arguments, as bytes (keys and values are
+    binary-safe and never decoded). A frame split across reads is resumed
+    where it stopped, bulk strings are read by their length prefix (so they may
+    contain \\r\\n) and inline commands ("PING\\r\\n") are accepted too.
+
+        parser.feed(data)
+        for command_parts in parser:
+            ...
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.pos = 0
+        # State of the multibulk currently being read
+        self.args = None        # arguments read so far, None between commands
+        self.remaining = 0      # arguments still to read
+        self.bulk_len = -1      # length of the bulk being read, -1 if its header is pending
+        self.fed = 0            # bytes fed so far
+
+    def feed(self, data):
+        self.buffer += data
+        self.fed += len(data)
+
+    def consumed(self):
+        """Bytes of input parsed so far; right after a command is returned,
+        the offset just past that command"""
+        return self.fed - (len(self.buffer) - self.pos)
+
+    def __iter__(self):
+        while True:
+            command = self.next_command()
+            if command is None:
+                return
+            yield command
+
+    def next_command(self):
+        """Return the next complete command, or None if more bytes are needed"""
+        while True:
+            if self.args is None:
+                if self.pos >= len(self.buffer):
+                    self._compact()
+                    return None
+                if self.buffer[self.pos] == ord('*'):
+                    command = self._read_multibulk()
+                else:
+                    command = self._read_inline()
+            else:
+                command = self._read_multibulk()
+            if command is None:
+                self._compact()
+                return None
+            if command:
+                return command
+            # Empty inline line or "*0": nothing to run, keep going
+
+    def _compact(self):
+        if self.pos:
+            del self.buffer[:self.pos]
+            self.pos = 0
+
+    def _read_line(self):
+        end = self.buffer.find(b'\r\n', self.pos)
+        if end == -1:
+            if len(self.buffer) - self.pos > MAX_INLINE_LENGTH:
+                raise ProtocolError("too big inline request")
+            return None
+        line = bytes(self.buffer[self.pos:end])
+        self.pos = end + 2
+        return line
+
+    def _read_inline(self):
+        line = self._read_line()
+        if line is None:
+            return None
+        return line.split()
+
+    def _read_multibulk(self):
+        if self.args is None:
+            line = self._read_line()
+            if line is None:
+                return None
+            try:
+                count = int(line[1:])
+            except ValueError:
+                raise ProtocolError("invalid multibulk length")
+            if count > MAX_MULTIBULK_LENGTH:
+                raise ProtocolError("invalid multibulk length")
+            if count <= 0:
+                return []
+            self.args = []
+            self.remaining = count
+
+        buffer = self.buffer
+        while self.remaining:
+            if self.bulk_len == -1:
+                if self.pos >= len(buffer):
+                    return None
+                if buffer[self.pos] != ord('$'):
+                    raise ProtocolError(f"expected '$', got '{chr(buffer[self.pos])}'")
+                line = self._read_line()
+                if line is None:
+                    return None
+                try:
+                    self.bulk_len = int(line[1:])
+                except ValueError:
+                    raise ProtocolError("invalid bulk length")
+                if self.bulk_len < 0 or self.bulk_len > MAX_BULK_LENGTH:
+                    raise ProtocolError("invalid bulk length")
+
+            end = self.pos + self.bulk_len
+            if len(buffer) < end + 2:
+                return None
+            if self.bulk_len < BIG_ARG:
+                self.args.append(bytes(buffer[self.pos:end]))
+            else:
+                # Sliced through a view so a big value is copied once, not twice
+                with memoryview(buffer) as view:
+                    self.args.append(bytes(view[self.pos:end]))
+            self.pos = end + 2
+            self.bulk_len = -1
+            self.remaining -= 1
+
+        args = self.args
+        self.args = None
+        return args
+
+
+# Reply writers: each appends to a bytearray, so a reply of any size is built
+# in one buffer in linear time, without intermediate strings
+
+def write_bulk(out, data):
+    out += b'$%d\r\n' % len(data)
+    out += data
+    out += b'\r\n'
+
+
+def write_array(out, items):
+    """Array of bulk strings"""
+    out += b'*%d\r\n' % len(items)
+    for item in items:
+        out += b'$%d\r\n' % len(item)
+        out += item
+        out += b'\r\n'
+
+
+def write_value(out, value):
+    """Nested lists of strings and integers, None as a null bulk string"""
+    if value is None:
+        out += b'$-1\r\n'
+    elif isinstance(value, int):
+        out += b':%d\r\n' % value
+    elif isinstance(value, list):
+        out += b'*%d\r\n' % len(value)
+        for item in value:
+            write_value(out, item)
+    else:
+        write_bulk(out, value.encode() if isinstance(value, str) else value)
@@ -0,0 +1,596 @@
+import bisect
+import sys
+from array import array
+
+from app.resp import write_array
+
+# Limits of a single node, same defaults as Redis' stream-node-max-entries/bytes
+STREAM_NODE_MAX_ENTRIES = 100
+STREAM_NODE_MAX_BYTES = 4096
+# IDs per chunk of a SortedIDs
+SORTED_IDS_CHUNK_SIZE = 128
+
+
+def format_entry_id(entry_id):
+    return b'%d-%d' % entry_id
+
+
+def encode_entry(entry_id, field_values):
+    """An entry as it appears in replies: [id, [field, value, ...]]"""
+    id_str = format_entry_id(entry_id)
+    out = bytearray(b'*2\r\n$%d\r\n%s\r\n' % (len(id_str), id_str))
+    write_array(out, field_values)
+    return out
+
+
+def _put_varint(buf, n):
+    # 7 bits per byte, so anything under 128 takes a single byte
+    while n >= 0x80:
+        buf.append((n & 0x7f) | 0x80)
+        n >>= 7
+    buf.append(n)
+
+def _put_string(buf, data):
+    _put_varint(buf, len(data))
+    buf += data
+
+def _get_varint(buf, pos):
+    n = shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        n |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return n, pos
+        shift += 7
+
+def _get_string(buf, pos):
+    n, pos = _get_varint(buf, pos)
+    return bytes(buf[pos:pos + n]), pos + n
+
+
+class StreamNode:
+    """A block of consecutive stream entries, packed listpack style.
+
+    The first entry is the node's master entry. Every ID is stored as a
+    (ms, seq) delta from the master ID in an int64 array, and entries that
+    have the same field names as the master only store their values. Values
+    are length-prefixed bytes in a single bytearray, so an entry costs a few
+    bytes of header plus its payload instead of a tuple, a string and a dict.
+
+    Deleting an entry (XDEL, exact trimming) only flags it, like Redis does;
+    the node is dropped whole once none of its entries are left.
+    """
+    __slots__ = ('master_id', 'master_fields', 'id_deltas', 'offsets', 'data', 'encoded', 'deleted', 'size')
+
+    def __init__(self, master_id, master_fields):
+        self.master_id = master_id
+        self.master_fields = master_fields  # tuple of field names
+        self.id_deltas = array('q')  # ms delta, seq delta, ms delta, ...
+        self.offsets = array('I')    # where each entry starts in data
+        self.data = bytearray()
+        self.encoded = None  # encoded entries by index once read, see Stream.encoded_entry
+        self.deleted = None  # indexes of the deleted entries, None if there are none
+        self.size = 0        # bytes counted for the node in Stream.node_bytes
+
+    def __len__(self):
+        # Entries stored, the deleted ones included: entry indexes go up to this
+        return len(self.offsets)
+
+    def live(self):
+        return len(self.offsets) - (len(self.deleted) if self.deleted else 0)
+
+    def is_deleted(self, i):
+        return self.deleted is not None and i in self.deleted
+
+    def is_full(self):
+        return len(self.offsets) >= STREAM_NODE_MAX_ENTRIES or len(self.data) >= STREAM_NODE_MAX_BYTES
+
+    def entry_id(self, i):
+        return (self.master_id[0] + self.id_deltas[2 * i], self.master_id[1] + self.id_deltas[2 * i + 1])
+
+    def append(self, entry_id, field_values):
+        self.id_deltas.append(entry_id[0] - self.master_id[0])
+        self.id_deltas.append(entry_id[1] - self.master_id[1])
+        self.offsets.append(len(self.data))
+        data = self.data
+        fields = tuple(field_values[0::2])
+        if fields == self.master_fields:
+            data.append(0)
+        else:
+            data.append(1)
+            _put_varint(data, len(fields))
+            for field in fields:
+                _put_string(data, field)
+        for value in field_values[1::2]:
+            _put_string(data, value)
+
+    def entry(self, i):
+        """Decode entry i as a flat [field, value, ...] list"""
+        data = self.data
+        pos = self.offsets[i]
+        if data[pos] == 0:
+            fields = self.master_fields
+            pos += 1
+        else:
+            n, pos = _get_varint(data, pos + 1)
+            fields = []
+            for _ in range(n):
+                field, pos = _get_string(data, pos)
+                fields.append(field)
+        field_values = []
+        for field in fields:
+            value, pos = _get_string(data, pos)
+            field_values.append(field)
+            field_values.append(value)
+        return field_values
+
+    def seek(self, entry_id, inclusive=True):
+        """Index of the first entry with ID >= entry_id (> if not inclusive)"""
+        lo, hi = 0, len(self.offsets)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            mid_id = self.entry_id(mid)
+            if mid_id < entry_id or (not inclusive and mid_id == entry_id):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def memory_usage(self):
+        return (sys.getsizeof(self) + sys.getsizeof(self.id_deltas) + sys.getsizeof(self.offsets)
+                + sys.getsizeof(self.data))
+
+    def compacted(self):
+        """The node without its deleted entries (itself if it has none), for snapshots"""
+        if not self.deleted:
+            return self
+        node = StreamNode(self.master_id, self.master_fields)
+        for i in range(len(self)):
+            if i not in self.deleted:
+                node.append(self.entry_id(i), self.entry(i))
+        return node
+
+
+class Stream:
+    """Log of entries keyed by (ms, seq) integer pairs, appended to at the end
+    and trimmed from the start.
+
+    Entries live in StreamNode blocks. The master IDs of the nodes are kept in
+    ascending order, so a range query bisects to its first node, then to its
+    first entry inside it, and only touches the entries it returns. Range
+    results are lists of encoded entries (see encode_entry), ready to be
+    written out as the elements of a reply array. Trimming drops whole nodes
+    from the front, so a capped stream frees its memory a node at a time.
+    """
+
+    def __init__(self):
+        self.nodes = []
+        self.node_ids = []  # master ID of each node, for bisecting
+        self.length = 0
+        self.last_entry_id = (0, 0)
+        self.node_bytes = 0  # bytes held by the nodes, kept up to date for memory_usage
+        self.groups = {}  # consumer group name -> StreamGroup
+
+    def __len__(self):
+        return self.length
+
+    def last_id(self):
+        return self.last_entry_id
+
+    def top_id(self):
+        """ID of the newest entry left, None if there is none. last_id() can
+        be past it, once the newest entries are deleted."""
+        if not self.nodes:
+            return None
+        node = self.nodes[-1]
+        i = len(node) - 1
+        while node.is_deleted(i):
+            i -= 1
+        return node.entry_id(i)
+
+    def append(self, entry_id, field_values):
+        # Caller checks the ID is greater than last_id()
+        if not self.nodes or self.nodes[-1].is_full():
+            node = StreamNode(entry_id, tuple(field_values[0::2]))
+            self.nodes.append(node)
+            self.node_ids.append(entry_id)
+            # Master ID and the node's empty containers
+            self._count_bytes(node, node.memory_usage() + sys.getsizeof(entry_id))
+        node = self.nodes[-1]
+        data_size = len(node.data)
+        node.append(entry_id, field_values)
+        # Two int64 ID deltas, one uint32 offset and the packed payload
+        self._count_bytes(node, 20 + len(node.data) - data_size)
+        self.length += 1
+        self.last_entry_id = entry_id
+
+    def append_node(self, node):
+        """Add a whole node (loaded from a snapshot) after the existing ones"""
+        self.nodes.append(node)
+        self.node_ids.append(node.master_id)
+        self.length += len(node)
+        self.last_entry_id = node.entry_id(len(node) - 1)
+        self._count_bytes(node, node.memory_usage() + sys.getsizeof(node.master_id))
+
+    def _count_bytes(self, node, n):
+        node.size += n
+        self.node_bytes += n
+
+    def _remove_nodes(self, start, end):
+        for node in self.nodes[start:end]:
+            self.node_bytes -= node.size
+        del self.nodes[start:end]
+        del self.node_ids[start:end]
+
+    def _delete_entry(self, node_index, i):
+        """Flag entry i of a node as deleted, and drop the node if it was its last"""
+        node = self.nodes[node_index]
+        if node.deleted is None:
+            node.deleted = set()
+            self._count_bytes(node, sys.getsizeof(node.deleted))
+        node.deleted.add(i)
+        self.length -= 1
+        encoded = node.encoded
+        if encoded is not None and i < len(encoded) and encoded[i] is not None:
+            self._count_bytes(node, -sys.getsizeof(encoded[i]))
+            encoded[i] = None
+        if not node.live():
+            self._remove_nodes(node_index, node_index + 1)
+
+    def delete(self, entry_id):
+        """XDEL one entry; False if there is no such entry"""
+        node_index, i = self._seek(entry_id)
+        if node_index >= len(self.nodes):
+            return False
+        node = self.nodes[node_index]
+        if node.entry_id(i) != entry_id or node.is_deleted(i):
+            return False
+        self._delete_entry(node_index, i)
+        return True
+
+    def trim(self, maxlen=None, minid=None, approx=False, limit=None):
+        """Remove the oldest entries, leaving at most maxlen of them, or none
+        with an ID below minid. Returns how many were removed.
+
+        Whole nodes go first, which is a slice deletion off the node list.
+        With approx that is all: the stream may keep up to a node's worth of
+        entries more than asked, and no more than limit entries are removed.
+        Otherwise the entries left over in the first node are flagged deleted."""
+        nodes = self.nodes
+        removed = 0
+        drop = 0
+        while drop < len(nodes):
+            node = nodes[drop]
+            live = node.live()
+            if maxlen is not None and self.length - removed - live < maxlen:
+                break
+            if minid is not None and node.entry_id(len(node) - 1) >= minid:
+                break
+            if limit is not None and removed + live > limit:
+                break
+            removed += live
+            drop += 1
+        if drop:
+            self._remove_nodes(0, drop)
+            self.length -= removed
+        if approx:
+            return removed
+        i = 0
+        while nodes and i < len(nodes[0]):
+            if maxlen is not None and self.length <= maxlen:
+                break
+            if minid is not None and nodes[0].entry_id(i) >= minid:
+                break
+            if not nodes[0].is_deleted(i):
+                # Drops the node after its last live entry, which ends the loop
+                node = nodes[0]
+                self._delete_entry(0, i)
+                removed += 1
+                if not nodes or nodes[0] is not node:
+                    break
+            i += 1
+        return removed
+
+    def _seek(self, entry_id, inclusive=True):
+        """(node index, entry index) of the first entry >= entry_id (> if not inclusive)"""
+        # Last node whose master ID is <= entry_id, the entry can't be before it
+        lo, hi = 0, len(self.node_ids)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.node_ids[mid] <= entry_id:
+                lo = mid + 1
+            else:
+                hi = mid
+        node_index = max(lo - 1, 0)
+        if node_index >= len(self.nodes):
+            return node_index, 0
+        i = self.nodes[node_index].seek(entry_id, inclusive)
+        if i == len(self.nodes[node_index]):
+            return node_index + 1, 0
+        return node_index, i
+
+    def encoded_entry(self, node, i, cache=True):
+        """Entry i of node, encoded for a reply.
+
+        Entries never change once added, so with cache the encoding is kept
+        on the node: a hot range read by many clients is encoded only once.
+        The cached bytes count towards memory_usage."""
+        encoded = node.encoded
+        if encoded is not None and i < len(encoded) and encoded[i] is not None:
+            return encoded[i]
+        data = encode_entry(node.entry_id(i), node.entry(i))
+        if cache:
+            if encoded is None:
+                encoded = node.encoded = []
+                self._count_bytes(node, sys.getsizeof(encoded))
+            if i >= len(encoded):
+                # One slot per entry, 8 bytes each in the list
+                self._count_bytes(node, 8 * (len(node) - len(encoded)))
+                encoded.extend([None] * (len(node) - len(encoded)))
+            data = encoded[i] = bytes(data)
+            self._count_bytes(node, sys.getsizeof(data))
+        return data
+
+    def _forward(self, node_index, i, end, count, cache, with_ids=False):
+        result = []
+        nodes = self.nodes
+        while node_index < len(nodes):
+            node = nodes[node_index]
+            deleted = node.deleted
+            while i < len(node):
+                if deleted and i in deleted:
+                    i += 1
+                    continue
+                entry_id = node.entry_id(i)
+                if entry_id > end or (count is not None and len(result) >= count):
+                    return result
+                encoded = self.encoded_entry(node, i, cache)
+                result.append((entry_id, encoded) if with_ids else encoded)
+                i += 1
+            node_index += 1
+            i = 0
+        return result
+
+    def range(self, start, end, count=None, cache=True):
+        """Entries with start <= ID <= end, oldest first"""
+        node_index, i = self._seek(start)
+        return self._forward(node_index, i, end, count, cache)
+
+    def rev_range(self, end, start, count=None, cache=True):
+        """Entries with start <= ID <= end, newest first"""
+        # Step back from the first entry past the end
+        node_index, i = self._seek(end, inclusive=False)
+        result = []
+        nodes = self.nodes
+        while True:
+            if i == 0:
+                node_index -= 1
+                if node_index < 0:
+                    return result
+                i = len(nodes[node_index])
+            i -= 1
+            node = nodes[node_index]
+            if node.deleted and i in node.deleted:
+                continue
+            entry_id = node.entry_id(i)
+            if entry_id < start or (count is not None and len(result) >= count):
+                return result
+            result.append(self.encoded_entry(node, i, cache))
+
+    def after(self, last_id, count=None, cache=True, with_ids=False):
+        """Entries with ID > last_id, oldest first (what XREAD returns).
+        With with_ids, (id, entry) pairs."""
+        node_index, i = self._seek(last_id, inclusive=False)
+        return self._forward(node_index, i, self.last_entry_id, count, cache, with_ids)
+
+    def get(self, entry_id, cache=True):
+        """The encoded entry with this ID, None if there is none"""
+        node_index, i = self._seek(entry_id)
+        if node_index >= len(self.nodes):
+            return None
+        node = self.nodes[node_index]
+        if node.entry_id(i) != entry_id or node.is_deleted(i):
+            return None
+        return self.encoded_entry(node, i, cache)
+
+    def memory_usage(self):
+        """Approximate bytes used by the stream, in O(1) per consumer group"""
+        return (sys.getsizeof(self) + sys.getsizeof(self.nodes) + sys.getsizeof(self.node_ids) + self.node_bytes
+                + sum(group.memory_usage() for group in self.groups.values()))
+
+
+class SortedIDs:
+    """A sorted set of entry IDs, for the pending entries lists.
+
+    The IDs are kept in chunks of at most SORTED_IDS_CHUNK_SIZE, with the
+    greatest ID of each chunk in maxes: a lookup bisects maxes and then the
+    chunk, and adding or removing an ID only shifts the rest of its chunk.
+    A plain sorted list would shift everything after the ID instead, and
+    a FIFO consumer always acks the oldest one."""
+    __slots__ = ('chunks', 'maxes', 'length')
+
+    def __init__(self):
+        self.chunks = []
+        self.maxes = []
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            yield from chunk
+
+    def first(self):
+        return self.chunks[0][0] if self.chunks else None
+
+    def last(self):
+        return self.maxes[-1] if self.maxes else None
+
+    def add(self, entry_id):
+        # Caller makes sure entry_id isn't in the set yet
+        chunks, maxes = self.chunks, self.maxes
+        self.length += 1
+        if not chunks:
+            chunks.append([entry_id])
+            maxes.append(entry_id)
+            return
+        k = bisect.bisect_left(maxes, entry_id)
+        if k == len(maxes):
+            # Past every ID, the usual case: entries are delivered in ID order
+            k -= 1
+            chunks[k].append(entry_id)
+            maxes[k] = entry_id
+        else:
+            bisect.insort(chunks[k], entry_id)
+        chunk = chunks[k]
+        if len(chunk) > SORTED_IDS_CHUNK_SIZE:
+            half = len(chunk) // 2
+            chunks.insert(k + 1, chunk[half:])
+            del chunk[half:]
+            maxes.insert(k, chunk[-1])
+
+    def remove(self, entry_id):
+        # Caller makes sure entry_id is in the set
+        chunks, maxes = self.chunks, self.maxes
+        k = bisect.bisect_left(maxes, entry_id)
+        chunk = chunks[k]
+        del chunk[bisect.bisect_left(chunk, entry_id)]
+        self.length -= 1
+        if not chunk:
+            del chunks[k]
+            del maxes[k]
+        elif maxes[k] == entry_id:
+            maxes[k] = chunk[-1]
+
+    def range(self, start, end, count=None):
+        """The IDs with start <= ID <= end, in order, at most count of them"""
+        chunks = self.chunks
+        k = bisect.bisect_left(self.maxes, start)
+        if k == len(chunks):
+            return []
+        i = bisect.bisect_left(chunks[k], start)
+        ids = []
+        while k < len(chunks) and (count is None or len(ids) < count):
+            chunk = chunks[k]
+            j = bisect.bisect_right(chunk, end)
+            if count is not None:
+                j = min(j, i + count - len(ids))
+            ids += chunk[i:j]
+            if j < len(chunk):
+                break
+            k += 1
+            i = 0
+        return ids
+
+    def next_after(self, entry_id):
+        """The first ID greater than entry_id, None if there is none"""
+        k = bisect.bisect_right(self.maxes, entry_id)
+        if k == len(self.chunks):
+            return None
+        chunk = self.chunks[k]
+        return chunk[bisect.bisect_right(chunk, entry_id)]
+
+
+class StreamNACK:
+    """A pending entry: delivered to a consumer of a group, not acknowledged yet"""
+    __slots__ = ('consumer', 'delivery_time', 'delivery_count')
+
+    def __init__(self, consumer, delivery_time, delivery_count):
+        self.consumer = consumer
+        self.delivery_time = delivery_time  # unix ms of the last delivery
+        self.delivery_count = delivery_count
+
+
+class StreamConsumer:
+    __slots__ = ('name', 'seen_time', 'active_time', 'pending', 'pending_ids')
+
+    def __init__(self, name, seen_time):
+        self.name = name
+        self.seen_time = seen_time   # unix ms of its last command
+        self.active_time = -1        # unix ms it was last delivered an entry, -1 never
+        self.pending = {}            # entry ID -> StreamNACK, the group's NACKs it holds
+        self.pending_ids = SortedIDs()  # the IDs of pending
+
+    def _add(self, entry_id, nack):
+        self.pending[entry_id] = nack
+        self.pending_ids.add(entry_id)
+
+    def _remove(self, entry_id):
+        del self.pending[entry_id]
+        self.pending_ids.remove(entry_id)
+
+
+class StreamGroup:
+    """A consumer group: how far it has read, and what it delivered but was
+    not acknowledged yet (the pending entries list, PEL).
+
+    The PEL is a dict by entry ID, so XACK and XCLAIM find an entry
+    without a scan, plus a SortedIDs of the IDs for the range queries
+    (XPENDING, XAUTOCLAIM), which bisect to where they start. Each consumer
+    keeps its own dict and SortedIDs of the same NACKs, so XPENDING for one
+    consumer doesn't sort them."""
+    # Rough cost of a pending entry: the NACK, its slots in both dicts and both indexes
+    NACK_SIZE = 200
+    CONSUMER_SIZE = 300
+
+    def __init__(self, last_id):
+        self.last_id = last_id   # last entry delivered to the group
+        self.pending = {}        # entry ID -> StreamNACK
+        self.pending_ids = SortedIDs()  # the IDs of pending
+        self.consumers = {}      # name -> StreamConsumer
+
+    def consumer(self, name, now, create=True):
+        """The consumer called name, created if needed (None if not and create is off)"""
+        consumer = self.consumers.get(name)
+        if consumer is None and create:
+            consumer = self.consumers[name] = StreamConsumer(name, now)
+        return consumer
+
+    def delete_consumer(self, name):
+        """Remove a consumer and its pending entries; returns how many it had"""
+        consumer = self.consumers.pop(name, None)
+        if consumer is None:
+            return 0
+        for entry_id in consumer.pending:
+            self.pending_ids.remove(entry_id)
+            del self.pending[entry_id]
+        return len(consumer.pending)
+
+    def add_pending(self, entry_id, consumer, now, delivery_count=1):
+        """Make consumer the owner of entry_id, as delivered at now"""
+        nack = self.pending.get(entry_id)
+        if nack is None:
+            nack = self.pending[entry_id] = StreamNACK(consumer, now, delivery_count)
+            self.pending_ids.add(entry_id)
+        else:
+            nack.consumer._remove(entry_id)
+            nack.consumer = consumer
+            nack.delivery_time = now
+            nack.delivery_count = delivery_count
+        consumer._add(entry_id, nack)
+        return nack
+
+    def ack(self, entry_id):
+        """Drop entry_id from the PEL; False if it wasn't pending"""
+        nack = self.pending.pop(entry_id, None)
+        if nack is None:
+            return False
+        nack.consumer._remove(entry_id)
+        self.pending_ids.remove(entry_id)
+        return True
+
+    def pending_range(self, start, end, count=None, consumer=None):
+        """IDs of the pending entries with start <= ID <= end, oldest first,
+        only those of consumer if given"""
+        ids = self.pending_ids if consumer is None else consumer.pending_ids
+        return ids.range(start, end, count)
+
+    def next_pending(self, entry_id):
+        """The first pending ID after entry_id, None if there is none"""
+        return self.pending_ids.next_after(entry_id)
+
+    def memory_usage(self):
+        return (sys.getsizeof(self) + len(self.pending) * self.NACK_SIZE
+                + len(self.consumers) * self.CONSUMER_SIZE)
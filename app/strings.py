@@ -0,0 +1,90 @@
+"""String values and their encodings.
+
+A string is stored as bytes, or as an int when it is the canonical form
+of a signed 64-bit integer (what Redis calls the int encoding). Counters
+then skip the parse and format on every INCR, and a value under
+SHARED_INTEGERS is one of a set of preallocated int objects instead of
+an object per key (Python itself only caches -5..256). Strings grown in
+place by APPEND and SETRANGE become a bytearray, so repeated appends
+reuse its spare room instead of copying the whole value each time.
+"""
+import math
+
+SHARED_INTEGERS = 10000
+shared_integers = tuple(range(SHARED_INTEGERS))
+
+LLONG_MIN = -(1 << 63)
+LLONG_MAX = (1 << 63) - 1
+# Digits of the longest 64-bit integer, with its sign
+MAX_LLONG_LENGTH = 20
+# proto-max-bulk-len, the largest string SETRANGE and APPEND may build
+MAX_STRING_LENGTH = 512 * 1024 * 1024
+
+
+def is_string(value):
+    return type(value) in (bytes, int, bytearray)
+
+
+def shared(n):
+    # The preallocated object for small non-negative ints
+    return shared_integers[n] if 0 <= n < SHARED_INTEGERS else n
+
+
+def parse_int(data):
+    """The 64-bit integer that data spells canonically (no sign for zero,
+    no leading zeros or spaces, no '+'), None if there isn't one"""
+    if not data or len(data) > MAX_LLONG_LENGTH:
+        return None
+    first = data[0]
+    if not (0x30 <= first <= 0x39 or first == 0x2d):  # digit or '-'
+        return None
+    try:
+        n = int(data)
+    except ValueError:
+        return None
+    if b'%d' % n != data or not LLONG_MIN <= n <= LLONG_MAX:
+        return None
+    return n
+
+
+def encode(data):
+    """How a string is stored: the int it spells, or data itself"""
+    n = parse_int(data)
+    return data if n is None else shared(n)
+
+
+def to_bytes(value):
+    return b'%d' % value if type(value) is int else value
+
+
+def to_int(value):
+    """The integer a stored string holds, None if it doesn't hold one"""
+    return value if type(value) is int else parse_int(value)
+
+
+def length(value):
+    return len(b'%d' % value) if type(value) is int else len(value)
+
+
+def parse_float(data):
+    """A float argument or value as Redis reads it, None if it isn't one"""
+    try:
+        n = float(data)
+    except ValueError:
+        return None
+    # Python accepts surrounding spaces and nan, Redis doesn't
+    if data != data.strip() or math.isnan(n):
+        return None
+    return n
+
+
+def format_float(n):
+    # Shortest form that reads back the same, never in exponent notation
+    text = repr(n)
+    if 'e' in text:
+        text = '%.17f' % n
+        if '.' in text:
+            text = text.rstrip('0').rstrip('.')
+    elif text.endswith('.0'):
+        text = text[:-2]
+    return text.encode()
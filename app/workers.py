@@ -0,0 +1,203 @@
+"""Worker mode: the keyspace split across processes, to use more than one core.
+
+Keys are hashed to slots as in cluster mode (CRC16, {hash tags} included,
+see app/cluster.py), and each worker owns a contiguous range of slots.
+Every worker accepts clients on the shared port (SO_REUSEPORT spreads the
+connections). A command for keys another worker owns is forwarded to it
+over a unix socket, and its reply relayed back in place, so clients see
+one server.
+
+Each worker has its own dataset, persistence files and limits (maxmemory
+applies per worker). The files only hold the worker's own slots, so a
+server has to be restarted with the same number of workers.
+"""
+import os
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+
+from app.cluster import HASH_SLOTS, key_hash_slot
+
+PEER_READ_SIZE = 64 * 1024
+
+
+def key_worker(key, count):
+    """Index of the worker owning key, out of count"""
+    return key_hash_slot(key) * count // HASH_SLOTS
+
+
+def worker_filename(filename, worker_id):
+    """dump.rdb -> dump-2.rdb: each worker persists its own slots"""
+    stem, ext = os.path.splitext(filename)
+    return f"{stem}-{worker_id}{ext}"
+
+
+def peer_path(socket_dir, worker_id):
+    return os.path.join(socket_dir, f"worker-{worker_id}.sock")
+
+
+class ReplySplitter:
+    """Cuts a stream of RESP replies into whole replies, kept as raw bytes"""
+
+    def __init__(self):
+        self.buf = bytearray()
+        self.pos = 0
+
+    def feed(self, data):
+        if self.pos > len(self.buf) // 2:
+            del self.buf[:self.pos]
+            self.pos = 0
+        self.buf += data
+
+    def _end(self, pos):
+        # End of the reply starting at pos, -1 if it hasn't all arrived
+        line_end = self.buf.find(b'\r\n', pos)
+        if line_end == -1:
+            return -1
+        kind = self.buf[pos:pos + 1]
+        if kind not in (b'$', b'*'):
+            return line_end + 2
+        n = int(self.buf[pos + 1:line_end])
+        pos = line_end + 2
+        if kind == b'$':
+            if n < 0:
+                return pos
+            return pos + n + 2 if pos + n + 2 <= len(self.buf) else -1
+        for _ in range(n):
+            pos = self._end(pos)
+            if pos == -1:
+                return -1
+        return pos
+
+    def pop(self):
+        """The next whole reply, None if it hasn't all arrived"""
+        if self.pos == len(self.buf):
+            return None
+        end = self._end(self.pos)
+        if end == -1:
+            return None
+        reply = bytes(self.buf[self.pos:end])
+        self.pos = end
+        return reply
+
+
+class PeerLink:
+    """A client's connection to another worker, carrying the commands it
+    forwards there. Commands are buffered and sent together, replies come
+    back in the same order."""
+
+    def __init__(self, worker_id, path, blocking=True):
+        self.worker_id = worker_id
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.sock.connect(path)
+        except OSError:
+            self.sock.close()
+            raise
+        self.sock.setblocking(blocking)
+        self.out = []
+        self.replies = ReplySplitter()
+
+    def send(self, data):
+        self.out.append(data)
+
+    def flush(self):
+        if self.out:
+            data = b''.join(self.out)
+            self.out.clear()
+            self.sock.sendall(data)
+
+    def read_reply(self, skip=0):
+        """The next reply, after dropping `skip` replies before it"""
+        for _ in range(skip + 1):
+            while (reply := self.replies.pop()) is None:
+                data = self.sock.recv(PEER_READ_SIZE)
+                if not data:
+                    raise ConnectionError(f"worker {self.worker_id} closed the link")
+                self.replies.feed(data)
+        return reply
+
+    async def flush_async(self, loop):
+        if self.out:
+            data = b''.join(self.out)
+            self.out.clear()
+            await loop.sock_sendall(self.sock, data)
+
+    async def read_reply_async(self, loop, skip=0):
+        for _ in range(skip + 1):
+            while (reply := self.replies.pop()) is None:
+                data = await loop.sock_recv(self.sock, PEER_READ_SIZE)
+                if not data:
+                    raise ConnectionError(f"worker {self.worker_id} closed the link")
+                self.replies.feed(data)
+        return reply
+
+    def close(self):
+        self.sock.close()
+
+
+class ForwardedReply:
+    """Stands in a client's reply buffer for a reply a peer will send.
+
+    The peer answers every command of the forwarded batch; the first `skip`
+    replies (a MULTI and its +QUEUEDs) are dropped."""
+    __slots__ = ('link', 'skip')
+
+    def __init__(self, link, skip):
+        self.link = link
+        self.skip = skip
+
+
+def start_workers(count):
+    """Fork count workers and supervise them.
+
+    Returns (worker id, socket dir, unix listener) in each worker. The parent
+    stays here until the workers are gone: it stops all of them when it is
+    told to stop or when one dies, then exits. The unix sockets the workers
+    forward to each other on are all listening before the first fork, so a
+    worker can connect to a peer that hasn't started yet."""
+    socket_dir = tempfile.mkdtemp(prefix='redis-workers-')
+    listeners = []
+    for i in range(count):
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(peer_path(socket_dir, i))
+        listener.listen(128)
+        listeners.append(listener)
+    pids = {}
+    for i in range(count):
+        pid = os.fork()
+        if pid == 0:
+            for j, listener in enumerate(listeners):
+                if j != i:
+                    listener.close()
+            return i, socket_dir, listeners[i]
+        pids[pid] = i
+    for listener in listeners:
+        listener.close()
+    print(f"Started {count} workers: {', '.join(str(pid) for pid in pids)}")
+
+    stopping = False
+
+    def stop(signum=None, frame=None):
+        nonlocal stopping
+        stopping = True
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    try:
+        while pids:
+            pid, status = os.wait()
+            worker_id = pids.pop(pid, None)
+            if worker_id is not None and not stopping:
+                print(f"Worker {worker_id} exited with code {os.waitstatus_to_exitcode(status)}, stopping the others")
+                stop()
+    finally:
+        shutil.rmtree(socket_dir, ignore_errors=True)
+    sys.exit(0)
@@ -0,0 +1,92 @@
+import itertools
+
+import pytest
+
+from tools.resp_client import Connection, start_server, stop_server
+
+PORT = 6490
+
+
+@pytest.fixture(scope='session')
+def server(tmp_path_factory):
+    # A scratch directory, so no snapshot is loaded or left behind
+    process = start_server('--save', '', '--dir', str(tmp_path_factory.mktemp('data')), port=PORT)
+    yield process
+    stop_server(process)
+
+
+@pytest.fixture
+def r(server):
+    connection = Connection(port=PORT)
+    yield connection
+    connection.close()
+
+
+@pytest.fixture
+def connect(server):
+    """Opens more connections, for a test that needs other clients"""
+    connections = []
+
+    def connect():
+        connections.append(Connection(port=PORT))
+        return connections[-1]
+    yield connect
+    for connection in connections:
+        connection.close()
+
+
+_keys = itertools.count()
+
+
+@pytest.fixture
+def key():
+    """A key no other test has used, as the server is shared"""
+    return f'key:{next(_keys)}'
+
+
+_ports = itertools.count(PORT + 1)
+
+
+class Server:
+    """A server of a test's own, for tests that restart it or need
+    options of their own. It runs in the test's scratch directory."""
+    def __init__(self, directory, args):
+        self.port = next(_ports)
+        self.directory = directory
+        self.args = args
+        self.process = None
+        self.connections = []
+
+    def start(self):
+        self.process = start_server('--dir', str(self.directory), *self.args, port=self.port)
+
+    def stop(self):
+        for connection in self.connections:
+            connection.close()
+        self.connections.clear()
+        if self.process is not None:
+            stop_server(self.process)
+            self.process = None
+
+    def restart(self):
+        self.stop()
+        self.start()
+
+    def connect(self):
+        self.connections.append(Connection(port=self.port))
+        return self.connections[-1]
+
+
+@pytest.fixture
+def own_server(tmp_path):
+    """own_server(*options) starts a Server, stopped again after the test"""
+    servers = []
+
+    def own_server(*args):
+        server = Server(tmp_path, args)
+        server.start()
+        servers.append(server)
+        return server
+    yield own_server
+    for server in servers:
+        server.stop()
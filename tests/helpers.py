@@ -0,0 +1,16 @@
+import time
+
+
+def wait_for(condition, timeout=10):
+    """Poll until condition() is true, for what the server does in the background"""
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("timed out waiting for the server")
+        time.sleep(0.02)
+
+
+def info(connection, section):
+    """An INFO section as a dict of str values"""
+    lines = connection('INFO', section).decode().split('\r\n')
+    return dict(line.split(':', 1) for line in lines if ':' in line)
@@ -0,0 +1,87 @@
+import pytest
+
+from helpers import info, wait_for
+
+
+@pytest.mark.parametrize('policy', ['always', 'everysec', 'no'])
+def test_fsync_policies(own_server, policy):
+    server = own_server('--appendonly', 'yes', '--appendfsync', policy)
+    r = server.connect()
+    assert r('CONFIG', 'GET', 'appendfsync') == [b'appendfsync', policy.encode()]
+    r('SET', 'a', 'hello')
+    r('INCR', 'n')
+    r('RPUSH', 'list', 'x', 'y')
+    # Whatever the policy, a write reaches the file before its reply is sent
+    log = (server.directory / 'appendonly.aof').read_bytes()
+    assert b'$4\r\nINCR\r\n$1\r\nn\r\n' in log and log.endswith(b'$1\r\nx\r\n$1\r\ny\r\n')
+
+    server.restart()
+    r = server.connect()
+    assert r('GET', 'a') == b'hello' and r('GET', 'n') == b'1'
+    assert r('LRANGE', 'list', 0, -1) == [b'x', b'y']
+
+
+def test_truncated_last_command(own_server):
+    server = own_server('--appendonly', 'yes', '--appendfsync', 'always')
+    r = server.connect()
+    r('SET', 'a', '1')
+    r('RPUSH', 'list', 'x')
+    server.stop()
+    path = server.directory / 'appendonly.aof'
+    complete = path.read_bytes()
+    # The server died in the middle of writing a command
+    with open(path, 'ab') as f:
+        f.write(b'*3\r\n$3\r\nSET\r\n$1\r\nb\r\n$5\r\nab')
+
+    server.start()
+    r = server.connect()
+    assert r('GET', 'a') == b'1' and r('LRANGE', 'list', 0, -1) == [b'x']
+    assert r('EXISTS', 'b') == 0
+    # The partial command is cut off, so what comes next is appended after it
+    assert path.read_bytes() == complete
+    r('SET', 'b', '2')
+    server.restart()
+    assert server.connect()('GET', 'b') == b'2'
+
+
+def test_rewrite_round_trip(own_server):
+    server = own_server('--appendonly', 'yes')
+    r = server.connect()
+    r('RPUSH', 'list', *range(200))
+    r('LPOP', 'list', 50)
+    r('SET', 'counter', 10)
+    r('INCRBY', 'counter', 5)
+    r('SET', 'expiring', 'soon', 'PX', 100000)
+    r('SET', 'gone', 'x', 'PX', 1)
+    for i in range(1, 6):
+        r('XADD', 'stream', f'{i}-0', 'field', i)
+    r('XDEL', 'stream', '5-0')
+    r('XGROUP', 'CREATE', 'stream', 'group', '0')
+    r('XREADGROUP', 'GROUP', 'group', 'alice', 'COUNT', 3, 'STREAMS', 'stream', '>')
+    r('XACK', 'stream', 'group', '1-0')
+    r('XGROUP', 'CREATECONSUMER', 'stream', 'group', 'bob')
+    before = {
+        'list': r('LRANGE', 'list', 0, -1),
+        'stream': r('XRANGE', 'stream', '-', '+'),
+        'pending': r('XPENDING', 'stream', 'group', '-', '+', 10),
+    }
+    size = (server.directory / 'appendonly.aof').stat().st_size
+
+    assert r('BGREWRITEAOF') == 'Background append only file rewriting started'
+    wait_for(lambda: info(r, 'persistence')['aof_rewrite_in_progress'] == '0')
+    assert (server.directory / 'appendonly.aof').stat().st_size < size
+    server.restart()
+    r = server.connect()
+
+    assert r('LRANGE', 'list', 0, -1) == before['list']
+    assert r('GET', 'counter') == b'15' and r('EXISTS', 'gone') == 0
+    assert 0 < r('PTTL', 'expiring') <= 100000
+    assert r('XRANGE', 'stream', '-', '+') == before['stream']
+    assert [p[:2] + p[3:] for p in r('XPENDING', 'stream', 'group', '-', '+', 10)] == \
+        [p[:2] + p[3:] for p in before['pending']]
+    # CREATECONSUMER answers 0 for a consumer that exists, even one with nothing pending
+    assert r('XGROUP', 'CREATECONSUMER', 'stream', 'group', 'bob') == 0
+    assert r('XREADGROUP', 'GROUP', 'group', 'alice', 'STREAMS', 'stream', '>') == \
+        [[b'stream', [[b'4-0', [b'field', b'4']]]]]
+    # The stream's last ID outlives its deleted top entry
+    assert isinstance(r('XADD', 'stream', '5-0', 'f', 'v'), Exception)
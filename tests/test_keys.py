@@ -0,0 +1,66 @@
+from app.cluster import key_hash_slot
+from app.workers import key_worker
+from helpers import wait_for
+
+
+def test_msetnx_all_or_nothing(r, key):
+    assert r('MSETNX', key + ':a', 1, key + ':b', 2) == 1
+    assert r('MGET', key + ':a', key + ':b') == [b'1', b'2']
+    # One existing key and none of them is set
+    assert r('MSETNX', key + ':c', 3, key + ':b', 'new', key + ':d', 4) == 0
+    assert r('MGET', key + ':b', key + ':c', key + ':d') == [b'2', None, None]
+    # A key of another type counts as existing too
+    r('RPUSH', key + ':list', 'x')
+    assert r('MSETNX', key + ':e', 5, key + ':list', 6) == 0
+    assert r('EXISTS', key + ':e') == 0
+    assert str(r('MSETNX', key + ':f', 1, key + ':g')).startswith('ERR wrong number of arguments')
+
+
+def test_exists_counts_each_argument(r, key):
+    r('SET', key, 'v')
+    assert r('EXISTS', key) == 1
+    assert r('EXISTS', key, key) == 2
+    assert r('EXISTS', key, key + ':missing', key) == 2
+    r('SET', key + ':expired', 'v', 'PX', 1)
+    wait_for(lambda: r('EXISTS', key + ':expired', key + ':expired') == 0)
+
+
+def test_crossslot_in_cluster_mode(own_server):
+    r = own_server('--cluster-enabled', 'yes').connect()
+    assert r('CLUSTER', 'ADDSLOTSRANGE', 0, 16383) == 'OK'
+    wait_for(lambda: b'cluster_state:ok' in r('CLUSTER', 'INFO'))
+    assert key_hash_slot(b'a') != key_hash_slot(b'b')
+    for command in [('MSET', 'a', 1, 'b', 2), ('MSETNX', 'a', 1, 'b', 2), ('MGET', 'a', 'b'),
+                    ('EXISTS', 'a', 'b'), ('DEL', 'a', 'b')]:
+        assert str(r(*command)) == "CROSSSLOT Keys in request don't hash to the same slot"
+    # Keys sharing a hash tag are in the same slot
+    assert r('MSET', '{user}:a', 1, '{user}:b', 2) == 'OK'
+    assert r('MSETNX', '{user}:b', 3, '{user}:c', 4) == 0
+    assert r('EXISTS', '{user}:a', '{user}:b', '{user}:a') == 3
+    # The same key twice is one slot
+    assert r('MSET', 'a', 1, 'a', 2) == 'OK' and r('GET', 'a') == b'2'
+
+
+def test_crossslot_in_worker_mode(own_server):
+    r = own_server('--workers', '2').connect()
+    assert key_worker(b'a', 2) != key_worker(b'b', 2)
+    for command in [('MSET', 'a', 1, 'b', 2), ('MSETNX', 'a', 1, 'b', 2), ('MGET', 'a', 'b'),
+                    ('EXISTS', 'a', 'b'), ('DEL', 'a', 'b')]:
+        assert str(r(*command)) == "CROSSSLOT Keys in request don't hash to the same worker"
+    assert r('EXISTS', 'a') == r('EXISTS', 'b') == 0
+    # Keys of one worker work as usual, whether or not it's the one the client is on
+    keys = [b'a', b'b', b'c', b'd', b'e', b'f', b'g']
+    for worker in range(2):
+        group = [key for key in keys if key_worker(key, 2) == worker]
+        assert len(group) >= 2
+        assert r('MSET', *[part for key in group for part in (key, key)]) == 'OK'
+        assert r('MGET', *group) == group
+        assert r('EXISTS', *group, group[0]) == len(group) + 1
+        assert r('MSETNX', group[0], 'x', group[1], 'y') == 0
+        assert r('GET', group[0]) == group[0]
+    # A transaction whose keys span workers is refused whole
+    r('MULTI')
+    r('SET', 'a', 'changed')
+    r('SET', 'b', 'changed')
+    assert str(r('EXEC')).startswith('CROSSSLOT')
+    assert r('MGET', 'a') == [b'a']
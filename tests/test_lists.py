@@ -0,0 +1,126 @@
+import time
+
+
+def test_push_and_range(r, key):
+    assert r('RPUSH', key, 'b', 'c') == 2
+    assert r('LPUSH', key, 'a') == 3
+    assert r('LLEN', key) == 3
+    assert r('LRANGE', key, 0, -1) == [b'a', b'b', b'c']
+    assert r('LRANGE', key, -2, 10) == [b'b', b'c']
+
+
+def test_pop(r, key):
+    r('RPUSH', key, 'a', 'b', 'c', 'd')
+    assert r('LPOP', key) == b'a'
+    assert r('RPOP', key) == b'd'
+    assert r('LPOP', key, 5) == [b'b', b'c']
+    # A list popped empty is deleted
+    assert r('TYPE', key) == 'none'
+    assert r('LPOP', key) is None
+    assert r('RPOP', key) is None
+
+
+def test_push_and_pop_across_chunks(r, key):
+    # Many more items than a chunk holds, pushed and popped at both ends
+    r('RPUSH', key, *range(500, 1000))
+    r('LPUSH', key, *range(499, -1, -1))
+    assert r('LLEN', key) == 1000
+    assert r('LRANGE', key, 0, -1) == [b'%d' % i for i in range(1000)]
+    assert r('LRANGE', key, 250, 260) == [b'%d' % i for i in range(250, 261)]
+    assert r('LPOP', key, 300) == [b'%d' % i for i in range(300)]
+    assert [r('RPOP', key) for _ in range(300)] == [b'%d' % i for i in range(999, 699, -1)]
+    assert r('LRANGE', key, 0, -1) == [b'%d' % i for i in range(300, 700)]
+
+
+def test_lindex_and_lset(r, key):
+    r('RPUSH', key, 'a', 'b', 'c')
+    assert r('LINDEX', key, 1) == b'b'
+    assert r('LINDEX', key, -1) == b'c'
+    assert r('LINDEX', key, 3) is None
+    assert r('LSET', key, -2, 'x') == 'OK'
+    assert r('LRANGE', key, 0, -1) == [b'a', b'x', b'c']
+    assert 'out of range' in str(r('LSET', key, 5, 'y'))
+    assert 'no such key' in str(r('LSET', key + ':missing', 0, 'y'))
+
+
+def test_ltrim(r, key):
+    r('RPUSH', key, *range(10))
+    assert r('LTRIM', key, 2, -3) == 'OK'
+    assert r('LRANGE', key, 0, -1) == [b'2', b'3', b'4', b'5', b'6', b'7']
+    assert r('LTRIM', key, 5, 1) == 'OK'
+    assert r('TYPE', key) == 'none'
+
+
+def test_lmove_between_keys(r, key):
+    destination = key + ':dst'
+    r('RPUSH', key, 'a', 'b')
+    assert r('LMOVE', key, destination, 'LEFT', 'RIGHT') == b'a'
+    assert r('LMOVE', key, destination, 'RIGHT', 'LEFT') == b'b'
+    assert r('TYPE', key) == 'none'
+    assert r('LRANGE', destination, 0, -1) == [b'b', b'a']
+    assert r('LMOVE', key, destination, 'LEFT', 'LEFT') is None
+
+
+def test_lmove_rotates_same_key(r, key):
+    r('RPUSH', key, 'a', 'b', 'c')
+    assert r('LMOVE', key, key, 'LEFT', 'RIGHT') == b'a'
+    assert r('LRANGE', key, 0, -1) == [b'b', b'c', b'a']
+    assert r('LMOVE', key, key, 'RIGHT', 'LEFT') == b'a'
+    assert r('LRANGE', key, 0, -1) == [b'a', b'b', b'c']
+
+
+def test_lmove_same_key_single_element(r, key):
+    r('RPUSH', key, 'only')
+    assert r('LMOVE', key, key, 'RIGHT', 'LEFT') == b'only'
+    assert r('EXISTS', key) == 1
+    assert r('LRANGE', key, 0, -1) == [b'only']
+
+def test_wrong_type(r, key):
+    r('SET', key, 'x')
+    for command in (['LINDEX', key, 0], ['LSET', key, 0, 'a'], ['LTRIM', key, 0, 1],
+                    ['LMOVE', key, key + ':dst', 'LEFT', 'LEFT']):
+        assert 'WRONGTYPE' in str(r(*command)), command
+
+
+def test_blpop(r, connect, key):
+    r('RPUSH', key, 'x')
+    assert r('BLPOP', key, 0) == [key.encode(), b'x']
+    waiter = connect()
+    waiter.send('BLPOP', key, 0)
+    time.sleep(0.1)
+    r('RPUSH', key, 'y')
+    assert waiter.read_reply() == [key.encode(), b'y']
+    assert r('TYPE', key) == 'none'
+
+
+def test_blpop_serves_clients_in_the_order_they_blocked(r, connect, key):
+    waiters = []
+    for _ in range(5):
+        waiter = connect()
+        waiter.send('BLPOP', key, 0)
+        # Blocked before the next one comes
+        time.sleep(0.05)
+        waiters.append(waiter)
+    r('RPUSH', key, *range(5))
+    assert [waiter.read_reply() for waiter in waiters] == [[key.encode(), b'%d' % i] for i in range(5)]
+
+
+def test_blpop_several_keys(r, connect, key):
+    r('RPUSH', key + ':b', 'x')
+    assert r('BLPOP', key + ':a', key + ':b', 0) == [(key + ':b').encode(), b'x']
+    assert r('TYPE', key + ':b') == 'none'
+    waiter = connect()
+    waiter.send('BLPOP', key + ':a', key + ':b', 0)
+    time.sleep(0.1)
+    r('RPUSH', key + ':b', 'y')
+    assert waiter.read_reply() == [(key + ':b').encode(), b'y']
+    assert 'negative' in str(r('BLPOP', key, -1))
+
+
+def test_blpop_wrong_type(r, key):
+    r('SET', key, 'x')
+    start = time.monotonic()
+    assert 'WRONGTYPE' in str(r('BLPOP', key, 0))
+    assert 'WRONGTYPE' in str(r('BLPOP', key + ':empty', key, 0.5))
+    # Answered at once instead of waiting out the timeout
+    assert time.monotonic() - start < 0.4
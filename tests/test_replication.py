@@ -0,0 +1,125 @@
+from helpers import info, wait_for
+
+
+def master_and_replicas(own_server, count=1, *args):
+    master = own_server('--repl-diskless-sync-delay', '0', *args)
+    replicas = [own_server('--replicaof', f'localhost {master.port}') for _ in range(count)]
+    m = master.connect()
+    wait_for(lambda: info(m, 'replication')['connected_slaves'] == str(count))
+    for replica in replicas:
+        connection = replica.connect()
+        wait_for(lambda: info(connection, 'replication')['master_link_status'] == 'up')
+    return master, replicas
+
+
+def read_snapshot(connection):
+    """Read a full sync off a raw PSYNC connection: the +FULLRESYNC line
+    and the snapshot header, then the snapshot itself as far as the header
+    tells where it ends"""
+    fullresync = connection.reader.readline()
+    header = connection.reader.readline()
+    while header == b'\n':
+        header = connection.reader.readline()
+    if header.startswith(b'$EOF:'):
+        mark = header[5:-2]
+        payload = b''
+        while not payload.endswith(mark):
+            payload += connection.reader.read1(65536)
+        return fullresync, header[:5], payload[:-len(mark)]
+    return fullresync, header[:1], connection.reader.read(int(header[1:-2]))
+
+
+def test_replica_follows_master(own_server):
+    master, (replica,) = master_and_replicas(own_server)
+    m, s = master.connect(), replica.connect()
+    m('SET', 'a', '1')
+    m('RPUSH', 'list', 'x', 'y')
+    m('XADD', 'stream', '1-1', 'f', 'v')
+    wait_for(lambda: s('EXISTS', 'a', 'list', 'stream') == 3)
+    assert s('LRANGE', 'list', 0, -1) == [b'x', b'y']
+    assert str(s('SET', 'b', '2')).startswith('READONLY')
+    assert info(s, 'replication')['master_repl_offset'] == info(m, 'replication')['master_repl_offset']
+
+
+def test_partial_resync_from_backlog(own_server):
+    master, (replica,) = master_and_replicas(own_server, 1, '--repl-backlog-size', '4kb')
+    m = master.connect()
+    m('SET', 'a', '1')
+    replication = info(m, 'replication')
+    replid, offset = replication['master_replid'], int(replication['master_repl_offset'])
+    m('SET', 'b', '2')
+    m('RPUSH', 'list', 'x')
+
+    # Resuming after the last byte seen gets just what came after it
+    link = master.connect()
+    assert link('PSYNC', replid, offset + 1) == f'CONTINUE {replid}'
+    assert link.read_reply() == [b'SET', b'b', b'2']
+    assert link.read_reply() == [b'RPUSH', b'list', b'x']
+    # and then the writes as they happen
+    m('INCR', 'n')
+    assert link.read_reply() == [b'INCR', b'n']
+
+    # Once the backlog has moved past the offset, or for another history, it's a full sync
+    m('SET', 'big', 'x' * 8000)
+    assert int(info(m, 'replication')['repl_backlog_first_byte_offset']) > offset + 1
+    late = master.connect()
+    late.send('PSYNC', replid, offset + 1)
+    assert read_snapshot(late)[0].startswith(f'+FULLRESYNC {replid} '.encode())
+    stranger = master.connect()
+    stranger.send('PSYNC', 'f' * 40, 1)
+    assert read_snapshot(stranger)[0].startswith(b'+FULLRESYNC')
+
+    # The replica that stayed connected missed nothing
+    s = replica.connect()
+    wait_for(lambda: s('GET', 'n') == b'1')
+    assert s('STRLEN', 'big') == 8000
+
+
+def test_diskless_full_sync(own_server):
+    master = own_server('--repl-diskless-sync', 'yes', '--repl-diskless-sync-delay', '0')
+    m = master.connect()
+    m('RPUSH', 'list', *range(1000))
+    m('SET', 'expiring', 'v', 'PX', 100000)
+    for i in range(1, 101):
+        m('XADD', 'stream', f'{i}-0', 'f', i)
+    m('XGROUP', 'CREATE', 'stream', 'group', '0')
+    m('XREADGROUP', 'GROUP', 'group', 'alice', 'COUNT', 10, 'STREAMS', 'stream', '>')
+
+    # A replica that announces capa eof is sent the snapshot with an EOF mark
+    link = master.connect()
+    assert link('REPLCONF', 'capa', 'eof', 'capa', 'psync2') == 'OK'
+    link.send('PSYNC', '?', -1)
+    fullresync, header, payload = read_snapshot(link)
+    assert fullresync.startswith(b'+FULLRESYNC') and header == b'$EOF:'
+    assert payload.startswith(b'REDIS')
+    # and one that doesn't gets a length up front
+    legacy = master.connect()
+    legacy.send('PSYNC', '?', -1)
+    assert read_snapshot(legacy)[1] == b'$'
+
+    replica = own_server('--replicaof', f'localhost {master.port}')
+    s = replica.connect()
+    wait_for(lambda: info(s, 'replication')['master_link_status'] == 'up')
+    assert s('LRANGE', 'list', 0, -1) == m('LRANGE', 'list', 0, -1)
+    assert 0 < s('PTTL', 'expiring') <= 100000
+    assert s('XRANGE', 'stream', '-', '+') == m('XRANGE', 'stream', '-', '+')
+    assert s('XPENDING', 'stream', 'group')[0] == 10
+    # Writes made once the transfer is over still follow
+    m('SET', 'after', '1')
+    wait_for(lambda: s('GET', 'after') == b'1')
+
+
+def test_wait_counts_replica_acks(own_server):
+    master, replicas = master_and_replicas(own_server, 2)
+    m = master.connect()
+    assert m('WAIT', 0, 0) == 2
+    m('SET', 'a', '1')
+    assert m('WAIT', 2, 5000) == 2
+    # More replicas than there are: it waits out the timeout, then counts them
+    assert m('WAIT', 3, 100) == 2
+
+    replicas[1].stop()
+    wait_for(lambda: info(m, 'replication')['connected_slaves'] == '1')
+    m('SET', 'b', '2')
+    assert m('WAIT', 2, 100) == 1
+    assert str(replicas[0].connect()('WAIT', 1, 0)).startswith('ERR WAIT cannot be used')
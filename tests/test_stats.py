@@ -0,0 +1,102 @@
+from helpers import info
+
+
+def test_info_memory(r, own_server):
+    memory = info(r, 'memory')
+    # Without maxmemory nothing adds up the keys' sizes, so there is no used_memory
+    assert 'used_memory' not in memory
+    assert int(memory['used_memory_rss']) > 0 and memory['maxmemory'] == '0'
+
+    limited = own_server('--maxmemory', '10mb').connect()
+    assert info(limited, 'memory')['used_memory'] == '0'
+    limited('SET', 'a', 'x' * 1000)
+    assert int(info(limited, 'memory')['used_memory']) >= 1000
+
+
+def test_crossslot_is_a_rejected_call(own_server):
+    r = own_server('--workers', '2').connect()
+    keys = [b'k%d' % i for i in range(20)]
+    errors = 0
+    for other in keys[1:]:
+        reply = r('MSET', keys[0], 1, other, 2)
+        errors += reply != 'OK'
+    assert errors > 0
+    stats = info(r, 'commandstats')['cmdstat_mset']
+    assert f'rejected_calls={errors},' in stats
+
+
+def test_command_calls(own_server):
+    r = own_server().connect()
+    for i in range(5):
+        r('SET', f'k{i}', i)
+    r('GET', 'k0')
+    r('LPUSH', 'k0', 'x')
+    r('GET')
+    stats = info(r, 'commandstats')
+    assert stats['cmdstat_set'].startswith('calls=5,')
+    # A command that replies an error failed; one refused before it ran was rejected
+    assert stats['cmdstat_lpush'].endswith(',rejected_calls=0,failed_calls=1')
+    assert stats['cmdstat_get'].startswith('calls=1,')
+    assert stats['cmdstat_get'].endswith(',rejected_calls=1,failed_calls=0')
+    assert 'cmdstat_del' not in stats
+
+    assert r('CONFIG', 'RESETSTAT') == 'OK'
+    # A command is counted once it has run: the CONFIG, not yet this INFO
+    assert list(info(r, 'commandstats')) == ['cmdstat_config']
+
+
+def test_commandstats_format(own_server):
+    r = own_server().connect()
+    r('SET', 'a', 1)
+    r('SET', 'b', 2)
+    text = r('INFO', 'commandstats').decode()
+    assert text.startswith('# Commandstats\r\n')
+    line = next(line for line in text.split('\r\n') if line.startswith('cmdstat_set:'))
+    fields = dict(field.split('=') for field in line[len('cmdstat_set:'):].split(','))
+    assert list(fields) == ['calls', 'usec', 'usec_per_call', 'rejected_calls', 'failed_calls']
+    assert fields['calls'] == '2' and fields['usec_per_call'] == f"{int(fields['usec']) / 2:.2f}"
+    # Only asked for, not part of the default INFO
+    assert '# Commandstats' not in r('INFO').decode()
+    assert '# Commandstats' in r('INFO', 'all').decode()
+
+    histogram = r('LATENCY', 'HISTOGRAM', 'set')
+    assert histogram[0] == b'set' and histogram[1][:2] == [b'calls', 2]
+    assert histogram[1][3][-1] == 2
+
+
+def test_slowlog_threshold_and_length(own_server):
+    r = own_server().connect()
+    # Nothing here is slow at the default 10ms
+    r('SET', 'a', 1)
+    assert r('SLOWLOG', 'LEN') == 0
+    assert r('CONFIG', 'SET', 'slowlog-log-slower-than', 0) == 'OK'
+    r('SET', 'a', 2)
+    r('GET', 'a')
+    entries = r('SLOWLOG', 'GET')
+    # Newest first, including the CONFIG SET that lowered the threshold
+    assert [entry[3] for entry in entries] == [[b'GET', b'a'], [b'SET', b'a', b'2'],
+                                               [b'CONFIG', b'SET', b'slowlog-log-slower-than', b'0']]
+    entry_id, when, usec, args, address, name = entries[0]
+    assert entries[1][0] == entry_id - 1 and usec >= 0 and address.startswith(b'127.0.0.1:')
+    # SLOWLOG is logged too, once it has replied
+    assert r('SLOWLOG', 'GET', 1)[0][3] == [b'SLOWLOG', b'GET']
+
+    # Long commands are cut short
+    r('RPUSH', 'list', *range(40))
+    r('SET', 'long', 'x' * 200)
+    long_set, rpush = [entry[3] for entry in r('SLOWLOG', 'GET', 2)]
+    assert long_set[2] == b'x' * 128 + b'... (72 more bytes)'
+    assert len(rpush) == 32 and rpush[-1] == b'... (11 more arguments)'
+
+    assert r('CONFIG', 'SET', 'slowlog-max-len', 2) == 'OK'
+    assert r('SLOWLOG', 'LEN') == 2
+    for i in range(5):
+        r('INCR', 'n')
+    assert [entry[3] for entry in r('SLOWLOG', 'GET', -1)] == [[b'INCR', b'n']] * 2
+
+    # A negative threshold logs nothing
+    r('CONFIG', 'SET', 'slowlog-log-slower-than', -1)
+    assert r('SLOWLOG', 'RESET') == 'OK'
+    r('SET', 'a', 3)
+    assert r('SLOWLOG', 'LEN') == 0 and r('SLOWLOG', 'GET') == []
+    assert str(r('CONFIG', 'SET', 'slowlog-max-len', -1)).endswith('can not be negative')
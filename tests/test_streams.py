@@ -0,0 +1,219 @@
+import time
+
+from helpers import info, wait_for
+
+
+def test_xadd_ids(r, key):
+    assert r('XADD', key, '1-1', 'a', '1') == b'1-1'
+    assert r('XADD', key, '1-*', 'a', '2') == b'1-2'
+    assert r('XADD', key, '5-*', 'a', '3') == b'5-0'
+    assert 'equal or smaller' in str(r('XADD', key, '5-0', 'a', '4'))
+    assert 'greater than 0-0' in str(r('XADD', key, '0-0', 'a', '4'))
+    ms, seq = r('XADD', key, '*', 'a', '5').split(b'-')
+    assert int(ms) > 5 and seq == b'0'
+    assert r('TYPE', key) == 'stream'
+
+
+def test_xrange(r, key):
+    for i in range(1, 6):
+        r('XADD', key, f'{i}-1', 'n', i)
+    assert r('XRANGE', key, '-', '+') == [[f'{i}-1'.encode(), [b'n', str(i).encode()]] for i in range(1, 6)]
+    assert [entry[0] for entry in r('XRANGE', key, '2', '4')] == [b'2-1', b'3-1', b'4-1']
+    assert [entry[0] for entry in r('XRANGE', key, '2-2', '4-0')] == [b'3-1']
+    assert r('XRANGE', key, '6', '+') == []
+
+
+def test_xread(r, key):
+    other = key + ':other'
+    r('XADD', key, '1-1', 'a', '1')
+    r('XADD', key, '2-1', 'a', '2')
+    r('XADD', other, '1-1', 'b', '1')
+    assert r('XREAD', 'STREAMS', key, other, '1-1', '0-0') == [
+        [key.encode(), [[b'2-1', [b'a', b'2']]]],
+        [other.encode(), [[b'1-1', [b'b', b'1']]]],
+    ]
+
+
+def test_xread_block(r, connect, key):
+    r('XADD', key, '1-1', 'a', '1')
+    reader = connect()
+    reader.send('XREAD', 'BLOCK', 0, 'STREAMS', key, '$')
+    time.sleep(0.1)
+    r('XADD', key, '2-1', 'a', '2')
+    assert reader.read_reply() == [[key.encode(), [[b'2-1', [b'a', b'2']]]]]
+    start = time.monotonic()
+    assert reader('XREAD', 'BLOCK', 100, 'STREAMS', key, '2-1') is None
+    assert time.monotonic() - start >= 0.09
+
+
+def test_xrevrange_and_count(r, key):
+    for i in range(1, 6):
+        r('XADD', key, f'{i}-1', 'n', i)
+    assert [entry[0] for entry in r('XREVRANGE', key, '+', '-')] == [b'5-1', b'4-1', b'3-1', b'2-1', b'1-1']
+    assert [entry[0] for entry in r('XREVRANGE', key, '4', '2', 'COUNT', 2)] == [b'4-1', b'3-1']
+    assert [entry[0] for entry in r('XRANGE', key, '-', '+', 'COUNT', 2)] == [b'1-1', b'2-1']
+    assert [entry[0] for entry in r('XREAD', 'COUNT', 1, 'STREAMS', key, '2-1')[0][1]] == [b'3-1']
+
+
+def test_ranges_across_nodes(r, key):
+    # Enough entries for many nodes, some with other fields than the node's first
+    entries = []
+    for i in range(1, 1001):
+        fields = [b'n', b'%d' % i] if i % 7 else [b'other', b'x' * (i % 50), b'n', b'%d' % i]
+        r('XADD', key, f'{i // 3}-{i % 3}', *fields)
+        entries.append([f'{i // 3}-{i % 3}'.encode(), fields])
+    assert r('XRANGE', key, '-', '+') == entries
+    assert r('XRANGE', key, '100', '200-1') == entries[299:601]
+    assert r('XREVRANGE', key, '200-1', '100', 'COUNT', 150) == entries[600:450:-1]
+    assert r('XREAD', 'COUNT', 250, 'STREAMS', key, '33-1') == [[key.encode(), entries[100:350]]]
+
+
+def test_xread_lists_only_streams_with_new_entries(r, connect, key):
+    other = key + ':other'
+    r('XADD', key, '1-1', 'a', '1')
+    r('XADD', other, '1-1', 'a', '1')
+    r('XADD', other, '2-1', 'a', '2')
+    assert r('XREAD', 'STREAMS', key, other, '1-1', '1-1') == [[other.encode(), [[b'2-1', [b'a', b'2']]]]]
+    reader = connect()
+    reader.send('XREAD', 'BLOCK', 0, 'STREAMS', key, other, '1-1', '2-1')
+    time.sleep(0.1)
+    r('XADD', other, '3-1', 'a', '3')
+    assert reader.read_reply() == [[other.encode(), [[b'3-1', [b'a', b'3']]]]]
+
+
+def test_pending_entries_per_consumer(r, key):
+    for i in range(1, 301):
+        r('XADD', key, f'{i}-0', 'n', i)
+    r('XGROUP', 'CREATE', key, 'g', '0')
+    # Alternate deliveries between two consumers, then move some to a third
+    for i in range(150):
+        r('XREADGROUP', 'GROUP', 'g', 'alice' if i % 2 else 'bob', 'COUNT', 2, 'STREAMS', key, '>')
+    assert r('XCLAIM', key, 'g', 'carol', 0, '3-0', '200-0', 'JUSTID') == [b'3-0', b'200-0']
+    summary = r('XPENDING', key, 'g')
+    assert summary[:3] == [300, b'1-0', b'300-0']
+    assert sorted(summary[3]) == [[b'alice', b'148'], [b'bob', b'150'], [b'carol', b'2']]
+
+    alice = r('XPENDING', key, 'g', '-', '+', 1000, 'alice')
+    expected = [f'{i}-0'.encode() for i in range(1, 301) if (i - 1) // 2 % 2 and i not in (3, 200)]
+    assert [entry[0] for entry in alice] == expected
+    assert [entry[0] for entry in r('XPENDING', key, 'g', '10', '20', 3, 'alice')] == [b'11-0', b'12-0', b'15-0']
+
+    # Acknowledge the oldest entries first, as a FIFO consumer does
+    assert r('XACK', key, 'g', *[f'{i}-0' for i in range(1, 101)]) == 100
+    assert r('XPENDING', key, 'g')[:3] == [200, b'101-0', b'300-0']
+    assert r('XACK', key, 'g', '1-0') == 0
+
+    assert r('XGROUP', 'DELCONSUMER', key, 'g', 'bob') == 100
+    summary = r('XPENDING', key, 'g')
+    assert summary[0] == 100 and sorted(summary[3]) == [[b'alice', b'99'], [b'carol', b'1']]
+    assert len(r('XPENDING', key, 'g', '-', '+', 1000)) == 100
+
+
+def test_xautoclaim_walks_the_pending_entries(r, key):
+    for i in range(1, 11):
+        r('XADD', key, f'{i}-0', 'n', i)
+    r('XGROUP', 'CREATE', key, 'g', '0')
+    r('XREADGROUP', 'GROUP', 'g', 'alice', 'STREAMS', key, '>')
+    r('XACK', key, 'g', '4-0', '5-0')
+    cursor, claimed, _ = r('XAUTOCLAIM', key, 'g', 'bob', 0, '0-0', 'COUNT', 4, 'JUSTID')
+    assert claimed == [b'1-0', b'2-0', b'3-0', b'6-0'] and cursor == b'7-0'
+    cursor, claimed, _ = r('XAUTOCLAIM', key, 'g', 'bob', 0, cursor, 'COUNT', 4, 'JUSTID')
+    assert claimed == [b'7-0', b'8-0', b'9-0', b'10-0'] and cursor == b'0-0'
+
+
+def test_xadd_maxlen_and_minid(r, key):
+    for i in range(1, 1001):
+        r('XADD', key, 'MAXLEN', 500, f'{i}-0', 'n', i)
+    assert len(r('XRANGE', key, '-', '+')) == 500
+    assert r('XRANGE', key, '-', '+', 'COUNT', 1)[0][0] == b'501-0'
+    # ~ only drops whole nodes, so it may keep a few more
+    r('XADD', key, 'MAXLEN', '~', 250, '1001-0', 'n', 1001)
+    left = len(r('XRANGE', key, '-', '+'))
+    assert 250 <= left < 250 + 100
+    r('XADD', key, 'MINID', '=', 900, '1002-0', 'n', 1002)
+    assert r('XRANGE', key, '-', '+', 'COUNT', 1)[0][0] == b'900-0'
+
+
+def test_xtrim(r, key):
+    for i in range(1, 301):
+        r('XADD', key, f'{i}-0', 'n', i)
+    assert r('XTRIM', key, 'MAXLEN', 100) == 200
+    assert r('XTRIM', key, 'MINID', 250) == 49
+    assert [entry[0] for entry in r('XRANGE', key, '-', '+', 'COUNT', 2)] == [b'250-0', b'251-0']
+    assert r('XTRIM', key, 'MAXLEN', '~', 0, 'LIMIT', 10) == 0
+
+
+def test_xdel(r, key):
+    for i in range(1, 11):
+        r('XADD', key, f'{i}-0', 'n', i)
+    assert r('XDEL', key, '3-0', '4-0', '4-0', '11-0') == 2
+    assert [entry[0] for entry in r('XRANGE', key, '2', '5')] == [b'2-0', b'5-0']
+    assert [entry[0] for entry in r('XREVRANGE', key, '5', '2')] == [b'5-0', b'2-0']
+    # Deleting the newest entry doesn't let an older ID in
+    assert r('XDEL', key, '10-0') == 1
+    assert 'equal or smaller' in str(r('XADD', key, '10-0', 'n', 10))
+    assert r('XADD', key, '10-*', 'n', 10) == b'10-1'
+
+
+def test_xsetid(r, key):
+    r('XADD', key, '1-0', 'n', 1)
+    assert r('XSETID', key, '5-0') == 'OK'
+    assert r('XADD', key, '5-*', 'n', 2) == b'5-1'
+    assert 'smaller' in str(r('XSETID', key, '2-0'))
+
+
+def test_xread_skips_deleted_top_entries(r, key):
+    r('XADD', key, '1-1', 'a', '1')
+    r('XADD', key, '2-1', 'a', '2')
+    assert r('XDEL', key, '2-1') == 1
+    assert r('XREAD', 'STREAMS', key, '1-1') == []
+    r('XADD', key, '3-1', 'a', '3')
+    r('XTRIM', key, 'MINID', '4')
+    assert r('XREAD', 'STREAMS', key, '0-0') == []
+
+
+def test_xread_block_waits_past_deleted_entries(r, connect, key):
+    r('XADD', key, '1-1', 'a', '1')
+    r('XADD', key, '2-1', 'a', '2')
+    r('XDEL', key, '2-1')
+    reader = connect()
+    # Nothing new came in, so the read times out instead of answering at once
+    start = time.monotonic()
+    assert reader('XREAD', 'BLOCK', 100, 'STREAMS', key, '1-1') is None
+    assert time.monotonic() - start >= 0.09
+
+
+def pending_state(r, key):
+    # XPENDING without the idle times, which move on with the clock
+    summary = r('XPENDING', key, 'g')
+    entries = [[entry_id, consumer, count] for entry_id, consumer, _, count in
+               r('XPENDING', key, 'g', '-', '+', 100)]
+    return summary, entries
+
+
+def test_pending_entries_survive_restart_and_rewrite(own_server):
+    server = own_server('--appendonly', 'yes', '--appendfsync', 'always')
+    r = server.connect()
+    for i in range(1, 5):
+        r('XADD', 's', f'{i}-0', 'n', i)
+    r('XGROUP', 'CREATE', 's', 'g', '0')
+    r('XREADGROUP', 'GROUP', 'g', 'alice', 'COUNT', 3, 'STREAMS', 's', '>')
+    r('XREADGROUP', 'GROUP', 'g', 'bob', 'STREAMS', 's', '>')
+    # Reading its history delivers alice's entries again
+    r('XREADGROUP', 'GROUP', 'g', 'alice', 'STREAMS', 's', '0')
+    # A pending entry deleted from the stream stays pending
+    r('XDEL', 's', '2-0')
+    before = pending_state(r, 's')
+    assert before[0][0] == 4 and [count for _, _, count in before[1]] == [2, 2, 2, 1]
+
+    server.restart()
+    r = server.connect()
+    assert pending_state(r, 's') == before
+
+    assert r('BGREWRITEAOF').startswith('Background')
+    wait_for(lambda: info(r, 'persistence')['aof_rewrite_in_progress'] == '0')
+    server.restart()
+    r = server.connect()
+    assert pending_state(r, 's') == before
+    assert r('XREADGROUP', 'GROUP', 'g', 'alice', 'STREAMS', 's', '0')[0][1][1] == [b'2-0', None]
+    assert r('XACK', 's', 'g', '2-0') == 1
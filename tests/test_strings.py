@@ -0,0 +1,65 @@
+import pytest
+
+LLONG_MAX = (1 << 63) - 1
+LLONG_MIN = -(1 << 63)
+
+
+def test_incr_overflow(r, key):
+    r('SET', key, LLONG_MAX)
+    assert str(r('INCR', key)) == 'ERR increment or decrement would overflow'
+    assert r('GET', key) == b'%d' % LLONG_MAX
+    assert str(r('DECRBY', key, -1)) == 'ERR increment or decrement would overflow'
+    r('SET', key, LLONG_MIN)
+    assert str(r('DECR', key)) == 'ERR increment or decrement would overflow'
+    assert str(r('DECRBY', key, LLONG_MIN)) == 'ERR decrement would overflow'
+    assert r('INCRBY', key, LLONG_MAX) == -1
+
+
+def test_incr_non_integer(r, key):
+    for value in ['abc', '1.5', ' 1', '007', '+1', str(LLONG_MAX + 1)]:
+        r('SET', key, value)
+        assert str(r('INCR', key)) == 'ERR value is not an integer or out of range'
+        # The value is left as it was, not in some normalized form
+        assert r('GET', key) == value.encode()
+    r('SET', key, 1)
+    assert str(r('INCRBY', key, '1.0')) == 'ERR value is not an integer or out of range'
+    r('RPUSH', key + ':list', 'x')
+    assert str(r('INCR', key + ':list')).startswith('WRONGTYPE')
+
+
+def test_incrbyfloat_formatting(r, key):
+    assert r('INCRBYFLOAT', key, '10.5') == b'10.5'
+    assert r('INCRBYFLOAT', key, '0.1') == b'10.6'
+    assert r('INCRBYFLOAT', key, '-10.6') == b'0'
+    assert r('INCRBYFLOAT', key, '5.0e3') == b'5000'
+    # A whole result is an integer again, for INCR
+    assert r('INCR', key) == 5001
+    # and a large one is still written out in full, not in exponent notation
+    assert r('INCRBYFLOAT', key + ':large', '1e20') == b'100000000000000000000'
+    r('SET', key, 3)
+    assert r('INCRBYFLOAT', key, '1.5') == b'4.5'
+    for increment in ['abc', ' 1', 'nan']:
+        assert str(r('INCRBYFLOAT', key, increment)) == 'ERR value is not a valid float'
+    assert str(r('INCRBYFLOAT', key, 'inf')) == 'ERR increment would produce NaN or Infinity'
+    assert r('GET', key) == b'4.5'
+
+
+@pytest.mark.parametrize('persistence', [('--save', ''), ('--appendonly', 'yes')], ids=['rdb', 'aof'])
+def test_values_survive_restart(own_server, persistence):
+    values = {'counter': b'12345', 'small': b'7', 'negative': b'-42', 'max': b'%d' % LLONG_MAX,
+              'padded': b'007', 'text': b'hello', 'float': b'2.5'}
+    server = own_server(*persistence)
+    r = server.connect()
+    for key, value in values.items():
+        r('SET', key, value)
+    r('INCR', 'counter')
+    if persistence[0] == '--save':
+        assert r('SAVE') == 'OK'
+    server.restart()
+    r = server.connect()
+    values['counter'] = b'12346'
+    for key, value in values.items():
+        assert r('GET', key) == value
+    assert r('INCR', 'counter') == 12347
+    assert str(r('INCR', 'padded')) == 'ERR value is not an integer or out of range'
+    assert r('APPEND', 'small', '0') == 2 and r('GET', 'small') == b'70'
@@ -0,0 +1,77 @@
+"""Memory allocated and time taken per GET/SET on the request path.
+
+Runs in process, without sockets: each request goes through the parser,
+process_command and the reply encoding, which is where arguments and
+replies get copied. For each value size it reports how far a request
+pushes the traced memory above what was held before it (tracemalloc's
+peak, so every copy alive at the same time counts), and the time per
+request with tracing off.
+
+Usage: python3 -m tools.alloc_benchmark [--sizes 16,1024,65536] [--requests N] [--keys K]
+"""
+import argparse
+import time
+import tracemalloc
+
+from app import main as server
+from app.resp import RespParser
+
+
+def encode_request(*args):
+    out = [b'*%d\r\n' % len(args)]
+    for arg in args:
+        out.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+    return b''.join(out)
+
+
+def run_request(client, parser, data):
+    parser.feed(data)
+    with server.store_lock:
+        for command_parts in parser:
+            server.process_command(client, command_parts)
+    client.reply.clear()
+    client.reply_bytes = 0
+
+
+def measure(requests, traced):
+    client = server.Client(('benchmark', 0))
+    parser = RespParser()
+    if not traced:
+        start = time.perf_counter()
+        for data in requests:
+            run_request(client, parser, data)
+        return (time.perf_counter() - start) / len(requests)
+    total = 0
+    for data in requests:
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        run_request(client, parser, data)
+        total += tracemalloc.get_traced_memory()[1] - before
+    return total / len(requests)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='16,1024,65536')
+    parser.add_argument('--requests', type=int, default=20000)
+    parser.add_argument('--keys', type=int, default=1000)
+    args = parser.parse_args()
+
+    print(f"{'value':>8} {'command':>8} {'bytes/request':>14} {'usec/request':>13}")
+    for size in (int(n) for n in args.sizes.split(',')):
+        value = b'v' * size
+        keys = [b'key:%d' % i for i in range(args.keys)]
+        commands = {
+            'SET': [encode_request(b'SET', keys[i % len(keys)], value) for i in range(args.requests)],
+            'GET': [encode_request(b'GET', keys[i % len(keys)]) for i in range(args.requests)],
+        }
+        for name, requests in commands.items():
+            seconds = measure(requests, traced=False)
+            tracemalloc.start()
+            allocated = measure(requests, traced=True)
+            tracemalloc.stop()
+            print(f"{size:>8} {name:>8} {allocated:>14.0f} {seconds * 1e6:>13.2f}")
+
+
+if __name__ == "__main__":
+    main()
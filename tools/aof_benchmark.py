@@ -0,0 +1,71 @@
+"""Write throughput with the append-only file off and under each fsync policy.
+
+Starts a server per configuration in a scratch directory and has a few
+clients SET keys, each with a small pipeline.
+
+Usage: python3 -m tools.aof_benchmark [--requests N] [--clients C] [--pipeline P]
+                                      [--io-mode threads|asyncio] [--port PORT]
+"""
+import argparse
+import shutil
+import tempfile
+import threading
+import time
+
+from tools.resp_client import Connection, start_server, stop_server
+
+CONFIGURATIONS = [
+    ("aof off", ['--appendonly', 'no']),
+    ("appendfsync no", ['--appendonly', 'yes', '--appendfsync', 'no']),
+    ("appendfsync everysec", ['--appendonly', 'yes', '--appendfsync', 'everysec']),
+    ("appendfsync always", ['--appendonly', 'yes', '--appendfsync', 'always']),
+]
+
+
+def run_client(port, client_id, requests, pipeline):
+    conn = Connection(port=port)
+    value = b'x' * 32
+    sent = 0
+    while sent < requests:
+        batch = min(pipeline, requests - sent)
+        conn.send_many([(b'SET', b'key:%d:%d' % (client_id, sent + i), value) for i in range(batch)])
+        for _ in range(batch):
+            conn.read_reply()
+        sent += batch
+    conn.close()
+
+
+def measure(port, clients, requests, pipeline):
+    per_client = requests // clients
+    threads = [threading.Thread(target=run_client, args=(port, i, per_client, pipeline)) for i in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return per_client * clients / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=50000)
+    parser.add_argument('--clients', type=int, default=4)
+    parser.add_argument('--pipeline', type=int, default=16)
+    parser.add_argument('--io-mode', default='threads', choices=('threads', 'asyncio'))
+    parser.add_argument('--port', type=int, default=6399)
+    args = parser.parse_args()
+
+    print(f"{args.requests} SETs, {args.clients} clients, pipeline {args.pipeline}, {args.io_mode}")
+    for name, options in CONFIGURATIONS:
+        directory = tempfile.mkdtemp(prefix='aof-benchmark-')
+        server = start_server('--io-mode', args.io_mode, '--dir', directory, *options, port=args.port)
+        try:
+            ops = measure(args.port, args.clients, args.requests, args.pipeline)
+        finally:
+            stop_server(server)
+            shutil.rmtree(directory, ignore_errors=True)
+        print(f"{name:22} {ops:10.0f} ops/sec")
+
+
+if __name__ == "__main__":
+    main()
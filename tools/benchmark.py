@@ -0,0 +1,355 @@
+"""Load generator in the style of redis-benchmark.
+
+Each test sends --requests commands from --clients connections, --pipeline
+commands per round trip, over keys drawn at random from --keyspace keys
+with --data-size byte values. The connections are spread over client
+processes (--processes) that each drive theirs from one selector loop, so
+the load generator isn't held back by a single interpreter. A request's
+latency runs from sending its pipeline batch to reading its reply. Each
+test reports throughput and latency percentiles, and --json writes them
+all out for scripts.
+
+With --baseline, the results are compared with an earlier --json file,
+and the exit status is 1 if any test lost more than --tolerance of its
+throughput or gained as much on its p99 latency, or got error replies.
+
+Tests:
+  set, get, incr   SET/GET/INCR key:<n>
+  lpush, lpop      LPUSH/LPOP on one list
+  xadd             XADD * on one stream
+  xrange           XRANGE - + COUNT 10 on that stream (run after xadd)
+  xread            XREAD BLOCK on a stream per client, woken by an XADD
+                   from a second connection; its latency is the wakeup
+                   time, and the pipeline is always 1
+
+Usage: python3 -m tools.benchmark [--host H] [--port P] [--clients 50] [--requests 100000]
+                                  [--pipeline 1] [--keyspace 100000] [--data-size 3]
+                                  [--tests set,get,...] [--processes N] [--start-server]
+                                  [--io-mode threads|asyncio] [--json FILE|-]
+                                  [--baseline FILE] [--tolerance 0.1]
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import selectors
+import socket
+import sys
+import time
+
+from tools.resp_client import Connection, encode_command, start_server, stop_server
+
+TESTS = ('set', 'get', 'incr', 'lpush', 'lpop', 'xadd', 'xrange', 'xread')
+LIST_KEY = b'bench:list'
+STREAM_KEY = b'bench:stream'
+
+
+def reply_end(buf, pos):
+    """Index just past the reply starting at buf[pos], -1 if it isn't all in yet"""
+    line_end = buf.find(b'\r\n', pos)
+    if line_end < 0:
+        return -1
+    kind = buf[pos]
+    if kind == 0x24:  # $
+        length = int(buf[pos + 1:line_end])
+        if length < 0:
+            return line_end + 2
+        end = line_end + 2 + length + 2
+        return end if end <= len(buf) else -1
+    if kind == 0x2a:  # *
+        count = int(buf[pos + 1:line_end])
+        pos = line_end + 2
+        for _ in range(max(count, 0)):
+            pos = reply_end(buf, pos)
+            if pos < 0:
+                return -1
+        return pos
+    return line_end + 2
+
+
+class BenchClient:
+    """One connection's share of a test, and where it is in it.
+
+    send_batch() sends the next pipeline batch, and read() counts off its
+    replies. The xread test also sends on a producer, a second connection
+    that adds the entries the first one waits for."""
+
+    def __init__(self, test, index, requests, args, rng):
+        self.test = test
+        self.index = index
+        self.left = requests
+        self.args = args
+        self.rng = rng
+        self.value = b'x' * args.data_size
+        self.sock = self.connect()
+        self.producer = self.connect() if test == 'xread' else None
+        self.buf = bytearray()
+        self.producer_buf = bytearray()
+        self.waiting = 0           # replies still due on sock
+        self.producer_waiting = 0  # and on producer
+        self.sent_at = 0.0
+        self.latencies = []
+        self.errors = 0
+        # xread: a stream of its own, and the ID of the last entry read from it
+        self.stream = b'bench:xread:%d:%d' % (os.getpid(), index)
+        self.seq = 0
+
+    def connect(self):
+        sock = socket.create_connection((self.args.host, self.args.port))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+
+    def random_key(self, prefix):
+        return b'%s:%012d' % (prefix, self.rng.randrange(self.args.keyspace))
+
+    def command(self):
+        test = self.test
+        if test == 'set':
+            return (b'SET', self.random_key(b'key'), self.value)
+        if test == 'get':
+            return (b'GET', self.random_key(b'key'))
+        if test == 'incr':
+            return (b'INCR', self.random_key(b'counter'))
+        if test == 'lpush':
+            return (b'LPUSH', LIST_KEY, self.value)
+        if test == 'lpop':
+            return (b'LPOP', LIST_KEY)
+        if test == 'xadd':
+            return (b'XADD', STREAM_KEY, b'*', b'field', self.value)
+        return (b'XRANGE', STREAM_KEY, b'-', b'+', b'COUNT', b'10')
+
+    def send_batch(self):
+        if self.test == 'xread':
+            # Block first, then add the entry it waits for. If the XADD gets
+            # in first the XREAD returns at once, which is still a valid
+            # sample: the explicit ID leaves nothing to miss.
+            last_id = b'%d-1' % self.seq
+            self.seq += 1
+            self.sent_at = time.perf_counter()
+            self.sock.sendall(encode_command([b'XREAD', b'BLOCK', b'0', b'STREAMS', self.stream, last_id]))
+            self.producer.sendall(encode_command([b'XADD', self.stream, b'%d-1' % self.seq, b'field', self.value]))
+            self.waiting = self.producer_waiting = 1
+            self.left -= 1
+            return
+        batch = min(self.args.pipeline, self.left)
+        data = b''.join(encode_command(self.command()) for _ in range(batch))
+        self.sent_at = time.perf_counter()
+        self.sock.sendall(data)
+        self.waiting = batch
+        self.left -= batch
+
+    def read(self, sock):
+        """Take in what arrived on sock; False once the connection is closed"""
+        data = sock.recv(256 * 1024)
+        if not data:
+            return False
+        now = time.perf_counter()
+        producer = sock is self.producer
+        buf = self.producer_buf if producer else self.buf
+        buf += data
+        pos = 0
+        while pos < len(buf):
+            end = reply_end(buf, pos)
+            if end < 0:
+                break
+            if buf[pos] == 0x2d:  # -
+                self.errors += 1
+            if producer:
+                self.producer_waiting -= 1
+            else:
+                self.latencies.append(now - self.sent_at)
+                self.waiting -= 1
+            pos = end
+        del buf[:pos]
+        return True
+
+    def done_with_batch(self):
+        return self.waiting == 0 and self.producer_waiting == 0
+
+    def close(self):
+        if self.producer is not None:
+            self.producer.close()
+        self.sock.close()
+
+
+def run_clients(test, first_index, per_client, count, args, start_barrier, results):
+    """Client process: drive `count` connections through the test, then
+    report (start, end, latencies, errors)"""
+    rng = random.Random(first_index)
+    clients = [BenchClient(test, first_index + i, per_client, args, rng) for i in range(count)]
+    selector = selectors.DefaultSelector()
+    for client in clients:
+        selector.register(client.sock, selectors.EVENT_READ, client)
+        if client.producer is not None:
+            selector.register(client.producer, selectors.EVENT_READ, client)
+    start_barrier.wait()
+    start = time.monotonic()
+    running = 0
+    for client in clients:
+        if client.left:
+            client.send_batch()
+            running += 1
+    while running:
+        for key, _ in selector.select():
+            client = key.data
+            if not client.read(key.fileobj):
+                raise ConnectionError("connection closed by the server")
+            if client.done_with_batch():
+                if client.left:
+                    client.send_batch()
+                else:
+                    running -= 1
+    end = time.monotonic()
+    latencies = []
+    errors = 0
+    for client in clients:
+        latencies += client.latencies
+        errors += client.errors
+    if test == 'xread':
+        cleanup = Connection(args.host, args.port)
+        cleanup(b'DEL', *[client.stream for client in clients])
+        cleanup.close()
+    for client in clients:
+        client.close()
+    results.put((start, end, latencies, errors))
+
+
+def percentile(samples, p):
+    return samples[min(int(len(samples) * p), len(samples) - 1)]
+
+
+def run_test(test, args):
+    processes = min(args.processes, args.clients)
+    per_client = args.requests // args.clients
+    barrier = multiprocessing.Barrier(processes + 1)
+    results = multiprocessing.Queue()
+    workers = []
+    first = 0
+    for i in range(processes):
+        count = args.clients // processes + (i < args.clients % processes)
+        workers.append(multiprocessing.Process(
+            target=run_clients, args=(test, first, per_client, count, args, barrier, results)))
+        first += count
+    for worker in workers:
+        worker.start()
+    barrier.wait()
+    collected = [results.get() for _ in workers]
+    for worker in workers:
+        worker.join()
+        if worker.exitcode:
+            raise RuntimeError(f"client process failed on test {test}")
+
+    seconds = max(end for _, end, _, _ in collected) - min(start for start, _, _, _ in collected)
+    latencies = sorted(sample for _, _, samples, _ in collected for sample in samples)
+    requests = len(latencies)
+    return {
+        'test': test,
+        'requests': requests,
+        'errors': sum(errors for _, _, _, errors in collected),
+        'seconds': round(seconds, 6),
+        'requests_per_second': round(requests / seconds, 2) if seconds else 0.0,
+        'latency_ms': {
+            'avg': round(sum(latencies) / requests * 1000, 4),
+            'p50': round(percentile(latencies, 0.5) * 1000, 4),
+            'p99': round(percentile(latencies, 0.99) * 1000, 4),
+            'p999': round(percentile(latencies, 0.999) * 1000, 4),
+            'max': round(latencies[-1] * 1000, 4),
+        },
+    }
+
+
+def print_result(result, args):
+    latency = result['latency_ms']
+    pipeline = 1 if result['test'] == 'xread' else args.pipeline
+    print(f"====== {result['test'].upper()} ======")
+    print(f"  {result['requests']} requests completed in {result['seconds']:.2f} seconds")
+    print(f"  {args.clients} parallel clients, {args.data_size} bytes payload, pipeline {pipeline}, "
+          f"keyspace {args.keyspace}")
+    if result['errors']:
+        print(f"  {result['errors']} error replies")
+    print(f"  {result['requests_per_second']:.2f} requests per second")
+    print(f"  latency (msec): avg {latency['avg']:.3f}  p50 {latency['p50']:.3f}  p99 {latency['p99']:.3f}  "
+          f"p99.9 {latency['p999']:.3f}  max {latency['max']:.3f}")
+    print()
+
+
+def compare(results, baseline_path, tolerance):
+    """Regressions against an earlier --json file, as printable lines"""
+    with open(baseline_path) as f:
+        baseline = {result['test']: result for result in json.load(f)['results']}
+    regressions = []
+    for result in results:
+        before = baseline.get(result['test'])
+        if result['errors']:
+            regressions.append(f"{result['test']}: {result['errors']} error replies")
+        if before is None:
+            continue
+        if result['requests_per_second'] < before['requests_per_second'] * (1 - tolerance):
+            regressions.append(f"{result['test']}: {result['requests_per_second']:.0f} requests per second, "
+                               f"was {before['requests_per_second']:.0f}")
+        if result['latency_ms']['p99'] > before['latency_ms']['p99'] * (1 + tolerance):
+            regressions.append(f"{result['test']}: p99 {result['latency_ms']['p99']:.3f} ms, "
+                               f"was {before['latency_ms']['p99']:.3f} ms")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=6379)
+    parser.add_argument('--clients', type=int, default=50)
+    parser.add_argument('--requests', type=int, default=100000)
+    parser.add_argument('--pipeline', type=int, default=1)
+    parser.add_argument('--keyspace', type=int, default=100000)
+    parser.add_argument('--data-size', type=int, default=3)
+    parser.add_argument('--tests', default=','.join(TESTS))
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--start-server', action='store_true',
+                        help="run a server on --port for the benchmark instead of using a running one")
+    parser.add_argument('--io-mode', default='asyncio', choices=('threads', 'asyncio'),
+                        help="I/O mode of the server started by --start-server")
+    parser.add_argument('--json', help="write the results as JSON to this file, - for stdout")
+    parser.add_argument('--baseline', help="JSON results of an earlier run to check for regressions")
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    args = parser.parse_args()
+    tests = [test.strip().lower() for test in args.tests.split(',') if test.strip()]
+    unknown = [test for test in tests if test not in TESTS]
+    if unknown:
+        parser.error(f"unknown tests: {', '.join(unknown)} (known: {', '.join(TESTS)})")
+    if args.clients < 1 or args.requests < args.clients or args.pipeline < 1 or args.keyspace < 1:
+        parser.error("--clients, --pipeline and --keyspace must be positive, and --requests at least --clients")
+
+    server = start_server('--io-mode', args.io_mode, '--save', '', port=args.port) if args.start_server else None
+    try:
+        results = []
+        for test in tests:
+            result = run_test(test, args)
+            results.append(result)
+            if args.json != '-':
+                print_result(result, args)
+    finally:
+        if server is not None:
+            stop_server(server)
+
+    if args.json:
+        config = {name: getattr(args, name) for name in
+                  ('host', 'port', 'clients', 'requests', 'pipeline', 'keyspace', 'data_size', 'processes')}
+        if args.start_server:
+            config['io_mode'] = args.io_mode
+        document = json.dumps({'config': config, 'results': results}, indent=2)
+        if args.json == '-':
+            print(document)
+        else:
+            with open(args.json, 'w') as f:
+                f.write(document + '\n')
+    if args.baseline:
+        regressions = compare(results, args.baseline, args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
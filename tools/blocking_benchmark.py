@@ -0,0 +1,92 @@
+"""Wakeup latency with many clients blocked in BLPOP.
+
+Opens --clients connections that all block in BLPOP, then pushes one element
+at a time from another connection and times how long the client it serves
+takes to get its reply (from sending RPUSH to reading the reply). With
+--keys shared every client waits on the same list, and a served client
+blocks again at the back of the queue. Its position tells whether the
+push went to the client that had waited longest. With --keys own each
+client waits on its own list and the pushes pick lists at random.
+
+Usage: python3 -m tools.blocking_benchmark [--clients 10000] [--pushes 1000] [--keys shared|own]
+                                           [--io-mode asyncio|threads] [--port PORT]
+"""
+import argparse
+import random
+import selectors
+import socket
+import time
+
+from tools.resp_client import Connection, encode_command, start_server, stop_server
+
+
+def percentile(samples, p):
+    return samples[min(int(len(samples) * p), len(samples) - 1)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--clients', type=int, default=10000)
+    parser.add_argument('--pushes', type=int, default=1000)
+    parser.add_argument('--keys', default='shared', choices=('shared', 'own'))
+    parser.add_argument('--io-mode', default='asyncio', choices=('threads', 'asyncio'))
+    parser.add_argument('--port', type=int, default=6399)
+    args = parser.parse_args()
+
+    server = start_server('--io-mode', args.io_mode, '--save', '', port=args.port)
+    selector = selectors.DefaultSelector()
+    sockets = []
+    try:
+        pusher = Connection(port=args.port)
+        key_of = [b'list' if args.keys == 'shared' else b'list:%d' % i for i in range(args.clients)]
+        queue = []  # shared list: client indexes in the order they blocked
+        for i in range(args.clients):
+            sock = socket.create_connection(('localhost', args.port))
+            sock.sendall(encode_command([b'BLPOP', key_of[i], 0]))
+            selector.register(sock, selectors.EVENT_READ, i)
+            sockets.append(sock)
+            queue.append(i)
+            if i % 100 == 99:
+                # Let the server catch up, so clients block in the order they were opened
+                pusher('PING')
+        time.sleep(1)
+        print(f"{args.clients} clients blocked in BLPOP ({args.keys} keys), {args.io_mode}")
+
+        latencies = []
+        out_of_order = 0
+        rng = random.Random(0)
+        for n in range(args.pushes):
+            target = queue[0] if args.keys == 'shared' else rng.randrange(args.clients)
+            start = time.perf_counter()
+            pusher.send(b'RPUSH', key_of[target], b'%d' % n)
+            served = None
+            while served is None:
+                for selector_key, _ in selector.select():
+                    served = selector_key.data
+            reply = sockets[served].recv(4096)
+            latencies.append(time.perf_counter() - start)
+            pusher.read_reply()
+            if not reply.startswith(b'*2\r\n'):
+                raise RuntimeError(f"unexpected reply {reply!r}")
+            if served != target:
+                out_of_order += 1
+            if args.keys == 'shared':
+                queue.remove(served)
+                queue.append(served)
+            sockets[served].sendall(encode_command([b'BLPOP', key_of[served], 0]))
+            if args.keys == 'shared':
+                # The client must be queued again before the next push
+                pusher('PING')
+
+        latencies.sort()
+        print(f"{args.pushes} pushes: wakeup latency p50 {percentile(latencies, 0.5) * 1e6:.0f}us "
+              f"p99 {percentile(latencies, 0.99) * 1e6:.0f}us max {latencies[-1] * 1e6:.0f}us, "
+              f"{out_of_order} served another client than the one expected")
+    finally:
+        for sock in sockets:
+            sock.close()
+        stop_server(server)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""Run a cluster of local nodes, and move slots between nodes while it serves.
+
+    python3 -m tools.cluster create [--nodes 3] [--port 7000] [--dir DIR] [--io-mode threads|asyncio]
+        Starts the nodes (node N in DIR/<port>), has them meet, splits the
+        slots evenly and waits for every node to report cluster_state:ok.
+        Runs until interrupted.
+
+    python3 -m tools.cluster reshard --from PORT --to PORT --slots N [--batch 100]
+        Moves N slots of one node to another: the slot is marked IMPORTING
+        and MIGRATING, its keys are MIGRATEd in batches, then both nodes are
+        told the new owner and the others learn it from them. Clients keep
+        working throughout, redirected with -ASK for keys already moved.
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from tools.resp_client import Connection, RespError, start_server, stop_server
+
+HASH_SLOTS = 16384
+
+
+def call(conn, *args):
+    reply = conn(*args)
+    if isinstance(reply, RespError):
+        raise reply
+    return reply
+
+
+def wait_for(condition, timeout, what):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"timed out waiting for {what}")
+        time.sleep(0.2)
+
+
+def cluster_ok(conns, count):
+    for conn in conns:
+        info = call(conn, 'CLUSTER', 'INFO').decode()
+        if 'cluster_state:ok' not in info or f'cluster_known_nodes:{count}' not in info:
+            return False
+    return True
+
+
+def create(args):
+    directory = args.dir or tempfile.mkdtemp(prefix='cluster-')
+    ports = [args.port + i for i in range(args.nodes)]
+    servers = []
+    try:
+        for port in ports:
+            node_dir = os.path.join(directory, str(port))
+            os.makedirs(node_dir, exist_ok=True)
+            servers.append(start_server('--io-mode', args.io_mode, '--cluster-enabled', 'yes',
+                                        '--dir', node_dir, port=port, quiet=False))
+        conns = [Connection(port=port) for port in ports]
+        for i, conn in enumerate(conns):
+            first = i * HASH_SLOTS // len(conns)
+            last = (i + 1) * HASH_SLOTS // len(conns) - 1
+            call(conn, 'CLUSTER', 'ADDSLOTSRANGE', first, last)
+        for port in ports[1:]:
+            call(conns[0], 'CLUSTER', 'MEET', '127.0.0.1', port)
+        wait_for(lambda: cluster_ok(conns, len(conns)), 30, "the cluster to form")
+        print(f"Cluster of {len(ports)} nodes ready on ports {ports[0]}-{ports[-1]}, data in {directory}")
+        print(call(conns[0], 'CLUSTER', 'NODES').decode(), end='')
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for server in servers:
+            stop_server(server)
+
+
+def node_slots(conn, node_id):
+    slots = []
+    for first, last, (host, port, owner, *_) in call(conn, 'CLUSTER', 'SLOTS'):
+        if owner.decode() == node_id:
+            slots.extend(range(first, last + 1))
+    return slots
+
+
+def reshard(args):
+    source, target = Connection(port=args.source), Connection(port=args.target)
+    source_id = call(source, 'CLUSTER', 'MYID').decode()
+    target_id = call(target, 'CLUSTER', 'MYID').decode()
+    slots = node_slots(source, source_id)[:args.slots]
+    moved_keys = 0
+    start = time.monotonic()
+    for slot in slots:
+        call(target, 'CLUSTER', 'SETSLOT', slot, 'IMPORTING', source_id)
+        call(source, 'CLUSTER', 'SETSLOT', slot, 'MIGRATING', target_id)
+        while True:
+            keys = call(source, 'CLUSTER', 'GETKEYSINSLOT', slot, args.batch)
+            if not keys:
+                break
+            call(source, 'MIGRATE', args.host, args.target, '', 0, 5000, 'REPLACE', 'KEYS', *keys)
+            moved_keys += len(keys)
+        call(target, 'CLUSTER', 'SETSLOT', slot, 'NODE', target_id)
+        call(source, 'CLUSTER', 'SETSLOT', slot, 'NODE', target_id)
+    print(f"Moved {len(slots)} slots ({moved_keys} keys) from {args.source} to {args.target} "
+          f"in {time.monotonic() - start:.2f} seconds")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+    create_parser = commands.add_parser('create')
+    create_parser.add_argument('--nodes', type=int, default=3)
+    create_parser.add_argument('--port', type=int, default=7000)
+    create_parser.add_argument('--dir')
+    create_parser.add_argument('--io-mode', default='threads', choices=('threads', 'asyncio'))
+    reshard_parser = commands.add_parser('reshard')
+    reshard_parser.add_argument('--from', dest='source', type=int, required=True)
+    reshard_parser.add_argument('--to', dest='target', type=int, required=True)
+    reshard_parser.add_argument('--slots', type=int, required=True)
+    reshard_parser.add_argument('--batch', type=int, default=100)
+    reshard_parser.add_argument('--host', default='127.0.0.1')
+    args = parser.parse_args()
+    if args.command == 'create':
+        create(args)
+    else:
+        reshard(args)
+
+
+if __name__ == "__main__":
+    main()
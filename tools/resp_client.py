@@ -0,0 +1,88 @@
+"""Minimal blocking RESP client for the tools in this directory and the tests."""
+import socket
+import subprocess
+import sys
+import time
+
+
+def encode_command(args):
+    out = [b'*%d\r\n' % len(args)]
+    for arg in args:
+        if not isinstance(arg, bytes):
+            arg = str(arg).encode()
+        out.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+    return b''.join(out)
+
+
+class RespError(Exception):
+    pass
+
+
+class Connection:
+    def __init__(self, host="localhost", port=6379, timeout=30):
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = self.sock.makefile('rb')
+
+    def close(self):
+        self.reader.close()
+        self.sock.close()
+
+    def send(self, *args):
+        self.sock.sendall(encode_command(args))
+
+    def send_many(self, commands):
+        self.sock.sendall(b''.join(encode_command(args) for args in commands))
+
+    def read_reply(self):
+        """Next reply: str, int, bytes, list, None, or a RespError instance"""
+        line = self.reader.readline()
+        if not line:
+            raise ConnectionError("connection closed by the server")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b'+':
+            return rest.decode()
+        if kind == b'-':
+            return RespError(rest.decode())
+        if kind == b':':
+            return int(rest)
+        if kind == b'$':
+            length = int(rest)
+            if length < 0:
+                return None
+            return self.reader.read(length + 2)[:-2]
+        if kind == b'*':
+            length = int(rest)
+            if length < 0:
+                return None
+            return [self.read_reply() for _ in range(length)]
+        raise RespError(f"unexpected reply {line!r}")
+
+    def __call__(self, *args):
+        self.send(*args)
+        return self.read_reply()
+
+
+def start_server(*args, port=6379, quiet=True):
+    """Run app.main in a child process and wait until it accepts connections"""
+    process = subprocess.Popen([sys.executable, '-m', 'app.main', '--port', str(port), *args],
+                               stdout=subprocess.DEVNULL if quiet else None)
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            socket.create_connection(("localhost", port)).close()
+            return process
+        except OSError:
+            if process.poll() is not None or time.monotonic() > deadline:
+                process.kill()
+                raise RuntimeError(f"server on port {port} did not start")
+            time.sleep(0.05)
+
+
+def stop_server(process):
+    process.terminate()
+    try:
+        process.wait(5)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
@@ -0,0 +1,76 @@
+"""Throughput against the number of worker processes (--workers).
+
+Starts a server per worker count and drives it from client processes (not
+threads, so the load generator isn't held back by one interpreter), each
+sending a pipelined mix of SET and GET on random keys. Keys land on every
+worker, so most commands arriving at a worker are forwarded to another one,
+which is the worst case for this mode. Scaling needs as many cores as
+workers plus clients.
+
+Usage: python3 -m tools.worker_benchmark [--workers 1,2,4] [--requests N] [--clients C]
+                                         [--pipeline P] [--io-mode threads|asyncio] [--port PORT]
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import time
+
+from tools.resp_client import Connection, start_server, stop_server
+
+
+def run_client(port, requests, pipeline, seed):
+    conn = Connection(port=port)
+    rng = random.Random(seed)
+    value = b'x' * 32
+    sent = 0
+    while sent < requests:
+        batch = min(pipeline, requests - sent)
+        commands = []
+        for _ in range(batch):
+            key = b'key:%d' % rng.randrange(100000)
+            commands.append((b'SET', key, value) if rng.random() < 0.5 else (b'GET', key))
+        conn.send_many(commands)
+        for _ in range(batch):
+            conn.read_reply()
+        sent += batch
+    conn.close()
+
+
+def measure(port, clients, requests, pipeline):
+    per_client = requests // clients
+    processes = [multiprocessing.Process(target=run_client, args=(port, per_client, pipeline, i))
+                 for i in range(clients)]
+    start = time.perf_counter()
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    return per_client * clients / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', default=','.join(str(n) for n in (1, 2, 4, 8) if n <= (os.cpu_count() or 1)) or '1')
+    parser.add_argument('--requests', type=int, default=200000)
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--pipeline', type=int, default=16)
+    parser.add_argument('--io-mode', default='asyncio', choices=('threads', 'asyncio'))
+    parser.add_argument('--port', type=int, default=6399)
+    args = parser.parse_args()
+
+    print(f"{args.requests} SET/GET, {args.clients} client processes, pipeline {args.pipeline}, "
+          f"{args.io_mode}, {os.cpu_count()} cores")
+    baseline = None
+    for count in (int(n) for n in args.workers.split(',')):
+        server = start_server('--io-mode', args.io_mode, '--workers', str(count), '--save', '', port=args.port)
+        try:
+            ops = measure(args.port, args.clients, args.requests, args.pipeline)
+        finally:
+            stop_server(server)
+        baseline = baseline or ops
+        print(f"{count:3} workers {ops:10.0f} ops/sec  x{ops / baseline:.2f}")
+
+
+if __name__ == "__main__":
+    main()